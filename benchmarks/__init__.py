@@ -0,0 +1,6 @@
+"""حزمة قياس الأداء: مولّد متجر صناعي ومقاييس للمسارات الساخنة في main.py.
+
+    python -m benchmarks.run --size medium --out results.json
+    python -m benchmarks.compare old.json new.json
+    python -m benchmarks.loadtest --cashiers 8 --duration 20
+"""
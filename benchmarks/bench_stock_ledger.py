@@ -0,0 +1,126 @@
+"""قياس أداء استعلامات المخزون الزمنية (لقطة + فرق) مقابل إعادة تشغيل كامل السجل.
+
+الاستخدام:
+    python benchmarks/bench_stock_ledger.py --movements 2000000 --products 2000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+def build_ledger(db_path, n_products, n_movements, seed):
+    """تنشئ سجلًا صناعيًا بالجملة مع لقطات كل STOCK_SNAPSHOT_INTERVAL حركة كما يفعل التطبيق."""
+    rng = random.Random(seed)
+    main.DB_NAME = db_path
+    main.init_db()
+    with main.db_context() as conn:
+        conn.executemany(
+            "INSERT INTO products (id, name, cost_price, sell_price, quantity) VALUES (?, ?, 1.0, 1.5, 0)",
+            [(pid, f"P{pid:06d}") for pid in range(1, n_products + 1)],
+        )
+        conn.execute("DELETE FROM stock_snapshot_items")
+        conn.execute("DELETE FROM stock_snapshots")
+
+        stock = dict.fromkeys(range(1, n_products + 1), 0)
+        start = datetime(2020, 1, 1)
+        step = timedelta(days=365 * 3) / n_movements
+        types = ['sale'] * 8 + ['receipt', 'adjustment']
+        batch = []
+        conn.execute("INSERT INTO stock_snapshots (id, taken_at, last_movement_id) VALUES (1, ?, 0)",
+                     (start.strftime("%Y-%m-%d %H:%M:%S"),))
+        conn.executemany("INSERT INTO stock_snapshot_items VALUES (1, ?, 0)", [(pid,) for pid in stock])
+        snapshot_id = 1
+        for mid in range(1, n_movements + 1):
+            pid = rng.randint(1, n_products)
+            movement_type = rng.choice(types)
+            change = -rng.randint(1, 3) if movement_type == 'sale' else rng.randint(1, 50)
+            stock[pid] += change
+            moved_at = (start + step * mid).strftime("%Y-%m-%d %H:%M:%S")
+            batch.append((mid, pid, movement_type, change, moved_at))
+            if mid % main.STOCK_SNAPSHOT_INTERVAL == 0:
+                conn.executemany("INSERT INTO stock_movements (id, product_id, movement_type, quantity_change, moved_at) VALUES (?, ?, ?, ?, ?)", batch)
+                batch = []
+                snapshot_id += 1
+                conn.execute("INSERT INTO stock_snapshots (id, taken_at, last_movement_id) VALUES (?, ?, ?)",
+                             (snapshot_id, moved_at, mid))
+                conn.executemany("INSERT INTO stock_snapshot_items VALUES (?, ?, ?)",
+                                 [(snapshot_id, pid, qty) for pid, qty in stock.items()])
+        conn.executemany("INSERT INTO stock_movements (id, product_id, movement_type, quantity_change, moved_at) VALUES (?, ?, ?, ?, ?)", batch)
+        conn.executemany("UPDATE products SET quantity = ? WHERE id = ?", [(qty, pid) for pid, qty in stock.items()])
+    return start, start + step * n_movements
+
+
+def full_replay(at_time):
+    with main.db_context() as conn:
+        rows = conn.execute("SELECT product_id, SUM(quantity_change) FROM stock_movements WHERE moved_at <= ? GROUP BY product_id",
+                            (at_time,)).fetchall()
+    return dict(rows)
+
+
+def timed(fn, *args, repeat=5):
+    best = None
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--movements", type=int, default=2_000_000)
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        t0 = time.perf_counter()
+        first, last = build_ledger(db_path, args.products, args.movements, args.seed)
+        build_seconds = time.perf_counter() - t0
+
+        rng = random.Random(args.seed)
+        span = (last - first).total_seconds()
+        points = [(first + timedelta(seconds=rng.uniform(0, span))).strftime("%Y-%m-%d %H:%M:%S")
+                  for _ in range(args.queries)]
+
+        snapshot_times, replay_times, product_times = [], [], []
+        for at_time in points:
+            t_snap, snap = timed(main.get_stock_at, at_time)
+            t_replay, replay = timed(full_replay, at_time, repeat=1)
+            if {k: v for k, v in snap.items() if v} != {k: v for k, v in replay.items() if v}:
+                raise SystemExit(f"نتيجة غير متطابقة عند {at_time}")
+            t_product, _ = timed(main.get_stock_at, at_time, rng.randint(1, args.products))
+            snapshot_times.append(t_snap)
+            replay_times.append(t_replay)
+            product_times.append(t_product)
+
+        t_report, _ = timed(main.get_stock_movements_report, points[0][:10], points[0][:10], repeat=3)
+
+    result = {
+        "benchmark": "stock_ledger",
+        "movements": args.movements,
+        "products": args.products,
+        "snapshot_interval": main.STOCK_SNAPSHOT_INTERVAL,
+        "build_seconds": round(build_seconds, 3),
+        "stock_at_all_products_ms": round(1000 * sum(snapshot_times) / len(snapshot_times), 3),
+        "stock_at_one_product_ms": round(1000 * sum(product_times) / len(product_times), 3),
+        "full_replay_ms": round(1000 * sum(replay_times) / len(replay_times), 3),
+        "daily_movement_report_ms": round(1000 * t_report, 3),
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,85 @@
+"""قياس زمن تبديل السمة (toggle_theme) على شاشة فيها آلاف الصفوف.
+
+الاستخدام (يتطلب شاشة عرض):
+    python benchmarks/bench_theme.py --rows 5000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tkinter as tk
+from tkinter import ttk
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+def build_screen(parent, rows, widget_rows):
+    """شاشة مشابهة لواجهة المدير: جدول منتجات كبير وشريط جانبي وعدد من صفوف النماذج."""
+    main.create_sidebar(parent, [(f"زر {i}", lambda: None) for i in range(12)])
+    tree = ttk.Treeview(parent, columns=("name", "price", "qty"), show="headings")
+    main.register_theme_role(tree, 'tree')
+    for i in range(rows):
+        tree.insert("", "end", values=(f"منتج {i}", 1.5, i % 7), tags=('low_stock',) if i % 7 < 2 else ())
+    tree.pack(fill=tk.BOTH, expand=True)
+    form = tk.Frame(parent)
+    form.pack(fill=tk.X)
+    for i in range(widget_rows):
+        row = tk.Frame(form)
+        row.pack(fill=tk.X)
+        tk.Label(row, text=f"حقل {i}").pack(side=tk.RIGHT)
+        tk.Entry(row).pack(side=tk.RIGHT)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=5000, help="عدد صفوف جدول المنتجات")
+    parser.add_argument("--widget-rows", type=int, default=500, help="عدد صفوف النماذج (إطار + تسمية + حقل)")
+    parser.add_argument("--toggles", type=int, default=9)
+    args = parser.parse_args()
+
+    try:
+        main.root = tk.Tk()
+    except tk.TclError as e:
+        print(json.dumps({"benchmark": "toggle_theme", "skipped": f"لا توجد شاشة عرض: {e}"}, ensure_ascii=False))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        main.DB_NAME = os.path.join(tmp, "bench.db")
+        main.init_db()
+        main.set_theme('light')
+
+        frame = tk.Frame(main.root)
+        frame.pack(fill=tk.BOTH, expand=True)
+        t0 = time.perf_counter()
+        build_screen(frame, args.rows, args.widget_rows)
+        main.apply_theme_to_widgets([frame] + main.collect_widgets(frame))
+        register_seconds = time.perf_counter() - t0
+        main.root.update()
+
+        timings = []
+        for _ in range(args.toggles):
+            t0 = time.perf_counter()
+            main.toggle_theme()
+            touched = main.apply_theme_globally()  # يجب أن يكون 0: لا شيء تغير منذ التبديل
+            main.root.update_idletasks()
+            timings.append({"theme": main.current_theme_name, "ms": round(1000 * (time.perf_counter() - t0), 3),
+                            "reapply_touched": touched})
+
+        widget_count = len(main.collect_widgets(main.root))
+        main.root.destroy()
+
+    print(json.dumps({
+        "benchmark": "toggle_theme",
+        "tree_rows": args.rows,
+        "widgets": widget_count,
+        "register_ms": round(1000 * register_seconds, 3),
+        "toggles": timings,
+        "toggle_mean_ms": round(sum(t["ms"] for t in timings) / len(timings), 3),
+    }, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
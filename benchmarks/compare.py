@@ -0,0 +1,32 @@
+"""يقارن ملفي نتائج من benchmarks.run ويطبع نسبة التغير في الوسيط لكل مقياس.
+
+    python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import json
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args()
+
+    with open(args.before, encoding='utf-8') as f:
+        before = json.load(f)
+    with open(args.after, encoding='utf-8') as f:
+        after = json.load(f)
+
+    print(f"{'benchmark':32s} {'before':>12s} {'after':>12s} {'change':>9s}")
+    for name in sorted(set(before['results']) | set(after['results'])):
+        old = before['results'].get(name, {}).get('median_ms')
+        new = after['results'].get(name, {}).get('median_ms')
+        if old is None or new is None:
+            print(f"{name:32s} {old if old is not None else '-':>12} {new if new is not None else '-':>12} {'':>9s}")
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        print(f"{name:32s} {old:12.3f} {new:12.3f} {change:+8.1f}%")
+
+
+if __name__ == "__main__":
+    main_cli()
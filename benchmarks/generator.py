@@ -0,0 +1,117 @@
+"""مولّد متجر صناعي بحجم قابل للضبط، بنفس بنية الفواتير التي ينتجها checkout.
+
+الإدخال بالجملة عبر executemany مع بذرة ثابتة حتى تكون المتاجر متطابقة بين التشغيلات.
+"""
+import os
+import random
+import sys
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+SIZES = {
+    'small': {'products': 500, 'employees': 5, 'days': 90, 'invoices_per_day': 50},
+    'medium': {'products': 2000, 'employees': 10, 'days': 365, 'invoices_per_day': 150},
+    'large': {'products': 10000, 'employees': 25, 'days': 3 * 365, 'invoices_per_day': 400},
+}
+
+SUPPLIERS = ["المورد الأول", "شركة النور", "مؤسسة الأمل", "الموزع المتحد", "مخازن الشرق", None]
+
+
+def generate_store(db_path, products=2000, employees=10, days=365, invoices_per_day=150, seed=42, end_date=None):
+    """تنشئ قاعدة بيانات متجر كاملة في db_path وتعيد ملخصًا بأحجام الجداول."""
+    rng = random.Random(seed)
+    end_date = end_date or date.today()
+    main.DB_NAME = db_path
+    main.init_db()
+
+    catalog = []
+    for pid in range(1, products + 1):
+        cost = round(rng.uniform(0.5, 200), 2)
+        sell = round(cost * rng.uniform(1.05, 1.6), 2)
+        # شهرة المنتج: توزيع ذيلي حتى تظهر منتجات أكثر مبيعًا بوضوح
+        catalog.append({'id': pid, 'name': f"{rng.randint(10**12, 10**13 - 1)}", 'cost': cost, 'sell': sell,
+                        'supplier': rng.choice(SUPPLIERS), 'weight': rng.paretovariate(1.2)})
+    weights = [p['weight'] for p in catalog]
+    sold = dict.fromkeys(range(1, products + 1), 0)
+
+    with main.db_context() as conn:
+        conn.executemany("INSERT INTO employees (name, role, password) VALUES (?, ?, ?)",
+                         [(f"موظف {i}", rng.choice(["بائع", "مخزن"]), "000") for i in range(employees)])
+
+        sales_rows, movement_rows, daily_rows, invoice_rows = [], [], [], []
+        start = end_date - timedelta(days=days - 1)
+        for day_offset in range(days):
+            day = start + timedelta(days=day_offset)
+            day_total, day_qty = 0.0, 0
+            opening = datetime.combine(day, datetime.min.time()) + timedelta(hours=8)
+            for seq in range(1, invoices_per_day + 1):
+                invoice_id = f"INV-{day.strftime('%Y%m%d')}-{seq:03d}"
+                sale_time = (opening + timedelta(seconds=seq * 50400 // invoices_per_day)).strftime("%Y-%m-%d %H:%M:%S")
+                discount_factor = 1 - rng.choice([0, 0, 0, 0, 5, 10]) / 100
+                lines = {p['id']: p for p in rng.choices(catalog, weights=weights, k=rng.randint(1, 8))}
+                invoice_total = 0.0
+                for product in lines.values():
+                    qty = rng.choice([1, 1, 1, 2, 2, 3, 5])
+                    price = product['sell'] * discount_factor
+                    sales_rows.append((invoice_id, product['name'], price, qty, sale_time))
+                    movement_rows.append((product['id'], 'sale', -qty, invoice_id, sale_time))
+                    sold[product['id']] += qty
+                    invoice_total += price * qty
+                    day_qty += qty
+                invoice_rows.append((invoice_id, sale_time, invoice_total, len(lines)))
+                day_total += invoice_total
+            daily_rows.append((day.isoformat(), day_total, day_qty))
+
+        # المخزون الحالي = ما استُلم ناقص ما بيع، والاستلام مسجل كحركة في بداية الفترة
+        first_moment = (datetime.combine(start, datetime.min.time()) + timedelta(hours=7)).strftime("%Y-%m-%d %H:%M:%S")
+        product_rows, lot_rows, receipt_rows = [], [], []
+        for p in catalog:
+            on_hand = rng.choice([0, 2, 4, 10, 25, 60, 150])
+            received = sold[p['id']] + on_hand
+            expiry = (end_date + timedelta(days=rng.randint(-10, 400))).isoformat() if rng.random() < 0.6 else None
+            product_rows.append((p['id'], p['name'], p['cost'], p['sell'], on_hand, expiry, p['supplier']))
+            if on_hand:
+                lot_rows.append((p['id'], on_hand, expiry, p['supplier'], p['cost'], first_moment))
+            receipt_rows.append((p['id'], 'receipt', received, None, first_moment))
+
+        conn.executemany("INSERT INTO products (id, name, cost_price, sell_price, quantity, expiry_date, supplier) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         product_rows)
+        conn.executemany("INSERT INTO product_barcodes (code, product_id, pack_qty) VALUES (?, ?, 1)",
+                         [(p['name'], p['id']) for p in catalog])
+        conn.executemany("INSERT INTO product_lots (product_id, quantity, expiry_date, supplier, cost_price, received_at) VALUES (?, ?, ?, ?, ?, ?)",
+                         lot_rows)
+        movement_sql = "INSERT INTO stock_movements (product_id, movement_type, quantity_change, reference, moved_at) VALUES (?, ?, ?, ?, ?)"
+        conn.executemany(movement_sql, receipt_rows)
+        conn.executemany(movement_sql, movement_rows)
+        conn.executemany("INSERT INTO sales (invoice_id, product_name, sell_price, quantity, sale_time) VALUES (?, ?, ?, ?, ?)",
+                         sales_rows)
+        conn.executemany("INSERT INTO invoices (invoice_id, created_at, total, line_count) VALUES (?, ?, ?, ?)", invoice_rows)
+        conn.executemany("INSERT INTO daily_sales (sale_date, total, quantity) VALUES (?, ?, ?)", daily_rows)
+        main.take_stock_snapshot(conn.cursor())
+
+    return {
+        'products': products,
+        'employees': employees,
+        'days': days,
+        'invoices': days * invoices_per_day,
+        'sale_lines': len(sales_rows),
+        'stock_movements': len(movement_rows) + len(receipt_rows),
+        'db_bytes': os.path.getsize(db_path),
+        'product_names': [p['name'] for p in catalog],
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="ينشئ متجرًا صناعيًا في ملف قاعدة بيانات")
+    parser.add_argument("db_path")
+    parser.add_argument("--size", choices=SIZES, default='small')
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    summary = generate_store(args.db_path, seed=args.seed, **SIZES[args.size])
+    summary.pop('product_names')
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
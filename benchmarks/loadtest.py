@@ -0,0 +1,258 @@
+"""اختبار حمل لعدة نقاط بيع متزامنة عبر مسار البيع نفسه الذي تستخدمه الواجهة (main.checkout).
+
+    python -m benchmarks.loadtest --cashiers 8 --duration 20 --out load.json
+    python -m benchmarks.loadtest --mode process --cashiers 4 --rate 5 --db existing_store.db
+
+في وضع thread تتشارك نقاط البيع الخيط الكاتب نفسه (التزام جماعي)، وفي وضع process لكل عملية
+خيطها الكاتب فتتنافس على قفل الملف عبر busy_timeout كما لو كانت أجهزة منفصلة.
+مع --readers تعمل تقارير متكررة بالتوازي مع البيع؛ للمقارنة شغّل مع STORE_READ_SNAPSHOTS=0.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+from benchmarks.generator import SIZES, generate_store  # noqa: E402
+from benchmarks.run import git_revision  # noqa: E402
+
+
+def load_catalog():
+    """المنتجات المتوفرة كما يراها البائع: (الاسم، سعر البيع)."""
+    with main.db_context() as conn:
+        return conn.execute("SELECT name, sell_price FROM products WHERE quantity > 0").fetchall()
+
+
+def stock_levels():
+    with main.db_context() as conn:
+        return dict(conn.execute("SELECT name, quantity FROM products"))
+
+
+def run_cashier(cashier_id, catalog, seed, duration, rate, max_lines, discounts, stop_at):
+    """نقطة بيع واحدة: تبني سلالًا عشوائية وتبيعها حتى انتهاء المدة. rate = سلال في الثانية (0 = بلا توقف)."""
+    rng = random.Random(seed * 1000 + cashier_id)
+    samples, invoices, rejected, errors = [], [], 0, []
+    # كل نقطة بيع تبيع ضمن وردية بائعها كما في الواجهة
+    employee = f"كاشير-{cashier_id}"
+    main.add_employee_to_db(employee, "بائع", "loadtest")
+    shift_id = main.open_shift(employee)
+    next_start = time.perf_counter()
+    while time.perf_counter() < stop_at:
+        if rate:
+            # جدول ثابت للوصول: التأخير يتراكم في زمن الاستجابة ولا يُخفي الازدحام
+            next_start += rng.expovariate(rate)
+            delay = next_start - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            if time.perf_counter() >= stop_at:
+                break
+        lines = rng.sample(catalog, k=min(len(catalog), rng.randint(1, max_lines)))
+        cart = [{'name': name, 'price': price, 'quantity': rng.choice([1, 1, 1, 2, 3])} for name, price in lines]
+        t0 = time.perf_counter()
+        try:
+            success, result = main.checkout(cart, rng.choice(discounts), shift_id)
+        except sqlite3.Error as e:
+            errors.append(str(e))
+            continue
+        samples.append((time.perf_counter() - t0) * 1000)
+        if success:
+            invoices.append(result)
+        else:
+            rejected += 1
+    return {'latencies_ms': samples, 'invoices': invoices, 'rejected': rejected, 'errors': errors}
+
+
+def _process_cashier(db_path, cashier_id, catalog, seed, duration, rate, max_lines, discounts, start_at):
+    main.DB_NAME = db_path
+    # الساعة الأحادية لا تُشارك بين العمليات، فيُحسب الموعد من ساعة الجدار
+    stop_at = time.perf_counter() + max(0.0, start_at - time.time()) + duration
+    while time.time() < start_at:
+        time.sleep(0.001)
+    result = run_cashier(cashier_id, catalog, seed, duration, rate, max_lines, discounts, stop_at)
+    result['writer'] = main.get_writer_stats()
+    return result
+
+
+def run_reader(stop_at):
+    """يكرر تقارير المدير حتى انتهاء الاختبار ويعيد أزمنتها."""
+    latencies, errors = [], []
+    today = datetime.now().date().isoformat()
+    while time.perf_counter() < stop_at:
+        t0 = time.perf_counter()
+        try:
+            main.get_daily_sales_totals(today, today)
+            main.get_low_stock_products()
+            main.get_invoices_page(limit=50)
+        except Exception as e:
+            errors.append(str(e))
+        latencies.append((time.perf_counter() - t0) * 1000)
+    return {'latencies_ms': latencies, 'errors': errors}
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))], 3)
+
+
+def check_violations(stock_before, invoices):
+    """البيع بأكثر من المتوفر، وعدم تطابق الرصيد مع المبيعات، وتكرار أرقام الفواتير."""
+    stock_after = stock_levels()
+    duplicates = sorted(inv for inv, n in Counter(invoices).items() if n > 1)
+    with main.db_context() as conn:
+        sold = Counter()
+        for name, qty in conn.execute("SELECT product_name, quantity FROM sales WHERE invoice_id IN (SELECT value FROM json_each(?))",
+                                      (json.dumps(invoices),)):
+            sold[name] += qty
+        # فاتورة واحدة يجب أن تُسجّل بوقت واحد؛ تعدد الأوقات يعني أن نقطتي بيع أخذتا الرقم نفسه
+        shared = [inv for inv, in conn.execute(
+            "SELECT invoice_id FROM sales WHERE invoice_id IN (SELECT value FROM json_each(?)) "
+            "GROUP BY invoice_id HAVING COUNT(DISTINCT sale_time) > 1", (json.dumps(invoices),))]
+        negative_lots = conn.execute("SELECT COUNT(*) FROM product_lots WHERE quantity < 0").fetchone()[0]
+        # الإجماليات الجارية للورديات يجب أن تساوي مجموع أسطر مبيعاتها
+        shift_mismatches = [shift_id for shift_id, in conn.execute('''
+            SELECT s.id FROM shifts s
+            WHERE abs(s.net_total - (SELECT COALESCE(SUM(sell_price * quantity), 0) FROM sales WHERE shift_id = s.id)) > 0.01
+               OR s.item_count != (SELECT COALESCE(SUM(quantity), 0) FROM sales WHERE shift_id = s.id)
+        ''')]
+    negative = sorted(name for name, qty in stock_after.items() if qty < 0)
+    mismatched = sorted(name for name, qty in stock_before.items() if stock_after.get(name) != qty - sold[name])
+    return {
+        'oversold_products': negative,
+        'negative_lots': negative_lots,
+        'stock_mismatches': mismatched,
+        'shift_mismatches': shift_mismatches,
+        'duplicate_invoices': sorted(set(duplicates) | set(shared)),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cashiers", type=int, default=4)
+    parser.add_argument("--mode", choices=["thread", "process"], default="thread")
+    parser.add_argument("--duration", type=float, default=10.0, help="مدة الاختبار بالثواني")
+    parser.add_argument("--rate", type=float, default=0.0, help="سلال في الثانية لكل نقطة بيع (0 = بأقصى سرعة)")
+    parser.add_argument("--max-lines", type=int, default=6, help="أقصى عدد أسطر في السلة")
+    parser.add_argument("--discounts", type=float, nargs="*", default=[0, 0, 0, 5, 10])
+    parser.add_argument("--size", choices=SIZES, default='small')
+    parser.add_argument("--readers", type=int, default=0, help="خيوط تقارير متزامنة مع البيع")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--db", help="استخدام نسخة من قاعدة بيانات موجودة بدل توليد متجر")
+    parser.add_argument("--out", help="ملف JSON للنتائج (افتراضيًا المخرج القياسي)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = os.path.join(workdir, "store.db")
+        if args.db:
+            shutil.copy(args.db, db_path)
+        else:
+            generate_store(db_path, seed=args.seed, **SIZES[args.size])
+        main.DB_NAME = db_path
+        main.init_db()
+        catalog = load_catalog()
+        stock_before = stock_levels()
+        work = [(i, catalog, args.seed, args.duration, args.rate, args.max_lines, args.discounts)
+                for i in range(args.cashiers)]
+
+        started = time.perf_counter()
+        reader_results = [None] * args.readers
+
+        def reader(i, stop_at):
+            reader_results[i] = run_reader(stop_at)
+
+        # التقارير تعمل دائمًا في العملية الرئيسية بجانب نقاط البيع
+        reader_delay = 0.0 if args.mode == "thread" else 1.0
+        readers = [threading.Thread(target=reader, args=(i, started + reader_delay + args.duration))
+                   for i in range(args.readers)]
+        for t in readers:
+            t.start()
+        if args.mode == "thread":
+            stop_at = started + args.duration
+            results = [None] * args.cashiers
+
+            def worker(i):
+                results[i] = run_cashier(*work[i], stop_at)
+
+            threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.cashiers)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            writers = [main.get_writer_stats()]
+        else:
+            start_at = time.time() + 1.0  # مهلة حتى تجهز كل العمليات
+            with multiprocessing.get_context("spawn").Pool(args.cashiers) as pool:
+                results = pool.starmap(_process_cashier, [(db_path,) + w + (start_at,) for w in work])
+            started += 1.0
+            writers = [r.pop('writer') for r in results]
+        for t in readers:
+            t.join()
+        elapsed = time.perf_counter() - started
+
+        latencies = sorted(ms for r in results for ms in r['latencies_ms'])
+        invoices = [inv for r in results for inv in r['invoices']]
+        violations = check_violations(stock_before, invoices)
+
+    report_latencies = sorted(ms for r in reader_results for ms in r['latencies_ms'])
+    jobs = sum(w['jobs'] for w in writers)
+    batches = sum(w['batches'] for w in writers)
+    output = {
+        'suite': 'loadtest',
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'config': {k: v for k, v in vars(args).items() if k != 'out'},
+        'results': {
+            'checkouts': len(latencies),
+            'completed': len(invoices),
+            'rejected': sum(r['rejected'] for r in results),
+            'errors': sum(len(r['errors']) for r in results),
+            'error_samples': sorted({e for r in results for e in r['errors']})[:5],
+            'throughput_per_s': round(len(invoices) / elapsed, 2) if elapsed else None,
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'max_ms': round(latencies[-1], 3) if latencies else None,
+            # انتظار الطابور داخل العملية، وانتظار قفل الملف بين العمليات
+            'queue_wait_ms_per_job': round(sum(w['queue_wait_seconds'] for w in writers) * 1000 / jobs, 3) if jobs else None,
+            'lock_wait_ms_total': round(sum(w['lock_wait_seconds'] for w in writers) * 1000, 3),
+            'lock_wait_ms_per_batch': round(sum(w['lock_wait_seconds'] for w in writers) * 1000 / batches, 3) if batches else None,
+            'avg_commit_batch': round(jobs / batches, 2) if batches else None,
+            'max_commit_batch': max(w['max_batch'] for w in writers),
+            'max_lock_wait_ms': round(max(w['max_lock_wait_seconds'] for w in writers) * 1000, 3),
+        },
+        'reports': {
+            'read_snapshots': main.READ_SNAPSHOTS,
+            'runs': len(report_latencies),
+            'errors': sum(len(r['errors']) for r in reader_results),
+            'p50_ms': percentile(report_latencies, 0.50),
+            'p95_ms': percentile(report_latencies, 0.95),
+            'max_ms': round(report_latencies[-1], 3) if report_latencies else None,
+            'readers': main.get_reader_stats(),
+        } if args.readers else None,
+        'violations': violations,
+        'ok': not any(violations.values()),
+    }
+    text = json.dumps(output, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0 if output['ok'] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
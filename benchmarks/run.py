@@ -0,0 +1,150 @@
+"""يشغّل مقاييس المسارات الساخنة على متجر صناعي ويكتب النتائج بصيغة JSON.
+
+    python -m benchmarks.run --size medium --out results.json
+    python -m benchmarks.run --db existing_store.db --only checkout get_all_invoices
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+from benchmarks.generator import SIZES, generate_store  # noqa: E402
+
+
+def measure(fn, repeat, setup=None):
+    """تعيد أزمنة التنفيذ بالميلي ثانية لعدد repeat من الاستدعاءات."""
+    samples = []
+    for i in range(repeat):
+        args = setup(i) if setup else ()
+        t0 = time.perf_counter()
+        fn(*args)
+        samples.append((time.perf_counter() - t0) * 1000)
+    return samples
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        'runs': len(samples),
+        'min_ms': round(ordered[0], 3),
+        'median_ms': round(statistics.median(ordered), 3),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+        'max_ms': round(ordered[-1], 3),
+    }
+
+
+def busiest_day():
+    with main.db_context() as conn:
+        row = conn.execute("SELECT sale_date FROM daily_sales ORDER BY total DESC LIMIT 1").fetchone()
+    return row[0] if row else date.today().isoformat()
+
+
+def build_benchmarks(product_names, rng, workdir, repeat):
+    """قائمة (الاسم، الدالة، دالة التهيئة، عدد التكرار) لكل مسار ساخن."""
+    day = busiest_day()
+    stocked = []
+    with main.db_context() as conn:
+        stocked = [name for name, in conn.execute("SELECT name FROM products WHERE quantity >= 20")]
+        deep_cursor = conn.execute("SELECT created_at, invoice_id FROM invoices ORDER BY created_at, invoice_id "
+                                   "LIMIT 1 OFFSET (SELECT COUNT(*) / 2 FROM invoices)").fetchone()
+    random_name = lambda _: (rng.choice(product_names),)
+
+    def random_basket(_):
+        lines = rng.sample(stocked, k=min(len(stocked), rng.randint(1, 6)))
+        return ([{'name': name, 'price': 1.0, 'quantity': 1} for name in lines],)
+
+    report_path = os.path.join(workdir, "report.xlsx")
+    backup_path = os.path.join(workdir, "backup.db")
+    return [
+        ('get_products_filtered', main.get_products_filtered, None, repeat),
+        ('get_products_filtered[name]', main.get_products_filtered, lambda _: (rng.choice(product_names)[:4],), repeat),
+        ('get_products_filtered[expiry]', main.get_products_filtered, lambda _: ("", date.today().isoformat()), repeat),
+        ('get_product_by_barcode', main.get_product_by_barcode, random_name, repeat * 20),
+        ('sell_product', main.sell_product, lambda _: (rng.choice(stocked), 1.0, 1), repeat * 4),
+        ('checkout', main.checkout, random_basket, repeat * 4),
+        ('get_all_invoices', main.get_all_invoices, None, max(3, repeat // 4)),
+        ('get_invoices_page', main.get_invoices_page, None, repeat),
+        ('get_invoices_page[deep]', main.get_invoices_page, lambda _: (deep_cursor,), repeat),
+        ('get_invoices_page[prefix]', lambda: main.get_invoices_page(id_prefix=f"INV-{day.replace('-', '')}"), None, repeat),
+        ('get_daily_sales', main.get_daily_sales, lambda _: (day,), repeat),
+        ('get_best_selling_products', main.get_best_selling_products, None, max(3, repeat // 4)),
+        ('get_sales_summary_last_7_days', main.get_sales_summary_last_7_days, None, repeat),
+        ('get_inventory_analytics', main.get_inventory_analytics, None, max(3, repeat // 4)),
+        ('export_daily_report', main.write_daily_report, lambda _: (day, report_path), max(3, repeat // 4)),
+        ('backup', main.backup_database_to, lambda _: (backup_path,), max(3, repeat // 4)),
+    ]
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(main.__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", choices=SIZES, default='small')
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--db", help="استخدام نسخة من قاعدة بيانات موجودة بدل توليد متجر")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--only", nargs="*", help="أسماء المقاييس المطلوب تشغيلها فقط")
+    parser.add_argument("--out", help="ملف JSON للنتائج (افتراضيًا المخرج القياسي)")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = os.path.join(workdir, "store.db")
+        t0 = time.perf_counter()
+        if args.db:
+            shutil.copy(args.db, db_path)
+            main.DB_NAME = db_path
+            main.init_db()
+            with main.db_context() as conn:
+                product_names = [name for name, in conn.execute("SELECT name FROM products")]
+            store = {'source': os.path.abspath(args.db), 'db_bytes': os.path.getsize(db_path)}
+        else:
+            store = generate_store(db_path, seed=args.seed, **SIZES[args.size])
+            product_names = store.pop('product_names')
+        store['generate_seconds'] = round(time.perf_counter() - t0, 3)
+
+        results = {}
+        for name, fn, setup, repeat in build_benchmarks(product_names, rng, workdir, args.repeat):
+            if args.only and name not in args.only:
+                continue
+            results[name] = summarize(measure(fn, repeat, setup))
+            print(f"{name:32s} median {results[name]['median_ms']:10.3f} ms", file=sys.stderr)
+
+    output = {
+        'suite': 'hot_paths',
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'size': None if args.db else args.size,
+        'seed': args.seed,
+        'store': store,
+        'results': results,
+    }
+    text = json.dumps(output, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main_cli()
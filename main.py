@@ -1,9 +1,12 @@
 import tkinter as tk
-from tkinter import ttk, messagebox, filedialog
+from tkinter import ttk, messagebox, filedialog, simpledialog
 from datetime import datetime, date, timedelta
 import sqlite3
 from openpyxl import Workbook
-import shutil
+import os
+import io
+import json
+import math
 from PIL import Image
 
 try:
@@ -16,12 +19,18 @@ except (ImportError, OSError) as e:
 try:
     from matplotlib.figure import Figure
     from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-    import matplotlib.pyplot as plt
     matplotlib_available = True
 except ImportError:
     matplotlib_available = False
     print("Warning: Matplotlib is not installed. Charts will be disabled. Install it with: pip install matplotlib")
 
+try:
+    import numpy as np
+    numpy_available = True
+except ImportError:
+    numpy_available = False
+    print("Warning: NumPy is not installed. Inventory analytics will be disabled and reorder suggestions will use simple averages. Install it with: pip install numpy")
+
 try:
     import barcode
     from barcode.writer import ImageWriter
@@ -33,10 +42,67 @@ except ImportError:
 
 # === الإعدادات الأساسية ===
 DB_NAME = "store.db"
+# زِد هذا الرقم عند تغيير شكل نتائج أي تقرير مخزن في ذاكرة التقارير
+REPORT_CACHE_SCHEMA_VERSION = 1
+REPORT_CACHE_MAX_ENTRIES = 2000
+# خدمة الكتابة: أقصى عدد عمليات في التزام واحد، وأقصى انتظار لتجميعها (ثوانٍ)
+WRITE_BATCH_MAX_JOBS = 64
+WRITE_BATCH_MAX_WAIT = 0.002
+# الأرشفة تنقل السنة على دفعات بهذا الحجم، كل دفعة عملية مستقلة في طابور الكتابة
+ARCHIVE_BATCH_LINES = 5000
+ARCHIVE_MOVE_FLAG = 'archive.moving'
+DB_BUSY_TIMEOUT_MS = 5000
+# التشخيص: يُفعَّل من نافذة التشخيص أو بمتغير البيئة STORE_DIAGNOSTICS=1
+SLOW_QUERY_MS = 20
+METRICS_EXPORT_INTERVAL = 30
+LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, float('inf'))
+# الصيانة الدورية: الفاصل الأدنى بين تشغيلين لكل مهمة (ثوانٍ)، وتُنفذ فقط بعد فترة هدوء بلا كتابة
+MAINTENANCE_TASKS = {
+    'wal_checkpoint': 10 * 60,
+    'optimize': 60 * 60,
+    'incremental_vacuum': 60 * 60,
+    'analyze': 24 * 60 * 60,
+    'quick_check': 24 * 60 * 60,
+    'prune_change_log': 24 * 60 * 60,
+}
+MAINTENANCE_CHECK_INTERVAL = 60
+MAINTENANCE_IDLE_SECONDS = 30
+MAINTENANCE_TIME_BOX_MS = 500
+# فحص السلامة يقرأ القاعدة كلها فلا يكفيه نصف ثانية؛ ولا يوقفه البيع لأنه قراءة فقط في WAL
+MAINTENANCE_TASK_TIME_BOX_MS = {'quick_check': 60 * 1000}
+MAINTENANCE_READ_ONLY_TASKS = {'quick_check'}
+# بعد محاولة غير ناجحة: إعادة المحاولة بعد هذه المدة مضاعفة لكل فشل متتالٍ (حتى فاصل المهمة نفسه)
+MAINTENANCE_RETRY_SECONDS = 5 * 60
+MAINTENANCE_LOG_RETENTION_DAYS = 30
+MAINTENANCE_VACUUM_STEP_PAGES = 256
+# تتبع التغييرات للمزامنة: حجم دفعة التصدير، ومدة الاحتفاظ بالتغييرات بعد أن يستهلكها كل المستهلكين (أيام)
+CHANGE_EXPORT_BATCH = 1000
+CHANGE_LOG_RETENTION_DAYS = 7
+# الفروع: حتى هذا العدد تُقرأ الملفات بـ ATTACH في اتصال واحد (حد SQLite الافتراضي 10)، وما زاد في مجمع عمليات
+FEDERATION_ATTACH_MAX = 6
+FEDERATION_WORKERS = max(2, min(8, os.cpu_count() or 2))
+FEDERATION_CACHE_MAX = 500
+root = None
 current_user = None
 current_role = None
 current_user_permissions = {}
-LOW_STOCK_THRESHOLD = 5
+current_shift_id = None
+LOW_STOCK_THRESHOLD = 5  # حد إعادة الطلب الافتراضي للمنتجات الجديدة
+# اقتراحات إعادة الطلب: نافذة سجل المبيعات ومتوسطها القصير (أيام)، ومدة التوريد الافتراضية،
+# وأيام التغطية المطلوبة بعد وصول الطلبية، ومعامل مخزون الأمان (1.65 ≈ مستوى خدمة 95%)
+VELOCITY_WINDOW_DAYS = 56
+VELOCITY_SHORT_DAYS = 7
+DEFAULT_LEAD_TIME_DAYS = 7
+REORDER_COVER_DAYS = 14
+SAFETY_STOCK_Z = 1.65
+# تحليلات المخزون: فترة التحليل (أيام)، وحدود فئتي A و B من الإيراد التراكمي،
+# وأيام الركود التي يُعد بعدها المنتج مخزونًا راكدًا، وهامش الربح المستهدف
+ANALYTICS_WINDOW_DAYS = 365
+ABC_CLASS_LIMITS = (0.80, 0.95)
+DEAD_STOCK_DAYS = 90
+TARGET_MARGIN = 0.20
+MARGIN_BINS = (-math.inf, 0, 0.10, 0.20, 0.30, 0.50, math.inf)
+STOCK_SNAPSHOT_INTERVAL = 10000  # عدد حركات المخزون بين كل لقطة مخزون والتي تليها
 THEMES = {
     "light": {
         "bg": "#f0f0f0", "fg": "black",
@@ -79,8 +145,14 @@ def set_theme(theme_name):
 
 # === 1. إنشاء قاعدة البيانات ===
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
+    conn = connect_db()
     cursor = conn.cursor()
+    # التفريغ التدريجي يتيح للصيانة إعادة الصفحات الحرة على دفعات صغيرة. يسري دون VACUUM على القاعدة الجديدة فقط؛
+    # القواعد القديمة تُحوَّل من نافذة سجل الصيانة (convert_to_incremental_vacuum) لا عند التشغيل
+    if not cursor.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone():
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    # WAL يسمح للقراءة بالاستمرار أثناء الكتابة؛ الإعداد دائم في ملف القاعدة
+    cursor.execute("PRAGMA journal_mode = WAL")
 
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS employees (
@@ -125,12 +197,311 @@ def init_db():
     )
     ''')
 
+    # إعدادات عامة للمتجر (ليست لكل مستخدم): مفتاح وقيمة JSON
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS app_settings (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    ) WITHOUT ROWID
+    ''')
+
+    # سجل الفروع: قاعدة بيانات كل متجر للتقارير الموحدة
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS branches (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE,
+        db_path TEXT NOT NULL,
+        active INTEGER NOT NULL DEFAULT 1,
+        added_at TEXT NOT NULL
+    )
+    ''')
+
+    # تتبع التغييرات للمزامنة الخارجية: المشغلات تسجل كل إضافة وتعديل وحذف برقم تسلسل متزايد.
+    # AUTOINCREMENT لا يعيد استخدام الأرقام بعد التقليم، والكاتب الواحد يجعل ترتيب الأرقام ترتيب الالتزام.
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS change_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        table_name TEXT NOT NULL,
+        row_id INTEGER NOT NULL,
+        op TEXT NOT NULL,
+        changed_at TEXT NOT NULL
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sync_cursors (
+        consumer TEXT PRIMARY KEY,
+        last_seq INTEGER NOT NULL,
+        updated_at TEXT NOT NULL
+    ) WITHOUT ROWID
+    ''')
+    for table in CHANGE_TRACKED_TABLES:
+        for op, event, row in (('insert', 'INSERT', 'NEW'), ('update', 'UPDATE', 'NEW'), ('delete', 'DELETE', 'OLD')):
+            cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_{op}_change_log AFTER {event} ON {table}
+            BEGIN
+                INSERT INTO change_log (table_name, row_id, op, changed_at)
+                VALUES ('{table}', {row}.id, '{op}', datetime('now', 'localtime'));
+            END
+            ''')
+
+    # سجل حركات المخزون (إلحاقي فقط) ولقطات المخزون الدورية
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS stock_movements (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id INTEGER NOT NULL,
+        movement_type TEXT NOT NULL,
+        quantity_change INTEGER NOT NULL,
+        reference TEXT,
+        moved_at TEXT NOT NULL
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_invoice ON sales(invoice_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_movements_product_time ON stock_movements(product_id, moved_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_movements_time ON stock_movements(moved_at)")
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS stock_snapshots (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        taken_at TEXT NOT NULL,
+        last_movement_id INTEGER NOT NULL
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_snapshots_movement ON stock_snapshots(last_movement_id)")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS stock_snapshot_items (
+        snapshot_id INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        PRIMARY KEY (snapshot_id, product_id)
+    ) WITHOUT ROWID
+    ''')
+
+    # إجماليات المبيعات اليومية المجمعة مسبقًا (تُحدَّث مع كل بيع) للرسوم البيانية
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'daily_sales'")
+    daily_sales_exists = cursor.fetchone() is not None
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS daily_sales (
+        sale_date TEXT PRIMARY KEY,
+        total REAL NOT NULL DEFAULT 0,
+        quantity INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    ''')
+    if not daily_sales_exists:
+        cursor.execute('''
+        INSERT INTO daily_sales (sale_date, total, quantity)
+        SELECT date(sale_time), SUM(sell_price * quantity), SUM(quantity) FROM sales GROUP BY date(sale_time)
+        ''')
+
+    # رؤوس الفواتير: صف واحد لكل فاتورة حتى لا يحتاج التصفح إلى تجميع جدول المبيعات كاملًا
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'invoices'")
+    invoices_exists = cursor.fetchone() is not None
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS invoices (
+        invoice_id TEXT PRIMARY KEY,
+        created_at TEXT NOT NULL,
+        total REAL NOT NULL,
+        line_count INTEGER NOT NULL
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_invoices_created ON invoices(created_at, invoice_id)")
+    if not invoices_exists:
+        cursor.execute('''
+        INSERT INTO invoices (invoice_id, created_at, total, line_count)
+        SELECT invoice_id, MIN(sale_time), SUM(sell_price * quantity), COUNT(*) FROM sales GROUP BY invoice_id
+        ''')
+
+    # ورديات البائعين: إجماليات جارية تُحدَّث داخل معاملة البيع، فتقرير الإغلاق (Z) قراءة صف الوردية فقط
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS shifts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        employee_id INTEGER NOT NULL,
+        employee_name TEXT NOT NULL,
+        opened_at TEXT NOT NULL,
+        closed_at TEXT,
+        opening_cash REAL NOT NULL DEFAULT 0,
+        counted_cash REAL,
+        invoice_count INTEGER NOT NULL DEFAULT 0,
+        line_count INTEGER NOT NULL DEFAULT 0,
+        item_count INTEGER NOT NULL DEFAULT 0,
+        gross REAL NOT NULL DEFAULT 0,
+        promotion_discounts REAL NOT NULL DEFAULT 0,
+        manual_discounts REAL NOT NULL DEFAULT 0,
+        net_total REAL NOT NULL DEFAULT 0
+    )
+    ''')
+    # وردية مفتوحة واحدة على الأكثر لكل موظف
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_shifts_open ON shifts(employee_id) WHERE closed_at IS NULL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_shifts_employee ON shifts(employee_id, opened_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_shifts_opened ON shifts(opened_at)")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS shift_category_totals (
+        shift_id INTEGER NOT NULL,
+        category TEXT NOT NULL,
+        quantity INTEGER NOT NULL DEFAULT 0,
+        total REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (shift_id, category)
+    ) WITHOUT ROWID
+    ''')
+
+    # سجل تغييرات أسعار الشراء والبيع (تعديل فردي أو جماعي)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS price_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id INTEGER NOT NULL,
+        old_cost REAL,
+        new_cost REAL,
+        old_sell REAL,
+        new_sell REAL,
+        changed_at TEXT NOT NULL,
+        reason TEXT
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_price_history_product ON price_history(product_id, changed_at)")
+
+    # العروض: نوع القاعدة ونطاقها (منتج أو مورد) ومعاملاتها وفترتها وحدودها
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS promotions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        rule_type TEXT NOT NULL,
+        product_id INTEGER,
+        supplier TEXT,
+        buy_qty INTEGER,
+        get_qty INTEGER,
+        amount REAL,
+        starts_at TEXT,
+        ends_at TEXT,
+        daily_start TEXT,
+        daily_end TEXT,
+        max_applications INTEGER,
+        max_discount REAL,
+        active INTEGER NOT NULL DEFAULT 1
+    )
+    ''')
+
+    # رموز الباركود: عدة رموز للمنتج الواحد (قطعة، عبوة...) ولكل رمز عدد القطع التي يمثلها
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'product_barcodes'")
+    barcodes_exist = cursor.fetchone() is not None
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS product_barcodes (
+        code TEXT PRIMARY KEY,
+        product_id INTEGER NOT NULL,
+        pack_qty INTEGER NOT NULL DEFAULT 1 CHECK (pack_qty > 0)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_product_barcodes_product ON product_barcodes(product_id)")
+    if not barcodes_exist:
+        # كان الاسم هو الباركود: تُرحَّل الأسماء القابلة للطباعة كباركود (ASCII بلا مسافات)
+        cursor.execute('''
+        INSERT OR IGNORE INTO product_barcodes (code, product_id, pack_qty)
+        SELECT name, id, 1 FROM products WHERE name <> '' AND name NOT GLOB '*[^!-~]*'
+        ''')
+
+    # سجل ملفات أرشيف المبيعات السنوية، وكميات المنتجات المؤرشفة حتى تبقى "الأكثر مبيعًا" في القاعدة الحية
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sales_archives (
+        year INTEGER PRIMARY KEY,
+        file_name TEXT NOT NULL,
+        line_count INTEGER NOT NULL,
+        invoice_count INTEGER NOT NULL,
+        archived_at TEXT NOT NULL
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS archived_product_sales (
+        product_name TEXT PRIMARY KEY,
+        quantity INTEGER NOT NULL
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_time ON sales(sale_time)")
+
+    # ذاكرة نتائج التقارير للفترات المغلقة (period بصيغة YYYY-MM-DD: اليوم أو آخر يوم تشمله النتيجة)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS report_cache (
+        report TEXT NOT NULL,
+        period TEXT NOT NULL,
+        params TEXT NOT NULL,
+        schema_version INTEGER NOT NULL,
+        payload TEXT NOT NULL,
+        last_used_at TEXT NOT NULL,
+        PRIMARY KEY (report, period, params, schema_version)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_report_cache_period ON report_cache(period)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_report_cache_used ON report_cache(last_used_at)")
+    cursor.execute("DELETE FROM report_cache WHERE schema_version != ?", (REPORT_CACHE_SCHEMA_VERSION,))
+    # أي تعديل بتاريخ سابق على المبيعات يلغي نتائج الفترات التي تشمل ذلك اليوم وما بعده
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_sales_insert_report_cache AFTER INSERT ON sales
+    WHEN NEW.sale_time < date('now', 'localtime')
+    BEGIN
+        DELETE FROM report_cache WHERE period >= substr(NEW.sale_time, 1, 10);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_sales_update_report_cache AFTER UPDATE ON sales
+    WHEN min(OLD.sale_time, NEW.sale_time) < date('now', 'localtime')
+    BEGIN
+        DELETE FROM report_cache WHERE period >= substr(min(OLD.sale_time, NEW.sale_time), 1, 10);
+    END
+    ''')
+    # نقل الأسطر إلى ملف الأرشيف ليس حذفًا: النتائج المخزنة تبقى صحيحة لأن الأرشيف يُضم إلى التقارير،
+    # فيضع _archive_sales_batch المفتاح ARCHIVE_MOVE_FLAG طوال الحذف ويزيله في المعاملة نفسها
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_sales_delete_report_cache'")
+    row = cursor.fetchone()
+    if row and ARCHIVE_MOVE_FLAG not in row[0]:
+        cursor.execute("DROP TRIGGER trg_sales_delete_report_cache")
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS trg_sales_delete_report_cache AFTER DELETE ON sales
+    WHEN OLD.sale_time < date('now', 'localtime')
+        AND NOT EXISTS (SELECT 1 FROM app_settings WHERE key = '{ARCHIVE_MOVE_FLAG}')
+    BEGIN
+        DELETE FROM report_cache WHERE period >= substr(OLD.sale_time, 1, 10);
+    END
+    ''')
+
+    # سجل تشغيل مهام الصيانة
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS maintenance_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        task TEXT NOT NULL,
+        started_at TEXT NOT NULL,
+        duration_ms REAL NOT NULL,
+        status TEXT NOT NULL,
+        pages_before INTEGER,
+        pages_after INTEGER,
+        freelist_before INTEGER,
+        freelist_after INTEGER,
+        reclaimed_bytes INTEGER,
+        detail TEXT
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_maintenance_log_task ON maintenance_log(task, started_at)")
+
+    # دفعات المنتجات (لكل دفعة كميتها وتاريخ انتهائها ومورّدها وتكلفتها)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS product_lots (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        expiry_date TEXT,
+        supplier TEXT,
+        cost_price REAL,
+        received_at TEXT NOT NULL
+    )
+    ''')
+    # فهارس جزئية على الدفعات غير الفارغة فقط: ترتيب FEFO لكل منتج وتنبيهات الانتهاء
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_product_lots_fefo ON product_lots(product_id, expiry_date) WHERE quantity > 0")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_product_lots_expiry ON product_lots(expiry_date) WHERE quantity > 0")
+
     # إضافة أعمدة إذا كانت مفقودة
-    for col_def in ["invoice_id TEXT", "quantity INTEGER DEFAULT 1"]:
+    for col_def in ["invoice_id TEXT", "quantity INTEGER DEFAULT 1", "promotion_id INTEGER", "promotion_discount REAL NOT NULL DEFAULT 0",
+                    "shift_id INTEGER"]:
         try:
             cursor.execute(f"ALTER TABLE sales ADD COLUMN {col_def}")
         except sqlite3.OperationalError:
             pass
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_shift ON sales(shift_id)")
     # التأكد من وجود عمود السمة
     try:
         cursor.execute("ALTER TABLE settings ADD COLUMN theme TEXT DEFAULT 'light'")
@@ -143,6 +514,25 @@ def init_db():
     except sqlite3.OperationalError:
         pass
 
+    # تصنيف المنتج (لإجماليات الورديات حسب التصنيف)
+    try:
+        cursor.execute("ALTER TABLE products ADD COLUMN category TEXT")
+    except sqlite3.OperationalError:
+        pass
+
+    # حد إعادة الطلب لكل منتج، وفهرس جزئي لا يضم إلا المنتجات التي بلغته
+    try:
+        cursor.execute(f"ALTER TABLE products ADD COLUMN reorder_threshold INTEGER NOT NULL DEFAULT {LOW_STOCK_THRESHOLD}")
+    except sqlite3.OperationalError:
+        pass
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_low_stock ON products(supplier, quantity) WHERE quantity <= reorder_threshold")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS supplier_lead_times (
+        supplier TEXT PRIMARY KEY,
+        lead_time_days INTEGER NOT NULL
+    ) WITHOUT ROWID
+    ''')
+
     # التأكد من وجود عمود الصلاحيات
     try:
         cursor.execute("ALTER TABLE employees ADD COLUMN can_apply_discount INTEGER NOT NULL DEFAULT 0")
@@ -156,28 +546,458 @@ def init_db():
         if not cursor.fetchone():
             cursor.execute("INSERT INTO employees (name, role, password) VALUES (?, ?, ?)", (name, role, pwd))
     # منح صلاحية الخصم للمدير
-    cursor.execute("UPDATE employees SET can_apply_discount = 1 WHERE role = 'مدير'")
+    cursor.execute("UPDATE employees SET can_apply_discount = 1 WHERE role = 'مدير' AND can_apply_discount = 0")
+
+    # ترحيل المنتجات القديمة: دفعة واحدة بكمية المنتج وتاريخ انتهائه
+    cursor.execute('''
+    INSERT INTO product_lots (product_id, quantity, expiry_date, supplier, cost_price, received_at)
+    SELECT id, quantity, expiry_date, supplier, cost_price, ?
+    FROM products p
+    WHERE quantity > 0 AND NOT EXISTS (SELECT 1 FROM product_lots l WHERE l.product_id = p.id)
+    ''', (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),))
+
+    # لقطة أساسية للكميات الحالية حتى تكون الاستعلامات الزمنية صحيحة لقواعد البيانات القديمة
+    cursor.execute("SELECT 1 FROM stock_snapshots LIMIT 1")
+    if not cursor.fetchone():
+        take_stock_snapshot(cursor)
 
     conn.commit()
     conn.close()
 
 from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+import bisect
+import functools
+import multiprocessing
+import queue
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import weakref
+
+# --- القياس وسجل الاستعلامات البطيئة ---
+# عند التعطيل لا تكلف الدوال المقاسة أكثر من فحص المفتاح enabled.
+diagnostics = {'enabled': os.environ.get('STORE_DIAGNOSTICS') == '1', 'export_thread': None}
+latency_histograms = {}
+slow_queries = deque(maxlen=200)
+diagnostics_lock = threading.Lock()
+trace_local = threading.local()
+
+def record_timing(name, ms):
+    with diagnostics_lock:
+        hist = latency_histograms.get(name)
+        if hist is None:
+            hist = latency_histograms[name] = {'count': 0, 'sum_ms': 0.0, 'max_ms': 0.0, 'buckets': [0] * len(LATENCY_BUCKETS_MS)}
+        hist['count'] += 1
+        hist['sum_ms'] += ms
+        hist['max_ms'] = max(hist['max_ms'], ms)
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if ms <= bound:
+                hist['buckets'][i] += 1
+                break
+
+def histogram_percentile(hist, fraction):
+    """الحد الأعلى للفئة التي تقع فيها النسبة المطلوبة (تقريبي بدقة الفئات)."""
+    target = hist['count'] * fraction
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS_MS, hist['buckets']):
+        seen += count
+        if seen >= target:
+            return min(bound, hist['max_ms'])
+    return hist['max_ms']
+
+def record_statement(sql):
+    """تسجل استعلامًا في جمع الخيط الجاري وتعيد سجله [sql, الثواني] ليُضاف إليه زمنه، أو None بلا جمع."""
+    statements = getattr(trace_local, 'statements', None)
+    if statements is None:
+        return None
+    entry = [sql, 0.0]
+    statements.append(entry)
+    return entry
+
+class TracedCursor(sqlite3.Cursor):
+    """مؤشر يضيف إلى كل استعلام زمن تنفيذه وجلب صفوفه فقط، فلا يُحسب عليه عمل بايثون الذي يليه."""
+    trace_entry = None
+
+    def timed(self, call, *args):
+        entry = self.trace_entry
+        if entry is None:
+            return call(*args)
+        started = time.perf_counter()
+        try:
+            return call(*args)
+        finally:
+            entry[1] += time.perf_counter() - started
+
+    def execute(self, sql, parameters=()):
+        self.trace_entry = record_statement(sql)
+        self.timed(super().execute, sql, parameters)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self.trace_entry = record_statement(sql)
+        self.timed(super().executemany, sql, seq_of_parameters)
+        return self
+
+    def fetchone(self):
+        return self.timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self.timed(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self.timed(super().fetchall)
+
+    def __next__(self):
+        return self.timed(super().__next__)
+
+class TracedConnection(sqlite3.Connection):
+    """اتصال مؤشراته TracedCursor؛ يُستخدم فقط عند تفعيل التشخيص (وللخيط الكاتب) لأن القياس في بايثون."""
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    # Connection.execute في C لا يمر بـ cursor() المعاد تعريفها
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def begin_trace():
+    """تبدأ جمع الاستعلامات المنفذة في هذا الخيط؛ تعيد False إن كان هناك جمع جارٍ (استدعاء متداخل)."""
+    if getattr(trace_local, 'statements', None) is not None:
+        return False
+    trace_local.statements = []
+    return True
+
+def end_trace(source):
+    """تنقل الاستعلامات التي تجاوز زمن تنفيذها وجلبها SLOW_QUERY_MS إلى سجل الاستعلامات البطيئة."""
+    statements, trace_local.statements = trace_local.statements, None
+    for sql, seconds in statements:
+        ms = seconds * 1000
+        if ms >= SLOW_QUERY_MS:
+            slow_queries.append({'at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'source': source,
+                                 'ms': round(ms, 3), 'sql': sql[:1000], 'plan': explain_query_plan(sql)})
+
+def explain_query_plan(sql):
+    if not sql.lstrip().upper().startswith(("SELECT", "WITH", "UPDATE", "DELETE", "INSERT")):
+        return []
+    conn = sqlite3.connect(DB_NAME)
+    try:
+        return [detail for _, _, _, detail in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+    except sqlite3.Error as e:
+        return [f"تعذر عرض الخطة: {e}"]
+    finally:
+        conn.close()
+
+def instrumented(kind):
+    """مزخرف يقيس زمن الدالة باسم kind.name ويجمع استعلاماتها البطيئة عند تفعيل التشخيص."""
+    def decorate(fn):
+        name = f"{kind}.{fn.__name__}"
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not diagnostics['enabled']:
+                return fn(*args, **kwargs)
+            outermost = begin_trace()
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                ended = time.perf_counter()
+                record_timing(name, (ended - started) * 1000)
+                if outermost:
+                    end_trace(name)
+        return wrapper
+    return decorate
+
+def get_diagnostics_snapshot():
+    with diagnostics_lock:
+        timings = {name: dict(hist, buckets=list(hist['buckets'])) for name, hist in latency_histograms.items()}
+    for hist in timings.values():
+        hist['avg_ms'] = hist['sum_ms'] / hist['count']
+        hist['p50_ms'] = histogram_percentile(hist, 0.50)
+        hist['p95_ms'] = histogram_percentile(hist, 0.95)
+    return {'generated_at': datetime.now().isoformat(timespec='seconds'), 'bucket_bounds_ms': LATENCY_BUCKETS_MS[:-1],
+            'timings': timings, 'slow_queries': list(slow_queries), 'writer': get_writer_stats(), 'readers': get_reader_stats()}
+
+def format_prometheus(snapshot):
+    lines = ["# TYPE store_latency_ms histogram"]
+    for name, hist in sorted(snapshot['timings'].items()):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, hist['buckets']):
+            cumulative += count
+            le = "+Inf" if bound == float('inf') else f"{bound:g}"
+            lines.append(f'store_latency_ms_bucket{{fn="{name}",le="{le}"}} {cumulative}')
+        lines.append(f'store_latency_ms_sum{{fn="{name}"}} {hist["sum_ms"]:.3f}')
+        lines.append(f'store_latency_ms_count{{fn="{name}"}} {hist["count"]}')
+    writer = snapshot['writer']
+    lines += ["# TYPE store_slow_queries gauge", f"store_slow_queries {len(snapshot['slow_queries'])}",
+              "# TYPE store_writer_queue_depth gauge", f"store_writer_queue_depth {writer['queue_depth']}",
+              "# TYPE store_writer_jobs_total counter", f"store_writer_jobs_total {writer['jobs']}",
+              "# TYPE store_writer_batches_total counter", f"store_writer_batches_total {writer['batches']}",
+              "# TYPE store_writer_lock_wait_seconds_total counter", f"store_writer_lock_wait_seconds_total {writer['lock_wait_seconds']:.6f}"]
+    readers = snapshot['readers']
+    lines += ["# TYPE store_read_snapshots_total counter", f"store_read_snapshots_total {readers['snapshots']}",
+              "# TYPE store_read_snapshots_active gauge", f"store_read_snapshots_active {readers['active']}",
+              "# TYPE store_read_open_wait_seconds_total counter", f"store_read_open_wait_seconds_total {readers['open_wait_seconds']:.6f}",
+              "# TYPE store_read_snapshot_held_seconds_total counter", f"store_read_snapshot_held_seconds_total {readers['held_seconds']:.6f}"]
+    return "\n".join(lines) + "\n"
+
+def write_metrics_files(base_path):
+    """تكتب base_path.json و base_path.prom (صيغة Prometheus النصية) بالاستبدال الذري."""
+    snapshot = get_diagnostics_snapshot()
+    for ext, text in ((".json", json.dumps(snapshot, ensure_ascii=False, indent=2)), (".prom", format_prometheus(snapshot))):
+        tmp_path = base_path + ext + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, base_path + ext)
+
+def start_metrics_export(base_path, interval=METRICS_EXPORT_INTERVAL):
+    if diagnostics['export_thread'] and diagnostics['export_thread'].is_alive():
+        return
+    def export_loop():
+        while True:
+            time.sleep(interval)
+            if diagnostics['enabled']:
+                try:
+                    write_metrics_files(base_path)
+                except OSError as e:
+                    print(f"تحذير: تعذر كتابة ملف القياسات: {e}")
+    diagnostics['export_thread'] = threading.Thread(target=export_loop, name="metrics-export", daemon=True)
+    diagnostics['export_thread'].start()
+
+def readonly_uri(path):
+    """رابط SQLite للفتح للقراءة فقط (mode=ro)، يُستخدم مع uri=True أو في ATTACH."""
+    return "file:" + urllib.request.pathname2url(os.path.abspath(path)) + "?mode=ro"
+
+@instrumented('db')
+def connect_db(readonly=False, **kwargs):
+    if diagnostics['enabled']:
+        kwargs.setdefault('factory', TracedConnection)
+    if readonly:
+        conn = sqlite3.connect(readonly_uri(DB_NAME), uri=True, **kwargs)
+    else:
+        conn = sqlite3.connect(DB_NAME, **kwargs)
+    # انتظار القفل بدل الفشل الفوري بـ "database is locked"
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    return conn
 
 @contextmanager
 def db_context():
     """مدير سياق للاتصال بقاعدة البيانات لضمان الفتح والإغلاق."""
-    conn = sqlite3.connect(DB_NAME)
+    conn = connect_db()
     try:
         yield conn
         conn.commit()
     finally:
         conn.close()
 
-def save_user_settings(user_name, role, theme):
+# --- اتصالات القراءة للتقارير ---
+# التقارير تقرأ من اتصال للقراءة فقط (mode=ro) داخل معاملة قراءة واحدة: كل استعلاماتها ترى لقطة القاعدة
+# لحظة أول قراءة مهما كتبت نقاط البيع أثناءها، ولا تأخذ قفلًا يؤخر الكاتب في وضع WAL.
+# READ_SNAPSHOTS = False يعيدها إلى اتصالات db_context العادية (للمقارنة في اختبار الحمل).
+READ_SNAPSHOTS = os.environ.get('STORE_READ_SNAPSHOTS', '1') != '0'
+reader_stats = {'snapshots': 0, 'fallbacks': 0, 'active': 0, 'max_active': 0, 'open_wait_seconds': 0.0,
+                'max_open_wait_seconds': 0.0, 'held_seconds': 0.0, 'max_held_seconds': 0.0}
+reader_lock = threading.Lock()
+
+@contextmanager
+def read_context():
+    """مدير سياق لاتصال قراءة بلقطة ثابتة؛ يُغلق دون التزام لأنه لا يكتب."""
+    if not READ_SNAPSHOTS:
+        with db_context() as conn:
+            yield conn
+        return
+    started = time.perf_counter()
+    try:
+        conn = connect_db(readonly=True, isolation_level=None)
+        fallback = False
+    except sqlite3.OperationalError:
+        # القاعدة غير موجودة بعد أو لا يمكن فتحها للقراءة فقط (ملف الذاكرة المشتركة مثلًا)
+        conn = connect_db(isolation_level=None)
+        fallback = True
+    try:
+        conn.execute("BEGIN")
+        # أول قراءة تثبت اللقطة؛ أي انتظار لقفل (استعادة WAL أو وضع journal آخر) يحدث هنا
+        conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+    except Exception:
+        conn.close()
+        raise
+    opened = time.perf_counter()
+    with reader_lock:
+        reader_stats['snapshots'] += 1
+        reader_stats['fallbacks'] += fallback
+        reader_stats['active'] += 1
+        reader_stats['max_active'] = max(reader_stats['max_active'], reader_stats['active'])
+        reader_stats['open_wait_seconds'] += opened - started
+        reader_stats['max_open_wait_seconds'] = max(reader_stats['max_open_wait_seconds'], opened - started)
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        conn.close()
+        held = time.perf_counter() - opened
+        with reader_lock:
+            reader_stats['active'] -= 1
+            reader_stats['held_seconds'] += held
+            reader_stats['max_held_seconds'] = max(reader_stats['max_held_seconds'], held)
+
+def get_reader_stats():
+    with reader_lock:
+        stats = dict(reader_stats)
+    if stats['snapshots']:
+        stats['avg_open_wait_ms'] = stats['open_wait_seconds'] * 1000 / stats['snapshots']
+        stats['avg_held_ms'] = stats['held_seconds'] * 1000 / stats['snapshots']
+    return stats
+
+# --- خدمة الكتابة ---
+# كل التعديلات تمر عبر طابور يفرغه خيط كاتب واحد: يجمع العمليات المنتظرة في معاملة واحدة
+# (التزام جماعي بمزامنة قرص واحدة)، وكل عملية داخل SAVEPOINT خاص بها فلا يُسقط فشلها بقية الدفعة.
+write_queue = queue.Queue()
+writer_state = {'thread': None, 'lock': threading.Lock(), 'attachments': {}}
+writer_stats = {'jobs': 0, 'failed_jobs': 0, 'batches': 0, 'failed_batches': 0, 'max_batch': 0, 'max_queue_depth': 0,
+                'queue_wait_seconds': 0.0, 'lock_wait_seconds': 0.0, 'max_lock_wait_seconds': 0.0, 'commit_seconds': 0.0, 'batch_sizes': {},
+                'last_write_at': 0.0}
+
+def submit_write(fn, *args):
+    """تضع العملية fn(cursor, *args) في طابور الكتابة وتعيد Future بنتيجتها بعد الالتزام."""
+    future = Future()
+    with writer_state['lock']:
+        if writer_state['thread'] is None or not writer_state['thread'].is_alive():
+            writer_state['thread'] = threading.Thread(target=_writer_loop, name="db-writer", daemon=True)
+            writer_state['thread'].start()
+    write_queue.put((fn, args, future, time.perf_counter()))
+    writer_stats['max_queue_depth'] = max(writer_stats['max_queue_depth'], write_queue.qsize())
+    return future
+
+def execute_write(fn, *args):
+    """تنفذ عملية كتابة عبر الخيط الكاتب وتنتظر نتيجتها (أو ترفع استثناءها)."""
+    return submit_write(fn, *args).result()
+
+def attach_to_writer(alias, path):
+    """تربط ملفًا باتصال الخيط الكاتب من الدفعة التالية؛ ATTACH غير مسموح داخل معاملته فيتم بين الدفعات."""
+    with writer_state['lock']:
+        writer_state['attachments'][alias] = path
+
+def detach_from_writer(alias):
+    with writer_state['lock']:
+        writer_state['attachments'].pop(alias, None)
+
+def _sync_writer_attachments(cursor, attached):
+    with writer_state['lock']:
+        wanted = dict(writer_state['attachments'])
+    for alias in [a for a, path in attached.items() if wanted.get(a) != path]:
+        cursor.execute(f"DETACH DATABASE {alias}")
+        del attached[alias]
+    for alias, path in wanted.items():
+        if alias not in attached:
+            cursor.execute(f"ATTACH DATABASE ? AS {alias}", (path,))
+            attached[alias] = path
+
+def get_writer_stats():
+    stats = dict(writer_stats, batch_sizes=dict(writer_stats['batch_sizes']), queue_depth=write_queue.qsize())
+    if stats['batches']:
+        stats['avg_batch'] = stats['jobs'] / stats['batches']
+        stats['avg_commit_ms'] = stats['commit_seconds'] * 1000 / stats['batches']
+    return stats
+
+def _writer_loop():
+    conn, conn_db, attached = None, None, {}
+    while True:
+        batch = [write_queue.get()]
+        deadline = time.perf_counter() + WRITE_BATCH_MAX_WAIT
+        while len(batch) < WRITE_BATCH_MAX_JOBS:
+            try:
+                batch.append(write_queue.get(timeout=max(0, deadline - time.perf_counter())))
+            except queue.Empty:
+                break
+
+        if conn_db != DB_NAME:
+            if conn:
+                conn.close()
+            # مؤشرات مقيسة دائمًا حتى يسري تفعيل التشخيص على الاتصال المفتوح؛ بلا جمع جارٍ لا تقيس شيئًا
+            conn, conn_db, attached = connect_db(isolation_level=None, factory=TracedConnection), DB_NAME, {}
+        cursor = conn.cursor()
+        results = []
+        started = time.perf_counter()
+        writer_stats['queue_wait_seconds'] += sum(started - queued_at for _, _, _, queued_at in batch)
+        try:
+            _sync_writer_attachments(cursor, attached)
+            # انتظار قفل الكتابة هنا لا يحدث إلا إذا كتبت عملية أخرى (نقطة بيع ثانية) على الملف نفسه
+            lock_started = time.perf_counter()
+            cursor.execute("BEGIN IMMEDIATE")
+            lock_wait = time.perf_counter() - lock_started
+            writer_stats['lock_wait_seconds'] += lock_wait
+            writer_stats['max_lock_wait_seconds'] = max(writer_stats['max_lock_wait_seconds'], lock_wait)
+            tracing = diagnostics['enabled']
+            for fn, args, future, _ in batch:
+                cursor.execute("SAVEPOINT write_job")
+                job_started = time.perf_counter()
+                if tracing:
+                    begin_trace()
+                try:
+                    results.append((future, fn(cursor, *args), None))
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO write_job")
+                    results.append((future, None, e))
+                if tracing:
+                    job_ended = time.perf_counter()
+                    record_timing(f"write.{fn.__name__}", (job_ended - job_started) * 1000)
+                    end_trace(f"write.{fn.__name__}")
+                cursor.execute("RELEASE write_job")
+            cursor.execute("COMMIT")
+        except Exception as e:
+            # فشل بدء المعاملة أو الالتزام: لم يُحفظ شيء من الدفعة
+            if conn.in_transaction:
+                conn.rollback()
+            writer_stats['failed_batches'] += 1
+            for _, _, future, _ in batch:
+                future.set_exception(e)
+            continue
+
+        writer_stats['batches'] += 1
+        writer_stats['jobs'] += len(batch)
+        writer_stats['max_batch'] = max(writer_stats['max_batch'], len(batch))
+        writer_stats['batch_sizes'][len(batch)] = writer_stats['batch_sizes'].get(len(batch), 0) + 1
+        writer_stats['commit_seconds'] += time.perf_counter() - started
+        writer_stats['last_write_at'] = time.time()
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                writer_stats['failed_jobs'] += 1
+                future.set_exception(error)
+
+@instrumented('db')
+def get_app_settings(prefix):
+    """{المفتاح بدون البادئة: القيمة} لكل الإعدادات العامة التي تبدأ بالبادئة."""
     with db_context() as conn:
-        conn.execute("INSERT OR REPLACE INTO settings (id, user_name, last_login_role, theme) VALUES (1, ?, ?, ?)",
-                     (user_name, role, theme))
+        rows = conn.execute("SELECT key, value FROM app_settings WHERE key >= ? AND key < ?", (prefix, prefix + "\U0010ffff"))
+        return {key[len(prefix):]: json.loads(value) for key, value in rows}
+
+def set_app_settings(prefix, values):
+    execute_write(_set_app_settings, prefix, values)
+    publish('settings_changed', keys={prefix + key for key in values})
+
+def _set_app_settings(cursor, prefix, values):
+    cursor.executemany("INSERT INTO app_settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                       [(prefix + key, json.dumps(value, ensure_ascii=False)) for key, value in values.items()])
 
+def save_user_settings(user_name, role, theme):
+    execute_write(_save_user_settings, user_name, role, theme)
+    publish('settings_changed', user_name=user_name, role=role, theme=theme)
+
+def _save_user_settings(cursor, user_name, role, theme):
+    cursor.execute("INSERT OR REPLACE INTO settings (id, user_name, last_login_role, theme) VALUES (1, ?, ?, ?)",
+                   (user_name, role, theme))
+
+@instrumented('db')
 def load_user_settings():
     with db_context() as conn:
         cursor = conn.cursor()
@@ -185,12 +1005,83 @@ def load_user_settings():
         return cursor.fetchone()
 
 # === 2. دوال قاعدة البيانات ===
+# ناقل الأحداث: دوال الكتابة تنشر ما تغير بعد الالتزام، والشاشات والتنبيهات تشترك وتطبق الفرق فقط.
+# ما يُنشر من خيط الواجهة يُدمج ويُسلَّم مرة واحدة لكل نوع في دورة الخمول التالية لـ Tk.
+EVENT_TYPES = {
+    'product_changed': "ids: منتجات أضيفت أو عُدلت، deleted: منتجات حُذفت، expiry_changed: منتجات تغير تاريخ انتهائها",
+    'stock_changed': "ids: منتجات تغيرت كمياتها، received: منتجات استلمت كميات جديدة",
+    'sale_completed': "sales: الفواتير المكتملة {invoice_id, sale_time, total, shift_id, lines: [(product_id, name, price, qty)]}",
+    'settings_changed': "الإعدادات المتغيرة وقيمها الجديدة (user_name, role, theme)، أو keys: مفاتيح الإعدادات العامة",
+    'employee_changed': "ids: موظفون أضيفوا أو عُدلوا أو حُذفوا",
+    'promotions_changed': "ids: عروض أضيفت أو عُدلت أو حُذفت",
+    'shift_changed': "ids: ورديات فُتحت أو أُغلقت",
+}
+event_subscribers = {event_type: [] for event_type in EVENT_TYPES}
+pending_events = {}
+events_lock = threading.Lock()
+event_flush = {'scheduled': False}
+
+def subscribe(event_type, handler, owner=None):
+    """تشترك handler(payload) في نوع حدث؛ مع owner (عنصر Tk) يُلغى الاشتراك تلقائيًا بعد تدميره.
+    تعيد دالة لإلغاء الاشتراك."""
+    entry = (handler, owner)
+    event_subscribers[event_type].append(entry)
+    def unsubscribe():
+        if entry in event_subscribers[event_type]:
+            event_subscribers[event_type].remove(entry)
+    return unsubscribe
+
+def publish(event_type, **payload):
+    """تدمج الحدث مع ما ينتظر من نوعه: المجموعات تُوحَّد والقوائم تُضم والقيم الأخرى تُستبدل."""
+    with events_lock:
+        merged = pending_events.setdefault(event_type, {})
+        for key, value in payload.items():
+            if isinstance(value, set):
+                merged[key] = merged.get(key, set()) | value
+            elif isinstance(value, list):
+                merged[key] = merged.get(key, []) + value
+            else:
+                merged[key] = value
+        on_ui_thread = root is not None and threading.current_thread() is threading.main_thread()
+        schedule = on_ui_thread and not event_flush['scheduled']
+        if schedule:
+            event_flush['scheduled'] = True
+    if root is None:
+        # بلا واجهة (سكربتات، قياسات): التسليم فوري
+        flush_events()
+    elif schedule:
+        root.after_idle(flush_events)
+    # النشر من خيط آخر أثناء عمل الواجهة يبقى منتظرًا حتى أول دورة تسليم في خيط الواجهة
+
+def flush_events():
+    with events_lock:
+        batch = dict(pending_events)
+        pending_events.clear()
+        event_flush['scheduled'] = False
+    for event_type, payload in batch.items():
+        for entry in list(event_subscribers[event_type]):
+            handler, owner = entry
+            if owner is not None:
+                try:
+                    alive = owner.winfo_exists()
+                except tk.TclError:
+                    alive = False
+                if not alive:
+                    event_subscribers[event_type].remove(entry)
+                    continue
+            try:
+                handler(payload)
+            except Exception as e:
+                print(f"تحذير: فشل معالج الحدث {event_type}: {e}")
+
+@instrumented('db')
 def get_employee(name, password):
     with db_context() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT name, role, can_apply_discount FROM employees WHERE name = ? AND password = ?", (name, password))
         return cursor.fetchone()
 
+@instrumented('db')
 def get_all_employees(filter_name=""):
     with db_context() as conn:
         cursor = conn.cursor()
@@ -200,16 +1091,18 @@ def get_all_employees(filter_name=""):
             cursor.execute("SELECT id, name, role FROM employees")
         return cursor.fetchall()
 
+@instrumented('db')
 def get_employee_details(employee_id):
     with db_context() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT id, name, role, can_apply_discount FROM employees WHERE id = ?", (employee_id,))
         return cursor.fetchone()
 
+@instrumented('db')
 def get_products_filtered(filter_name="", expiry_filter=""):
     with db_context() as conn:
         cursor = conn.cursor()
-        query = "SELECT id, name, cost_price, sell_price, quantity, expiry_date, supplier FROM products"
+        query = "SELECT id, name, cost_price, sell_price, quantity, expiry_date, supplier, reorder_threshold FROM products"
         params = []
         conditions = []
 
@@ -229,216 +1122,2337 @@ def get_products_filtered(filter_name="", expiry_filter=""):
         if conditions:
             query += " WHERE " + " AND ".join(conditions)
         cursor.execute(query, tuple(params))
-        rows = cursor.fetchall()
-        return [
-            {
-                'id': r[0], 'name': r[1], 'cost_price': r[2],
-                'sell_price': r[3], 'quantity': r[4], 'expiry_date': r[5], 'supplier': r[6]
-            }
-            for r in rows
-        ]
+        return [product_row_dict(r) for r in cursor.fetchall()]
 
+def product_row_dict(r):
+    return {
+        'id': r[0], 'name': r[1], 'cost_price': r[2],
+        'sell_price': r[3], 'quantity': r[4], 'expiry_date': r[5], 'supplier': r[6],
+        'reorder_threshold': r[7]
+    }
+
+def product_matches(product, name_filter="", expiry_filter=""):
+    """نفس شروط get_products_filtered مطبقة على منتج واحد في الذاكرة."""
+    if name_filter and name_filter.lower() not in product['name'].lower():
+        return False
+    if expiry_filter:
+        try:
+            datetime.strptime(expiry_filter, "%Y-%m-%d")
+        except ValueError:
+            return True
+        return product['expiry_date'] is not None and product['expiry_date'] <= expiry_filter
+    return True
+
+@instrumented('db')
+def get_products_by_ids(ids):
+    if not ids:
+        return []
+    with db_context() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, name, cost_price, sell_price, quantity, expiry_date, supplier, reorder_threshold FROM products
+            WHERE id IN (SELECT value FROM json_each(?)) ORDER BY id
+        ''', (json.dumps(sorted(ids)),))
+        return [product_row_dict(r) for r in cursor.fetchall()]
+
+@instrumented('db')
 def get_product_by_barcode(barcode):
     with db_context() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT name, sell_price, quantity FROM products WHERE name = ?", (barcode,))
+        cursor.execute('''
+            SELECT p.id, p.name, p.sell_price, p.quantity, b.pack_qty
+            FROM product_barcodes b JOIN products p ON p.id = b.product_id
+            WHERE b.code = ?
+        ''', (barcode,))
         result = cursor.fetchone()
         if result:
-            return {'name': result[0], 'sell_price': result[1], 'quantity': result[2]}
+            return {'id': result[0], 'name': result[1], 'sell_price': result[2], 'quantity': result[3], 'pack_qty': result[4]}
         return None
 
-def add_product_to_db(name, cost, sell, qty, expiry_str, supplier):
+@instrumented('db')
+def get_product_barcodes(product_ids=None):
+    """{product_id: [(الرمز، عدد القطع)]} ورمز القطعة الواحدة أولًا؛ بلا product_ids تعيد كل الرموز."""
+    query = "SELECT product_id, code, pack_qty FROM product_barcodes"
+    params = ()
+    if product_ids is not None:
+        query += " WHERE product_id IN (SELECT value FROM json_each(?))"
+        params = (json.dumps(sorted(product_ids)),)
+    codes = {}
     with db_context() as conn:
+        for product_id, code, pack_qty in conn.execute(query + " ORDER BY product_id, pack_qty, code", params):
+            codes.setdefault(product_id, []).append((code, pack_qty))
+    return codes
+
+def set_product_barcodes(product_id, codes):
+    """تستبدل رموز المنتج بالقائمة [(الرمز، عدد القطع)]. تعيد (نجاح، رسالة)."""
+    success, msg = execute_write(_set_product_barcodes, product_id, codes)
+    if success:
+        publish('product_changed', ids={product_id})
+    return success, msg
+
+def _set_product_barcodes(cursor, product_id, codes):
+    cursor.execute("SAVEPOINT set_barcodes")
+    cursor.execute("DELETE FROM product_barcodes WHERE product_id = ?", (product_id,))
+    try:
+        cursor.executemany("INSERT INTO product_barcodes (code, product_id, pack_qty) VALUES (?, ?, ?)",
+                           [(code, product_id, pack_qty) for code, pack_qty in codes])
+    except sqlite3.IntegrityError:
+        cursor.execute("ROLLBACK TO set_barcodes")
+        cursor.execute("RELEASE set_barcodes")
+        cursor.execute("SELECT p.name FROM product_barcodes b JOIN products p ON p.id = b.product_id "
+                       "WHERE b.code IN (SELECT value FROM json_each(?)) AND b.product_id <> ?",
+                       (json.dumps([code for code, _ in codes]), product_id))
+        owner = cursor.fetchone()
+        return False, f"الباركود مستخدم للمنتج: {owner[0]}" if owner else "باركود مكرر"
+    cursor.execute("RELEASE set_barcodes")
+    return True, ""
+
+@instrumented('db')
+def add_product_to_db(name, cost, sell, qty, expiry_str, supplier, barcode=None):
+    product_id = execute_write(_add_product, name, cost, sell, qty, expiry_str, supplier, barcode)
+    if product_id is None:
+        return False
+    publish('product_changed', ids={product_id}, expiry_changed={product_id} if expiry_str else set())
+    return True
+
+def _add_product(cursor, name, cost, sell, qty, expiry_str, supplier, barcode=None):
+    cursor.execute("SAVEPOINT add_product")
+    try:
+        cursor.execute('''
+        INSERT INTO products (name, cost_price, sell_price, quantity, expiry_date, supplier)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', (name, cost, sell, qty, expiry_str, supplier))
+        product_id = cursor.lastrowid
+        if barcode:
+            cursor.execute("INSERT INTO product_barcodes (code, product_id, pack_qty) VALUES (?, ?, 1)", (barcode, product_id))
+    except sqlite3.IntegrityError:
+        cursor.execute("ROLLBACK TO add_product")
+        cursor.execute("RELEASE add_product")
+        return None
+    cursor.execute("RELEASE add_product")
+    if qty:
+        add_lot(cursor, product_id, qty, expiry_str, supplier, cost)
+        record_stock_movement(cursor, product_id, 'receipt', qty)
+    return product_id
+
+@instrumented('db')
+def delete_product_from_db(name):
+    product_id = execute_write(_delete_product, name)
+    if product_id is not None:
+        publish('product_changed', deleted={product_id})
+
+def _delete_product(cursor, name):
+    cursor.execute("SELECT id, quantity FROM products WHERE name = ?", (name,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    product_id, qty = row
+    # تصفير رصيد المنتج في السجل قبل حذفه حتى تبقى الأرصدة التاريخية متوازنة
+    if qty:
+        record_stock_movement(cursor, product_id, 'adjustment', -qty, "حذف المنتج")
+    cursor.execute("DELETE FROM product_lots WHERE product_id = ?", (product_id,))
+    cursor.execute("DELETE FROM product_barcodes WHERE product_id = ?", (product_id,))
+    cursor.execute("DELETE FROM products WHERE id = ?", (product_id,))
+    return product_id
+
+@instrumented('db')
+def update_product_in_db(product_id, name, cost, sell, qty, expiry_str, supplier):
+    success, msg, expiry_changed = execute_write(_update_product, product_id, name, cost, sell, qty, expiry_str, supplier)
+    if success:
+        publish('product_changed', ids={product_id}, expiry_changed={product_id} if expiry_changed else set())
+    return success, msg
+
+def _update_product(cursor, product_id, name, cost, sell, qty, expiry_str, supplier):
+    cursor.execute("SELECT quantity, expiry_date, cost_price, sell_price FROM products WHERE id = ?", (product_id,))
+    row = cursor.fetchone()
+    if not row:
+        return False, "لم يتم العثور على المنتج.", False
+    old_qty, old_expiry, old_cost, old_sell = row
+    try:
+        cursor.execute('''
+        UPDATE products 
+        SET name = ?, cost_price = ?, sell_price = ?, quantity = ?, expiry_date = ?, supplier = ?
+        WHERE id = ?
+        ''', (name, cost, sell, qty, expiry_str, supplier, product_id))
+    except sqlite3.IntegrityError:
+        return False, "اسم المنتج مستخدم مسبقًا.", False
+    if qty > old_qty:
+        add_lot(cursor, product_id, qty - old_qty, expiry_str, supplier, cost)
+    elif qty < old_qty:
+        consume_lots_fefo(cursor, product_id, old_qty - qty)
+    elif expiry_str != old_expiry:
+        # تعديل تاريخ الانتهاء من نافذة المنتج يسري فقط عندما تكون هناك دفعة واحدة قائمة
+        cursor.execute("SELECT id FROM product_lots WHERE product_id = ? AND quantity > 0", (product_id,))
+        active_lots = cursor.fetchall()
+        if len(active_lots) == 1:
+            cursor.execute("UPDATE product_lots SET expiry_date = ? WHERE id = ?", (expiry_str, active_lots[0][0]))
+    if qty != old_qty:
+        record_stock_movement(cursor, product_id, 'adjustment', qty - old_qty, "تعديل يدوي")
+    if (cost, sell) != (old_cost, old_sell):
+        cursor.execute("INSERT INTO price_history (product_id, old_cost, new_cost, old_sell, new_sell, changed_at, reason) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (product_id, old_cost, cost, old_sell, sell, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "تعديل يدوي"))
+    refresh_product_expiry(cursor, product_id)
+    cursor.execute("SELECT expiry_date FROM products WHERE id = ?", (product_id,))
+    return True, "", cursor.fetchone()[0] != old_expiry
+
+@instrumented('db')
+def add_employee_to_db(name, role, password):
+    employee_id = execute_write(_add_employee, name, role, password)
+    if employee_id is None:
+        return False
+    publish('employee_changed', ids={employee_id})
+    return True
+
+def _add_employee(cursor, name, role, password):
+    try:
+        cursor.execute("INSERT INTO employees (name, role, password) VALUES (?, ?, ?)", (name, role, password))
+        return cursor.lastrowid
+    except sqlite3.IntegrityError:
+        return None
+
+@instrumented('db')
+def delete_employee_from_db(employee_id):
+    execute_write(_delete_employee, employee_id)
+    publish('employee_changed', ids={employee_id})
+
+def _delete_employee(cursor, employee_id):
+    cursor.execute("DELETE FROM employees WHERE id = ?", (employee_id,))
+
+@instrumented('db')
+def update_employee_in_db(employee_id, role, can_apply_discount, password=None):
+    execute_write(_update_employee, employee_id, role, can_apply_discount, password)
+    publish('employee_changed', ids={employee_id})
+    return True
+
+def _update_employee(cursor, employee_id, role, can_apply_discount, password):
+    if password:
+        cursor.execute("UPDATE employees SET role = ?, password = ?, can_apply_discount = ? WHERE id = ?", (role, password, can_apply_discount, employee_id))
+    else:
+        cursor.execute("UPDATE employees SET role = ?, can_apply_discount = ? WHERE id = ?", (role, can_apply_discount, employee_id))
+    return True
+
+@instrumented('db')
+def update_user_credentials(old_username, new_username=None, new_password=None):
+    if not new_username and not new_password:
+        return True, ""
+
+    updates = []
+    params = []
+    if new_username:
+        updates.append("name = ?")
+        params.append(new_username)
+    if new_password:
+        updates.append("password = ?")
+        params.append(new_password)
+    
+    params.append(old_username)
+    query = f"UPDATE employees SET {', '.join(updates)} WHERE name = ?"
+    
+    def update(cursor):
         try:
-            conn.execute('''
-            INSERT INTO products (name, cost_price, sell_price, quantity, expiry_date, supplier)
-            VALUES (?, ?, ?, ?, ?, ?)
-            ''', (name, cost, sell, qty, expiry_str, supplier))
-            return True
+            cursor.execute(query, tuple(params))
         except sqlite3.IntegrityError:
-            return False
+            return False, "اسم المستخدم الجديد مستخدم مسبقًا."
+        cursor.execute("SELECT id FROM employees WHERE name = ?", (new_username or old_username,))
+        row = cursor.fetchone()
+        return True, row[0] if row else None
+    success, result = execute_write(update)
+    if not success:
+        return False, result
+    if result is not None:
+        publish('employee_changed', ids={result})
+    return True, ""
+
+def next_invoice_id(cursor):
+    """رقم الفاتورة التالي لليوم. يُستدعى داخل معاملة الكتابة حتى لا يتكرر الرقم بين نقاط البيع."""
+    today = datetime.now().strftime("%Y%m%d")
+    # نطاق بدل LIKE حتى يُستخدم فهرس invoice_id ويُمسح فقط فواتير اليوم
+    cursor.execute("SELECT COUNT(DISTINCT invoice_id) FROM sales WHERE invoice_id >= ? AND invoice_id < ?",
+                   (f"INV-{today}-", f"INV-{today}."))
+    count = cursor.fetchone()[0] + 1
+    return f"INV-{today}-{count:03d}"
 
-def delete_product_from_db(name):
+def generate_invoice_id():
     with db_context() as conn:
-        conn.execute("DELETE FROM products WHERE name = ?", (name,))
+        return next_invoice_id(conn.cursor())
+
+def sell_line(cursor, invoice_id, product_name, sell_price, quantity, sale_time, promotion_id=None, promotion_discount=0,
+              shift_id=None):
+    """تبيع سطرًا واحدًا ضمن معاملة الفاتورة الحالية. تعيد (False, رسالة) إذا تعذر البيع.
+    sell_price سعر القطعة الصافي بعد العرض والخصم؛ العرض المطبق وقيمته والوردية تُسجل مع السطر."""
+    cursor.execute("SELECT id, quantity FROM products WHERE name = ?", (product_name,))
+    row = cursor.fetchone()
+    if not row:
+        return False, "المنتج غير موجود"
+    product_id, current_qty = row
+    if current_qty < quantity:
+        return False, f"الكمية غير كافية! المتوفر: {current_qty}"
+
+    new_qty = current_qty - quantity
+    cursor.execute("UPDATE products SET quantity = ? WHERE id = ?", (new_qty, product_id))
+    consume_lots_fefo(cursor, product_id, quantity)
+    refresh_product_expiry(cursor, product_id)
 
-def update_product_in_db(product_id, name, cost, sell, qty, expiry_str, supplier):
+    cursor.execute('''
+    INSERT INTO sales (invoice_id, product_name, sell_price, quantity, sale_time, promotion_id, promotion_discount, shift_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (invoice_id, product_name, sell_price, quantity, sale_time, promotion_id, promotion_discount, shift_id))
+    record_stock_movement(cursor, product_id, 'sale', -quantity, invoice_id, sale_time)
+    cursor.execute('''
+    INSERT INTO daily_sales (sale_date, total, quantity) VALUES (?, ?, ?)
+    ON CONFLICT(sale_date) DO UPDATE SET total = total + excluded.total, quantity = quantity + excluded.quantity
+    ''', (sale_time[:10], sell_price * quantity, quantity))
+    return True, product_id
+
+@instrumented('db')
+def checkout(cart, discount_percentage=0, shift_id=None):
+    """تبيع جميع أسطر السلة في معاملة واحدة برقم فاتورة واحد؛ إذا فشل أي سطر لا يُحفظ شيء.
+    cart: قائمة عناصر {'name', 'price', 'quantity'[, 'product_id']}. العروض تُحسب هنا لكل سطر ثم يُطبق
+    الخصم اليدوي على الصافي. مع shift_id تُضاف الفاتورة إلى إجماليات الوردية في المعاملة نفسها.
+    تعيد (True, رقم الفاتورة) أو (False, رسالة الخطأ)."""
+    if not cart:
+        return False, "لا يوجد منتجات"
+    promotions = price_cart(cart)
+    success, result = execute_write(_checkout, cart, 1 - (discount_percentage / 100), promotions, shift_id)
+    if not success:
+        return False, result
+    publish('stock_changed', ids={line[0] for line in result['lines']})
+    publish('sale_completed', sales=[result])
+    return True, result['invoice_id']
+
+def _checkout(cursor, cart, discount_factor, promotions=None, shift_id=None):
+    # الخيط الكاتب يحمل قفل الكتابة، فرقم الفاتورة والكميات محسوبة على آخر حالة
+    cursor.execute("SAVEPOINT checkout")
+    invoice_id = next_invoice_id(cursor)
+    sale_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    total = gross = promotion_total = 0
+    lines = []
+    for item, (promotion_id, promotion_discount) in zip(cart, promotions or [(None, 0)] * len(cart)):
+        price = (item['price'] - promotion_discount / item['quantity']) * discount_factor
+        success, result = sell_line(cursor, invoice_id, item['name'], price, item['quantity'], sale_time,
+                                    promotion_id, promotion_discount, shift_id)
+        if not success:
+            cursor.execute("ROLLBACK TO checkout")
+            cursor.execute("RELEASE checkout")
+            return False, f"{item['name']}: {result}"
+        lines.append((result, item['name'], price, item['quantity']))
+        total += price * item['quantity']
+        gross += item['price'] * item['quantity']
+        promotion_total += promotion_discount
+    if shift_id is not None and not add_to_shift_totals(cursor, shift_id, invoice_id, lines, gross, promotion_total, total):
+        cursor.execute("ROLLBACK TO checkout")
+        cursor.execute("RELEASE checkout")
+        return False, "الوردية مغلقة، افتح وردية جديدة"
+    cursor.execute("INSERT INTO invoices (invoice_id, created_at, total, line_count) VALUES (?, ?, ?, ?)",
+                   (invoice_id, sale_time, total, len(cart)))
+    cursor.execute("RELEASE checkout")
+    return True, {'invoice_id': invoice_id, 'sale_time': sale_time, 'total': total, 'shift_id': shift_id, 'lines': lines}
+
+@instrumented('db')
+def sell_product(product_name, sell_price, quantity):
+    success, msg = checkout([{'name': product_name, 'price': sell_price, 'quantity': quantity}])
+    if not success:
+        return False, msg.split(": ", 1)[-1]
+    return True, msg
+
+@instrumented('db')
+def get_sales_by_invoice(invoice_id):
+    with read_context() as conn:
+        cursor = conn.cursor()
+        # سنة الفاتورة من رقمها (INV-YYYYMMDD-NNN) تحدد ملف الأرشيف الذي قد يحويها
+        year = invoice_id[4:8] if invoice_id[4:8].isdigit() else None
+        schemas = attach_sales_archives(cursor, year and f"{year}-01-01", year and f"{year}-12-31")
+        lines = union_sql(schemas, "SELECT product_name, sell_price, quantity, sale_time FROM {schema}.sales WHERE invoice_id = ?")
+        cursor.execute(lines, (invoice_id,) * len(schemas))
+        return cursor.fetchall()
+
+@instrumented('db')
+def get_daily_sales(target_date):
+    return cached_report('daily_sales', target_date, lambda: _daily_sales_rows(target_date))
+
+def _daily_sales_rows(target_date):
+    next_day = (datetime.strptime(target_date, "%Y-%m-%d").date() + timedelta(days=1)).isoformat()
+    with read_context() as conn:
+        cursor = conn.cursor()
+        schemas = attach_sales_archives(cursor, target_date, target_date)
+        day_sales = union_sql(schemas, "SELECT invoice_id, product_name, sell_price, quantity FROM {schema}.sales "
+                                       "WHERE sale_time >= ? AND sale_time < ?")
+        cursor.execute(f'''
+            SELECT
+                s.invoice_id,
+                s.product_name,
+                s.sell_price,
+                s.quantity,
+                p.cost_price
+            FROM ({day_sales}) s
+            JOIN products p ON s.product_name = p.name
+        ''', (target_date, next_day) * len(schemas))
+        return cursor.fetchall()
+
+@instrumented('db')
+def get_all_invoices():
+    """تجلب قائمة بجميع الفواتير مع إجمالي كل فاتورة."""
+    with read_context() as conn:
+        cursor = conn.cursor()
+        schemas = attach_sales_archives(cursor)
+        cursor.execute(union_sql(schemas, "SELECT invoice_id, created_at, total FROM {schema}.invoices")
+                       + " ORDER BY created_at DESC, invoice_id DESC")
+        return cursor.fetchall()
+
+INVOICE_PAGE_SIZE = 100
+
+@instrumented('db')
+def get_invoices_page(after=None, limit=INVOICE_PAGE_SIZE, start_date=None, end_date=None,
+                      id_prefix=None, min_total=None, max_total=None):
+    """صفحة من الفواتير الأحدث أولًا بترقيم المفتاح (keyset): after هو (created_at, invoice_id)
+    لآخر صف في الصفحة السابقة. تعيد (الصفوف، مؤشر الصفحة التالية أو None)."""
+    conditions, params = [], []
+    if after:
+        conditions.append("(created_at, invoice_id) < (?, ?)")
+        params.extend(after)
+    if start_date:
+        conditions.append("created_at >= ?")
+        params.append(f"{start_date} 00:00:00")
+    if end_date:
+        conditions.append("created_at <= ?")
+        params.append(f"{end_date} 23:59:59")
+    if id_prefix:
+        # نطاق على المفتاح الأساسي بدل LIKE
+        conditions.append("invoice_id >= ? AND invoice_id < ?")
+        params.extend([id_prefix, id_prefix + "\U0010ffff"])
+    if min_total is not None:
+        conditions.append("total >= ?")
+        params.append(min_total)
+    if max_total is not None:
+        conditions.append("total <= ?")
+        params.append(max_total)
+
+    query = "SELECT invoice_id, created_at, total, line_count FROM {schema}.invoices"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY created_at DESC, invoice_id DESC LIMIT ?"
+    params.append(limit)
+    # الصفحات التالية لا تحتاج أرشيفات سنوات أحدث من آخر صف معروض
+    last_date = min(filter(None, [end_date, after and after[0][:10]]), default=None)
+    with read_context() as conn:
+        cursor = conn.cursor()
+        schemas = attach_sales_archives(cursor, start_date, last_date)
+        if len(schemas) == 1:
+            cursor.execute(query.format(schema='main'), tuple(params))
+        else:
+            # كل فرع يستخدم فهرسه ويعيد صفحة واحدة على الأكثر، ثم تُدمج الفروع
+            branches = union_sql(schemas, "SELECT * FROM (" + query + ")")
+            cursor.execute(branches + " ORDER BY created_at DESC, invoice_id DESC LIMIT ?",
+                           tuple(params) * len(schemas) + (limit,))
+        rows = cursor.fetchall()
+    next_cursor = (rows[-1][1], rows[-1][0]) if len(rows) == limit else None
+    return rows, next_cursor
+
+@instrumented('db')
+def get_daily_sales_totals(start_date, end_date):
+    """تجلب إجمالي المبيعات لكل يوم بين تاريخين من جدول الإجماليات اليومية."""
+    with read_context() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT sale_date, total FROM daily_sales
+            WHERE sale_date BETWEEN ? AND ?
+            ORDER BY sale_date ASC
+        ''', (start_date, end_date))
+        return cursor.fetchall()
+
+@instrumented('db')
+def get_sales_summary_last_7_days():
+    """تجلب ملخص المبيعات لآخر 7 أيام."""
+    seven_days_ago = (datetime.now() - timedelta(days=6)).strftime('%Y-%m-%d')
+    return get_daily_sales_totals(seven_days_ago, date.today().isoformat())
+
+@instrumented('db')
+def get_best_selling_products(limit=10):
+    """Fetches the best-selling products based on quantity sold."""
+    today = date.today().isoformat()
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+    # ما قبل اليوم محفوظ في ذاكرة التقارير، ومبيعات اليوم المفتوح فقط تُحسب مباشرة
+    totals = dict(cached_report('product_quantities', yesterday, lambda: _product_quantities(before=today)))
+    for name, qty in _product_quantities(since=today):
+        totals[name] = totals.get(name, 0) + qty
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+def _product_quantities(before=None, since=None):
+    """مجموع الكميات المباعة لكل منتج؛ الفترة المغلقة (before) تشمل الكميات المؤرشفة."""
+    with read_context() as conn:
+        cursor = conn.cursor()
+        if since:
+            cursor.execute("SELECT product_name, SUM(quantity) FROM sales WHERE sale_time >= ? GROUP BY product_name", (since,))
+        else:
+            cursor.execute('''
+                SELECT product_name, SUM(quantity) FROM (
+                    SELECT product_name, quantity FROM sales WHERE sale_time < ?
+                    UNION ALL
+                    SELECT product_name, quantity FROM archived_product_sales
+                )
+                GROUP BY product_name
+            ''', (before,))
+        return cursor.fetchall()
+
+def check_expiry_alerts(product_ids=None):
+    alerts = [
+        f"{name} — {qty} قطعة — ينتهي في: {expiry}" + (f" ({supplier})" if supplier else "")
+        for name, qty, expiry, supplier in get_expiring_lots(15, product_ids)
+    ]
+    if alerts:
+        messagebox.showwarning("تنبيه انتهاء الصلاحية", "\n".join(alerts))
+
+def alert_changed_products(product_ids):
+    """تنبيه الانتهاء للمنتجات التي أضيفت أو تغير تاريخ انتهائها أو استلمت دفعة جديدة فقط
+    (لا للمبيعات ولا لتعديلات الأسعار والموردين والرموز)."""
+    if root is not None and product_ids:
+        check_expiry_alerts(product_ids)
+
+subscribe('product_changed', lambda event: alert_changed_products(event.get('expiry_changed')))
+subscribe('stock_changed', lambda event: alert_changed_products(event.get('received')))
+
+# === 2.1 سجل حركات المخزون ===
+STOCK_MOVEMENT_TYPES = {
+    'sale': "مبيعات",
+    'receipt': "استلام",
+    'adjustment': "تسوية",
+    'return': "مرتجعات",
+}
+
+def record_stock_movement(cursor, product_id, movement_type, quantity_change, reference=None, moved_at=None):
+    """تسجل حركة مخزون ضمن المعاملة الحالية وتأخذ لقطة جديدة كل STOCK_SNAPSHOT_INTERVAL حركة."""
+    if movement_type not in STOCK_MOVEMENT_TYPES:
+        raise ValueError(f"نوع حركة غير معروف: {movement_type}")
+    moved_at = moved_at or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cursor.execute('''
+    INSERT INTO stock_movements (product_id, movement_type, quantity_change, reference, moved_at)
+    VALUES (?, ?, ?, ?, ?)
+    ''', (product_id, movement_type, quantity_change, reference, moved_at))
+    movement_id = cursor.lastrowid
+    cursor.execute("SELECT last_movement_id FROM stock_snapshots ORDER BY id DESC LIMIT 1")
+    last = cursor.fetchone()
+    if last is None or movement_id - last[0] >= STOCK_SNAPSHOT_INTERVAL:
+        take_stock_snapshot(cursor, moved_at)
+    return movement_id
+
+def take_stock_snapshot(cursor, taken_at=None):
+    """تحفظ كميات جميع المنتجات كما هي بعد آخر حركة مسجلة."""
+    taken_at = taken_at or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cursor.execute("SELECT COALESCE(MAX(id), 0) FROM stock_movements")
+    last_movement_id = cursor.fetchone()[0]
+    cursor.execute("INSERT INTO stock_snapshots (taken_at, last_movement_id) VALUES (?, ?)",
+                   (taken_at, last_movement_id))
+    snapshot_id = cursor.lastrowid
+    cursor.execute("INSERT INTO stock_snapshot_items (snapshot_id, product_id, quantity) SELECT ?, id, quantity FROM products",
+                   (snapshot_id,))
+    return snapshot_id
+
+def _stock_at(cursor, at_time, product_id=None):
+    """رصيد المخزون في لحظة معينة: أقرب لقطة (قبلها أو بعدها) ثم مسح صغير لنطاق الحركات بينهما."""
+    # آخر حركة حتى اللحظة المطلوبة تحدد موقعنا في السجل
+    cursor.execute("SELECT id FROM stock_movements WHERE moved_at <= ? ORDER BY moved_at DESC, id DESC LIMIT 1", (at_time,))
+    row = cursor.fetchone()
+    boundary = row[0] if row else 0
+
+    cursor.execute("SELECT id, last_movement_id FROM stock_snapshots WHERE last_movement_id <= ? ORDER BY last_movement_id DESC, id DESC LIMIT 1",
+                   (boundary,))
+    before = cursor.fetchone()
+    cursor.execute("SELECT id, last_movement_id FROM stock_snapshots WHERE last_movement_id > ? ORDER BY last_movement_id ASC LIMIT 1",
+                   (boundary,))
+    after = cursor.fetchone()
+    if before and (not after or boundary - before[1] <= after[1] - boundary):
+        # اللقطة السابقة + الحركات التي تلتها حتى اللحظة المطلوبة
+        snapshot_id, low, high, sign = before[0], before[1], boundary, 1
+    elif after:
+        # اللقطة اللاحقة - الحركات التي وقعت بعد اللحظة المطلوبة
+        snapshot_id, low, high, sign = after[0], boundary, after[1], -1
+    else:
+        return {}
+
+    if product_id is not None:
+        cursor.execute("SELECT product_id, quantity FROM stock_snapshot_items WHERE snapshot_id = ? AND product_id = ?",
+                       (snapshot_id, product_id))
+        # +product_id يبقي المسح على نطاق المعرفات الصغير بدل كل تاريخ المنتج في الفهرس
+        product_clause, product_params = " AND +product_id = ?", (product_id,)
+    else:
+        cursor.execute("SELECT product_id, quantity FROM stock_snapshot_items WHERE snapshot_id = ?", (snapshot_id,))
+        product_clause, product_params = "", ()
+    stock = dict(cursor.fetchall())
+    cursor.execute(f'''
+        SELECT product_id, SUM(quantity_change) FROM stock_movements
+        WHERE id > ? AND id <= ?{product_clause}
+        GROUP BY +product_id
+    ''', (low, high) + product_params)
+    for pid, change in cursor.fetchall():
+        stock[pid] = stock.get(pid, 0) + sign * change
+    return stock
+
+@instrumented('db')
+def get_stock_at(at_time, product_id=None):
+    """تعيد رصيد المخزون في تاريخ/وقت معين (YYYY-MM-DD أو YYYY-MM-DD HH:MM:SS).
+    بدون product_id تعيد قاموسًا {معرف المنتج: الكمية}، ومعه تعيد كمية ذلك المنتج فقط."""
+    if len(at_time) == 10:
+        at_time += " 23:59:59"
+    with read_context() as conn:
+        stock = _stock_at(conn.cursor(), at_time, product_id)
+    if product_id is not None:
+        return stock.get(product_id, 0)
+    return stock
+
+@instrumented('db')
+def get_stock_movements_report(start_date, end_date):
+    """تقرير حركة المخزون بين تاريخين: الرصيد الافتتاحي، مجموع كل نوع حركة، والرصيد الختامي لكل منتج."""
+    with read_context() as conn:
+        cursor = conn.cursor()
+        # نطرح ثانية واحدة حتى لا تدخل حركات بداية اليوم في الرصيد الافتتاحي
+        opening_time = (datetime.strptime(start_date, "%Y-%m-%d") - timedelta(seconds=1)).strftime("%Y-%m-%d %H:%M:%S")
+        opening = _stock_at(cursor, opening_time)
+        cursor.execute('''
+            SELECT product_id, movement_type, SUM(quantity_change)
+            FROM stock_movements
+            WHERE moved_at BETWEEN ? AND ?
+            GROUP BY product_id, movement_type
+        ''', (f"{start_date} 00:00:00", f"{end_date} 23:59:59"))
+        totals = {}
+        for pid, movement_type, change in cursor.fetchall():
+            totals.setdefault(pid, {})[movement_type] = change
+        cursor.execute("SELECT id, name FROM products")
+        names = dict(cursor.fetchall())
+
+    report = []
+    for pid in sorted(set(opening) | set(totals)):
+        by_type = totals.get(pid, {})
+        opening_qty = opening.get(pid, 0)
+        row = {'product_id': pid, 'name': names.get(pid, f"#{pid}"), 'opening': opening_qty}
+        for movement_type in STOCK_MOVEMENT_TYPES:
+            row[movement_type] = by_type.get(movement_type, 0)
+        row['closing'] = opening_qty + sum(by_type.values())
+        report.append(row)
+    return report
+
+@instrumented('db')
+def receive_stock(product_id, quantity, reference=None, expiry_date=None, supplier=None, cost_price=None):
+    """تستلم دفعة جديدة من منتج موجود وتسجلها كحركة استلام."""
+    success, msg = execute_write(_receive_stock, product_id, quantity, reference, expiry_date, supplier, cost_price)
+    if success:
+        publish('stock_changed', ids={product_id}, received={product_id})
+    return success, msg
+
+def _receive_stock(cursor, product_id, quantity, reference, expiry_date, supplier, cost_price):
+    cursor.execute("UPDATE products SET quantity = quantity + ? WHERE id = ?", (quantity, product_id))
+    if cursor.rowcount == 0:
+        return False, "المنتج غير موجود"
+    add_lot(cursor, product_id, quantity, expiry_date, supplier, cost_price)
+    refresh_product_expiry(cursor, product_id)
+    record_stock_movement(cursor, product_id, 'receipt', quantity, reference)
+    return True, ""
+
+@instrumented('db')
+def return_product(product_name, quantity, invoice_id=None):
+    """تعيد كمية مرتجعة من الزبون إلى المخزون وتسجلها كحركة مرتجعات."""
+    success, result = execute_write(_return_product, product_name, quantity, invoice_id)
+    if not success:
+        return False, result
+    publish('stock_changed', ids={result})
+    return True, ""
+
+def _return_product(cursor, product_name, quantity, invoice_id):
+    cursor.execute("SELECT id FROM products WHERE name = ?", (product_name,))
+    row = cursor.fetchone()
+    if not row:
+        return False, "المنتج غير موجود"
+    product_id = row[0]
+    cursor.execute("UPDATE products SET quantity = quantity + ? WHERE id = ?", (quantity, product_id))
+    # المرتجع يعود إلى الدفعة التي سيبيعها FEFO أولًا، أو إلى آخر دفعة إن نفدت كلها
+    cursor.execute("SELECT id FROM product_lots WHERE product_id = ? AND quantity > 0 ORDER BY expiry_date IS NULL, expiry_date, id LIMIT 1",
+                   (product_id,))
+    lot = cursor.fetchone()
+    if not lot:
+        cursor.execute("SELECT id FROM product_lots WHERE product_id = ? ORDER BY id DESC LIMIT 1", (product_id,))
+        lot = cursor.fetchone()
+    if lot:
+        cursor.execute("UPDATE product_lots SET quantity = quantity + ? WHERE id = ?", (quantity, lot[0]))
+    else:
+        add_lot(cursor, product_id, quantity, None, None, None)
+    refresh_product_expiry(cursor, product_id)
+    record_stock_movement(cursor, product_id, 'return', quantity, invoice_id)
+    return True, product_id
+
+# === 2.2 دفعات المنتجات وتواريخ انتهائها (FEFO) ===
+def add_lot(cursor, product_id, quantity, expiry_date, supplier, cost_price):
+    """تضيف دفعة جديدة ضمن المعاملة الحالية (الكمية الإجمالية في products يحدّثها المستدعي)."""
+    cursor.execute('''
+    INSERT INTO product_lots (product_id, quantity, expiry_date, supplier, cost_price, received_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ''', (product_id, quantity, expiry_date, supplier, cost_price, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    return cursor.lastrowid
+
+def consume_lots_fefo(cursor, product_id, quantity):
+    """تخصم الكمية من الدفعات الأقرب انتهاءً أولاً (الدفعات بلا تاريخ انتهاء تُخصم أخيرًا)."""
+    cursor.execute('''
+        SELECT id, quantity FROM product_lots
+        WHERE product_id = ? AND quantity > 0
+        ORDER BY expiry_date IS NULL, expiry_date, id
+    ''', (product_id,))
+    remaining = quantity
+    for lot_id, lot_qty in cursor.fetchall():
+        if remaining <= 0:
+            break
+        taken = min(lot_qty, remaining)
+        cursor.execute("UPDATE product_lots SET quantity = quantity - ? WHERE id = ?", (taken, lot_id))
+        remaining -= taken
+    return quantity - remaining
+
+def refresh_product_expiry(cursor, product_id):
+    """تجعل expiry_date في products أقرب تاريخ انتهاء بين الدفعات القائمة حتى تبقى الفلاتر الحالية صحيحة.
+    لا تكتب الصف إن لم يتغير التاريخ حتى لا يضيف سجل التغييرات صفًا بلا تغيير."""
+    cursor.execute('''
+        UPDATE products
+        SET expiry_date = (SELECT MIN(expiry_date) FROM product_lots WHERE product_id = ? AND quantity > 0)
+        WHERE id = ? AND EXISTS (SELECT 1 FROM product_lots WHERE product_id = ?)
+          AND expiry_date IS NOT (SELECT MIN(expiry_date) FROM product_lots WHERE product_id = ? AND quantity > 0)
+    ''', (product_id, product_id, product_id, product_id))
+
+@instrumented('db')
+def get_product_id_by_name(product_name):
     with db_context() as conn:
-        try:
-            conn.execute('''
-            UPDATE products 
-            SET name = ?, cost_price = ?, sell_price = ?, quantity = ?, expiry_date = ?, supplier = ?
-            WHERE id = ?
-            ''', (name, cost, sell, qty, expiry_str, supplier, product_id))
-            return True, ""
-        except sqlite3.IntegrityError:
-            return False, "اسم المنتج مستخدم مسبقًا."
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM products WHERE name = ?", (product_name,))
+        row = cursor.fetchone()
+        return row[0] if row else None
 
-def delete_employee_from_db(employee_id):
+@instrumented('db')
+def get_product_lots(product_id, include_empty=False):
+    """تجلب دفعات منتج مرتبة بترتيب البيع (FEFO)."""
     with db_context() as conn:
-        conn.execute("DELETE FROM employees WHERE id = ?", (employee_id,))
+        cursor = conn.cursor()
+        condition = "" if include_empty else " AND quantity > 0"
+        cursor.execute(f'''
+            SELECT id, quantity, expiry_date, supplier, cost_price, received_at
+            FROM product_lots
+            WHERE product_id = ?{condition}
+            ORDER BY expiry_date IS NULL, expiry_date, id
+        ''', (product_id,))
+        return [
+            {
+                'id': r[0], 'quantity': r[1], 'expiry_date': r[2],
+                'supplier': r[3], 'cost_price': r[4], 'received_at': r[5]
+            }
+            for r in cursor.fetchall()
+        ]
 
-def update_employee_in_db(employee_id, role, can_apply_discount, password=None):
+@instrumented('db')
+def get_expiring_lots(days=15, product_ids=None):
+    """تجلب الدفعات القائمة التي تنتهي صلاحيتها خلال عدد الأيام المحدد عبر الفهرس الجزئي.
+    product_ids يقصر النتيجة على منتجات محددة."""
+    today = date.today()
+    query = '''
+            SELECT p.name, l.quantity, l.expiry_date, l.supplier
+            FROM product_lots l
+            JOIN products p ON p.id = l.product_id
+            WHERE l.quantity > 0 AND l.expiry_date BETWEEN ? AND ?
+    '''
+    params = [today.isoformat(), (today + timedelta(days=days)).isoformat()]
+    if product_ids is not None:
+        query += " AND l.product_id IN (SELECT value FROM json_each(?))"
+        params.append(json.dumps(sorted(product_ids)))
+    with read_context() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query + " ORDER BY l.expiry_date", tuple(params))
+        return cursor.fetchall()
+
+# === 2.3 أرشفة المبيعات السنوية ===
+# السنوات المغلقة تنتقل إلى ملفات مستقلة بجانب قاعدة البيانات، فتبقى قاعدة البيع والنسخ الاحتياطي صغيرة.
+# جدول الإجماليات اليومية يبقى كاملًا في القاعدة الحية فلا تحتاج لوحة المدير إلى الأرشيف.
+def sales_archive_path(year):
+    base, _ = os.path.splitext(os.path.abspath(DB_NAME))
+    return f"{base}_sales_{year}.db"
+
+def attach_sales_archives(cursor, start_date=None, end_date=None):
+    """تربط ملفات الأرشيف التي تتقاطع سنواتها مع المدى وتعيد أسماء المخططات ('main' أولًا)."""
+    cursor.execute("SELECT year, file_name FROM sales_archives WHERE year BETWEEN ? AND ? ORDER BY year DESC",
+                   (int(start_date[:4]) if start_date else 0, int(end_date[:4]) if end_date else 9999))
+    db_dir = os.path.dirname(os.path.abspath(DB_NAME))
+    schemas = ['main']
+    archives = cursor.fetchall()
+    # ATTACH غير مسموح داخل معاملة: في اتصال اللقطة تُعاد المعاملة بعد الربط (لم يُقرأ منها إلا قائمة الأرشيفات)
+    in_snapshot = bool(archives) and cursor.connection.in_transaction
+    if in_snapshot:
+        cursor.execute("COMMIT")
+    for year, file_name in archives:
+        path = os.path.join(db_dir, file_name)
+        if not os.path.exists(path):
+            print(f"تحذير: ملف أرشيف مبيعات {year} غير موجود: {path}")
+            continue
+        cursor.execute(f"ATTACH DATABASE ? AS archive_{year}", (path,))
+        schemas.append(f"archive_{year}")
+    if in_snapshot:
+        cursor.execute("BEGIN")
+        cursor.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+    return schemas
+
+def union_sql(schemas, select_sql):
+    """تكرر الاستعلام لكل مخطط ({schema}) وتجمعها بـ UNION ALL؛ تُكرر المعاملات بعدد المخططات."""
+    return " UNION ALL ".join(select_sql.format(schema=schema) for schema in schemas)
+
+@instrumented('db')
+def get_sales_archives():
+    with db_context() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT year, file_name, line_count, invoice_count, archived_at FROM sales_archives ORDER BY year DESC")
+        return cursor.fetchall()
+
+@instrumented('db')
+def get_archivable_years():
+    """السنوات السابقة التي ما زالت مبيعاتها في القاعدة الحية."""
+    with db_context() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT DISTINCT substr(sale_time, 1, 4) FROM sales WHERE sale_time < ?", (f"{date.today().year}-01-01",))
+        return sorted(int(year) for year, in cursor.fetchall())
+
+@instrumented('db')
+def archive_sales_year(year):
+    """تنقل مبيعات وفواتير سنة مغلقة إلى ملف أرشيفها. تعيد (True, عدد الأسطر) أو (False, رسالة).
+    النقل دفعات صغيرة عبر الخيط الكاتب فلا تنتظر نقاط البيع أكثر من دفعة واحدة."""
+    if year >= date.today().year:
+        return False, "لا يمكن أرشفة السنة الحالية"
+    path = sales_archive_path(year)
+    alias = f"archive_{year}"
+    attach_to_writer(alias, path)
+    try:
+        if not execute_write(_prepare_sales_archive, year, alias, os.path.basename(path)):
+            return False, f"لا توجد مبيعات لسنة {year} في القاعدة الحالية"
+        moved_lines = 0
+        while True:
+            lines, invoices = execute_write(_archive_sales_batch, year, alias, ARCHIVE_BATCH_LINES)
+            if not lines and not invoices:
+                break
+            moved_lines += lines
+    finally:
+        detach_from_writer(alias)
+    # الصفحات المحررة تستردها مهمة الصيانة incremental_vacuum على دفعات؛ VACUUM كامل يحجب البيع طويلًا
+    return True, moved_lines
+
+def _prepare_sales_archive(cursor, year, alias, file_name):
+    """تنشئ جداول ملف الأرشيف وتسجله قبل أول دفعة، فترى التقارير كل سطر في مكان واحد أثناء النقل."""
+    cursor.execute("SELECT 1 FROM main.sales WHERE sale_time >= ? AND sale_time < ? LIMIT 1",
+                   (f"{year}-01-01", f"{year + 1}-01-01"))
+    if not cursor.fetchone():
+        return False
+    cursor.execute(f'''
+    CREATE TABLE IF NOT EXISTS {alias}.sales (
+        id INTEGER PRIMARY KEY,
+        invoice_id TEXT NOT NULL,
+        product_name TEXT NOT NULL,
+        sell_price REAL NOT NULL,
+        quantity INTEGER NOT NULL DEFAULT 1,
+        sale_time TEXT NOT NULL,
+        promotion_id INTEGER,
+        promotion_discount REAL NOT NULL DEFAULT 0,
+        shift_id INTEGER
+    )
+    ''')
+    # ملفات أرشيف أنشئت قبل تسجيل العروض والورديات على الأسطر
+    for col_def in ["promotion_id INTEGER", "promotion_discount REAL NOT NULL DEFAULT 0", "shift_id INTEGER"]:
+        try:
+            cursor.execute(f"ALTER TABLE {alias}.sales ADD COLUMN {col_def}")
+        except sqlite3.OperationalError:
+            pass
+    cursor.execute(f'''
+    CREATE TABLE IF NOT EXISTS {alias}.invoices (
+        invoice_id TEXT PRIMARY KEY,
+        created_at TEXT NOT NULL,
+        total REAL NOT NULL,
+        line_count INTEGER NOT NULL
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS {alias}.idx_sales_invoice ON sales(invoice_id)")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS {alias}.idx_sales_time ON sales(sale_time)")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS {alias}.idx_invoices_created ON invoices(created_at, invoice_id)")
+    cursor.execute('''
+    INSERT INTO sales_archives (year, file_name, line_count, invoice_count, archived_at) VALUES (?, ?, 0, 0, ?)
+    ON CONFLICT(year) DO UPDATE SET archived_at = excluded.archived_at
+    ''', (year, file_name, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    return True
+
+def _archive_sales_batch(cursor, year, alias, limit):
+    """تنقل حتى limit سطر مبيعات وlimit فاتورة من السنة. تعيد (الأسطر المنقولة، الفواتير المنقولة)."""
+    start, end = f"{year}-01-01", f"{year + 1}-01-01"
+    cursor.execute("SELECT id FROM main.sales WHERE sale_time >= ? AND sale_time < ? LIMIT ?", (start, end, limit))
+    line_ids = json.dumps([row[0] for row in cursor.fetchall()])
+    cursor.execute("SELECT invoice_id FROM main.invoices WHERE created_at >= ? AND created_at < ? LIMIT ?", (start, end, limit))
+    invoice_ids = json.dumps([row[0] for row in cursor.fetchall()])
+
+    # OR IGNORE يجعل إعادة الأرشفة آمنة إن انقطعت عملية سابقة بعد النسخ وقبل الحذف
+    cursor.execute(f'''
+    INSERT OR IGNORE INTO {alias}.sales (id, invoice_id, product_name, sell_price, quantity, sale_time, promotion_id, promotion_discount, shift_id)
+    SELECT id, invoice_id, product_name, sell_price, quantity, sale_time, promotion_id, promotion_discount, shift_id FROM main.sales
+    WHERE id IN (SELECT value FROM json_each(?))
+    ''', (line_ids,))
+    cursor.execute(f'''
+    INSERT OR IGNORE INTO {alias}.invoices (invoice_id, created_at, total, line_count)
+    SELECT invoice_id, created_at, total, line_count FROM main.invoices
+    WHERE invoice_id IN (SELECT value FROM json_each(?))
+    ''', (invoice_ids,))
+    cursor.execute('''
+    INSERT INTO archived_product_sales (product_name, quantity)
+    SELECT product_name, SUM(quantity) FROM main.sales WHERE id IN (SELECT value FROM json_each(?)) GROUP BY product_name
+    ON CONFLICT(product_name) DO UPDATE SET quantity = quantity + excluded.quantity
+    ''', (line_ids,))
+
+    last_change = cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM main.change_log").fetchone()[0]
+    cursor.execute("INSERT OR REPLACE INTO main.app_settings (key, value) VALUES (?, 'true')", (ARCHIVE_MOVE_FLAG,))
+    cursor.execute("DELETE FROM main.sales WHERE id IN (SELECT value FROM json_each(?))", (line_ids,))
+    moved_lines = cursor.rowcount
+    cursor.execute("DELETE FROM main.app_settings WHERE key = ?", (ARCHIVE_MOVE_FLAG,))
+    # نقل الأسطر إلى الأرشيف ليس حذفًا تجاريًا، فلا يظهر في تصدير التغييرات
+    cursor.execute("DELETE FROM main.change_log WHERE seq > ? AND table_name = 'sales' AND op = 'delete'", (last_change,))
+    cursor.execute("DELETE FROM main.invoices WHERE invoice_id IN (SELECT value FROM json_each(?))", (invoice_ids,))
+    moved_invoices = cursor.rowcount
+    if moved_lines or moved_invoices:
+        cursor.execute('''
+        UPDATE sales_archives SET line_count = line_count + ?, invoice_count = invoice_count + ?, archived_at = ?
+        WHERE year = ?
+        ''', (moved_lines, moved_invoices, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), year))
+    return moved_lines, moved_invoices
+
+# === 2.4 ذاكرة التقارير للفترات المغلقة ===
+def cached_report(report, period, compute, params=None):
+    """تعيد نتيجة التقرير من الذاكرة إن كانت الفترة مغلقة (قبل اليوم)، وإلا تحسبها مباشرة.
+    النتيجة قائمة صفوف (tuples) قابلة للتحويل إلى JSON."""
+    if period >= date.today().isoformat():
+        return compute()
+    key = (report, period, json.dumps(params, sort_keys=True), REPORT_CACHE_SCHEMA_VERSION)
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     with db_context() as conn:
-        if password:
-            conn.execute("UPDATE employees SET role = ?, password = ?, can_apply_discount = ? WHERE id = ?", (role, password, can_apply_discount, employee_id))
+        cursor = conn.cursor()
+        cursor.execute("SELECT payload FROM report_cache WHERE report = ? AND period = ? AND params = ? AND schema_version = ?", key)
+        row = cursor.fetchone()
+    # تحديث الذاكرة لا يحتاج أن ينتظره القارئ
+    if row:
+        submit_write(_touch_report_cache, key, now)
+        return [tuple(r) for r in json.loads(row[0])]
+
+    rows = compute()
+    submit_write(_store_report_cache, key, json.dumps(rows), now)
+    return [tuple(r) for r in rows]
+
+def _touch_report_cache(cursor, key, now):
+    cursor.execute("UPDATE report_cache SET last_used_at = ? WHERE report = ? AND period = ? AND params = ? AND schema_version = ?",
+                   (now,) + key)
+
+def _store_report_cache(cursor, key, payload, now):
+    cursor.execute("INSERT OR REPLACE INTO report_cache (report, period, params, schema_version, payload, last_used_at) VALUES (?, ?, ?, ?, ?, ?)",
+                   key + (payload, now))
+    # إخراج الأقل استخدامًا حديثًا (LRU) عند تجاوز الحد
+    cursor.execute('''
+        DELETE FROM report_cache WHERE (report, period, params, schema_version) IN (
+            SELECT report, period, params, schema_version FROM report_cache
+            ORDER BY last_used_at LIMIT max(0, (SELECT COUNT(*) FROM report_cache) - ?)
+        )
+    ''', (REPORT_CACHE_MAX_ENTRIES,))
+
+def clear_report_cache():
+    execute_write(_clear_report_cache)
+
+def _clear_report_cache(cursor):
+    cursor.execute("DELETE FROM report_cache")
+
+# === 2.5 الصيانة الدورية ===
+# تعمل في خيط خلفي على اتصال مستقل وفقط عند الهدوء. كل مهمة محدودة بـ MAINTENANCE_TIME_BOX_MS
+# عبر معالج التقدم، الذي يقطعها أيضًا فور وصول عملية بيع إلى طابور الكتابة.
+maintenance_state = {'thread': None, 'running': threading.Lock()}
+
+def writer_is_idle():
+    return write_queue.qsize() == 0 and time.time() - writer_stats['last_write_at'] >= MAINTENANCE_IDLE_SECONDS
+
+def run_maintenance_task(task, time_box_ms=None):
+    """تنفذ مهمة صيانة واحدة وتسجلها في maintenance_log. تعيد قاموس نتيجة التشغيل."""
+    if time_box_ms is None:
+        time_box_ms = MAINTENANCE_TASK_TIME_BOX_MS.get(task, MAINTENANCE_TIME_BOX_MS)
+    conn = connect_db(isolation_level=None)
+    started_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    started = time.perf_counter()
+    deadline = started + time_box_ms / 1000
+    if task in MAINTENANCE_READ_ONLY_TASKS:
+        conn.set_progress_handler(lambda: int(time.perf_counter() > deadline), 1000)
+    else:
+        conn.set_progress_handler(lambda: int(time.perf_counter() > deadline or write_queue.qsize() > 0), 1000)
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    pages_before = conn.execute("PRAGMA page_count").fetchone()[0]
+    freelist_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    status, detail = 'ok', None
+    try:
+        if task == 'optimize':
+            conn.execute("PRAGMA optimize")
+        elif task == 'analyze':
+            # إحصاءات تقريبية من عينة محدودة لكل فهرس تكفي المخطط وتبقى سريعة على القواعد الكبيرة
+            conn.execute("PRAGMA analysis_limit = 1000")
+            conn.execute("ANALYZE")
+        elif task == 'incremental_vacuum':
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                detail = "التفريغ التدريجي غير مفعّل في هذه القاعدة"
+            while conn.execute("PRAGMA freelist_count").fetchone()[0] and time.perf_counter() < deadline:
+                conn.execute(f"PRAGMA incremental_vacuum({MAINTENANCE_VACUUM_STEP_PAGES})").fetchall()
+        elif task == 'wal_checkpoint':
+            busy, wal_frames, checkpointed = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+            detail = f"busy={busy} wal_frames={wal_frames} checkpointed={checkpointed}"
+        elif task == 'quick_check':
+            problems = [msg for msg, in conn.execute("PRAGMA quick_check(20)")]
+            if problems != ['ok']:
+                status, detail = 'error', "\n".join(problems)
+        elif task == 'prune_change_log':
+            # لا يُحذف إلا ما صدّره كل المستهلكين المسجلين؛ بلا مستهلكين تسري مدة الاحتفاظ وحدها
+            # لأن المستهلك الجديد يبدأ دائمًا بلقطة كاملة
+            deleted = conn.execute('''
+                DELETE FROM change_log
+                WHERE seq <= COALESCE((SELECT MIN(last_seq) FROM sync_cursors), (SELECT MAX(seq) FROM change_log))
+                AND changed_at < datetime('now', 'localtime', ?)
+            ''', (f"-{CHANGE_LOG_RETENTION_DAYS} days",)).rowcount
+            detail = f"deleted={deleted}"
         else:
-            conn.execute("UPDATE employees SET role = ?, can_apply_discount = ? WHERE id = ?", (role, can_apply_discount, employee_id))
+            raise ValueError(f"مهمة صيانة غير معروفة: {task}")
+    except sqlite3.OperationalError as e:
+        status = 'interrupted' if 'interrupt' in str(e) else 'error'
+        detail = str(e)
+    finally:
+        pages_after = conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist_after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        conn.close()
+    entry = {
+        'task': task, 'started_at': started_at, 'duration_ms': round((time.perf_counter() - started) * 1000, 3),
+        'status': status, 'pages_before': pages_before, 'pages_after': pages_after,
+        'freelist_before': freelist_before, 'freelist_after': freelist_after,
+        'reclaimed_bytes': (pages_before - pages_after) * page_size, 'detail': detail,
+    }
+    submit_write(_log_maintenance, entry)
+    return entry
+
+def _log_maintenance(cursor, entry):
+    cursor.execute('''
+        INSERT INTO maintenance_log (task, started_at, duration_ms, status, pages_before, pages_after,
+                                     freelist_before, freelist_after, reclaimed_bytes, detail)
+        VALUES (:task, :started_at, :duration_ms, :status, :pages_before, :pages_after,
+                :freelist_before, :freelist_after, :reclaimed_bytes, :detail)
+    ''', entry)
+    # أطول فاصل بين تشغيلين يوم واحد، فالسجل الأقدم من مدة الاحتفاظ لا يلزم الجدولة
+    cursor.execute("DELETE FROM maintenance_log WHERE started_at < datetime('now', 'localtime', ?)",
+                   (f"-{MAINTENANCE_LOG_RETENTION_DAYS} days",))
+
+@instrumented('db')
+def get_maintenance_log(limit=100):
+    with db_context() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT started_at, task, status, duration_ms, reclaimed_bytes, freelist_before, freelist_after, detail
+            FROM maintenance_log ORDER BY id DESC LIMIT ?
+        ''', (limit,))
+        return cursor.fetchall()
+
+def get_auto_vacuum_mode():
+    """0 = بلا، 1 = كامل، 2 = تدريجي."""
+    with db_context() as conn:
+        return conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+
+def convert_to_incremental_vacuum():
+    """تحويل لمرة واحدة لقاعدة قديمة إلى التفريغ التدريجي. يحتاج VACUUM كاملًا يحجز قفل الكتابة حتى ينتهي
+    ومساحة حرة بقدر ضعف حجم القاعدة، فيُشغَّل يدويًا خارج ساعات البيع. تعيد (نجاح، رسالة)."""
+    size = sum(os.path.getsize(DB_NAME + suffix) for suffix in ("", "-wal") if os.path.exists(DB_NAME + suffix))
+    free = shutil.disk_usage(os.path.dirname(os.path.abspath(DB_NAME))).free
+    if free < 2 * size:
+        return False, f"المساحة الحرة ({free // 2**20} MB) أقل من ضعف حجم القاعدة ({size // 2**20} MB)"
+    conn = connect_db(isolation_level=None)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return True, "التفريغ التدريجي مفعّل مسبقًا"
+        started = time.perf_counter()
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+    return True, f"تم التحويل في {time.perf_counter() - started:.1f} ثانية"
+
+def maintenance_task_due(interval, last_ok, last_attempt, failures):
+    """حان وقت المهمة إذا مضى فاصلها على آخر نجاح؛ وبعد الفشل تُنتظر مهلة تتضاعف مع كل محاولة فاشلة."""
+    now = datetime.now()
+    if last_ok and (now - datetime.strptime(last_ok, "%Y-%m-%d %H:%M:%S")).total_seconds() < interval:
+        return False
+    if not failures:
         return True
+    retry_after = min(interval, MAINTENANCE_RETRY_SECONDS * 2 ** (failures - 1))
+    return (now - datetime.strptime(last_attempt, "%Y-%m-%d %H:%M:%S")).total_seconds() >= retry_after
 
-def update_user_credentials(old_username, new_username=None, new_password=None):
-    if not new_username and not new_password:
-        return True, ""
+def run_due_maintenance(force=False):
+    """تشغل المهام التي حان وقتها ما دامت القاعدة هادئة."""
+    if not maintenance_state['running'].acquire(blocking=False):
+        return []
+    try:
+        with db_context() as conn:
+            # لكل مهمة: آخر نجاح، وآخر محاولة، وعدد المحاولات الفاشلة بعد آخر نجاح
+            history = {task: rest for task, *rest in conn.execute('''
+                SELECT task, last_ok, MAX(started_at), SUM(status != 'ok' AND started_at >= COALESCE(last_ok, ''))
+                FROM maintenance_log
+                JOIN (SELECT task, MAX(CASE WHEN status = 'ok' THEN started_at END) AS last_ok FROM maintenance_log GROUP BY task)
+                USING (task)
+                GROUP BY task
+            ''')}
+        results = []
+        for task, interval in MAINTENANCE_TASKS.items():
+            due = maintenance_task_due(interval, *history.get(task, (None, None, 0)))
+            if force or (due and writer_is_idle()):
+                results.append(run_maintenance_task(task))
+        return results
+    finally:
+        maintenance_state['running'].release()
+
+def start_maintenance_scheduler():
+    if maintenance_state['thread'] and maintenance_state['thread'].is_alive():
+        return
+    def maintenance_loop():
+        while True:
+            time.sleep(MAINTENANCE_CHECK_INTERVAL)
+            try:
+                run_due_maintenance()
+            except sqlite3.Error as e:
+                print(f"تحذير: فشلت الصيانة الدورية: {e}")
+    maintenance_state['thread'] = threading.Thread(target=maintenance_loop, name="db-maintenance", daemon=True)
+    maintenance_state['thread'].start()
+
+# === 2.6 المخزون المنخفض واقتراحات إعادة الطلب ===
+def stock_tags(quantity, threshold):
+    if quantity <= 0:
+        return ('out_of_stock',)
+    if quantity <= threshold:
+        return ('low_stock',)
+    return ()
+
+@instrumented('db')
+def get_low_stock_products():
+    """المنتجات التي بلغت حد إعادة الطلب؛ الشرط نفسه شرط الفهرس الجزئي فلا يُمسح جدول المنتجات."""
+    with read_context() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, name, quantity, reorder_threshold, supplier, cost_price FROM products
+            WHERE quantity <= reorder_threshold
+            ORDER BY supplier, quantity
+        ''')
+        return [
+            {'id': r[0], 'name': r[1], 'quantity': r[2], 'reorder_threshold': r[3], 'supplier': r[4], 'cost_price': r[5]}
+            for r in cursor.fetchall()
+        ]
+
+def set_reorder_threshold(product_id, threshold):
+    execute_write(_set_reorder_threshold, product_id, threshold)
+    publish('product_changed', ids={product_id})
 
+def _set_reorder_threshold(cursor, product_id, threshold):
+    cursor.execute("UPDATE products SET reorder_threshold = ? WHERE id = ?", (threshold, product_id))
+
+def get_supplier_lead_times():
     with db_context() as conn:
-        updates = []
-        params = []
-        if new_username:
-            updates.append("name = ?")
-            params.append(new_username)
-        if new_password:
-            updates.append("password = ?")
-            params.append(new_password)
-        
-        params.append(old_username)
-        query = f"UPDATE employees SET {', '.join(updates)} WHERE name = ?"
-        
-        try:
-            conn.execute(query, tuple(params))
-            return True, ""
-        except sqlite3.IntegrityError:
-            return False, "اسم المستخدم الجديد مستخدم مسبقًا."
+        return dict(conn.execute("SELECT supplier, lead_time_days FROM supplier_lead_times"))
+
+def set_supplier_lead_time(supplier, days):
+    execute_write(_set_supplier_lead_time, supplier, days)
+
+def _set_supplier_lead_time(cursor, supplier, days):
+    cursor.execute("INSERT INTO supplier_lead_times (supplier, lead_time_days) VALUES (?, ?) "
+                   "ON CONFLICT(supplier) DO UPDATE SET lead_time_days = excluded.lead_time_days", (supplier, days))
+
+@instrumented('db')
+def get_sales_velocity(product_ids, days=VELOCITY_WINDOW_DAYS):
+    """متوسط البيع اليومي وانحرافه المعياري لكل منتج من سجل حركات المخزون خلال آخر days يومًا.
+    السرعة هي الأكبر بين المتوسط القصير (VELOCITY_SHORT_DAYS) والطويل حتى يُلحق الطلب المتصاعد.
+    تعيد {product_id: (السرعة، الانحراف)}."""
+    product_ids = sorted(product_ids)
+    if not product_ids:
+        return {}
+    today = date.today()
+    with read_context() as conn:
+        cursor = conn.cursor()
+        # عمر اليوم بالأيام (0 = اليوم) مع الكمية المباعة فيه لكل منتج
+        cursor.execute('''
+            SELECT product_id, CAST(julianday(?) - julianday(substr(moved_at, 1, 10)) AS INTEGER), -SUM(quantity_change)
+            FROM stock_movements
+            WHERE movement_type = 'sale' AND moved_at >= ? AND product_id IN (SELECT value FROM json_each(?))
+            GROUP BY product_id, substr(moved_at, 1, 10)
+        ''', (today.isoformat(), (today - timedelta(days=days - 1)).isoformat(), json.dumps(product_ids)))
+        rows = cursor.fetchall()
+    short_days = min(VELOCITY_SHORT_DAYS, days)
+    if not numpy_available:
+        totals, recent = {}, {}
+        for product_id, age, qty in rows:
+            totals[product_id] = totals.get(product_id, 0) + qty
+            if age < short_days:
+                recent[product_id] = recent.get(product_id, 0) + qty
+        return {pid: (max(totals.get(pid, 0) / days, recent.get(pid, 0) / short_days), 0.0) for pid in product_ids}
+
+    ids = np.array(product_ids)
+    daily = np.zeros((len(ids), days))
+    if rows:
+        data = np.array(rows, dtype=float)
+        np.add.at(daily, (np.searchsorted(ids, data[:, 0].astype(ids.dtype)), data[:, 1].astype(int)), data[:, 2])
+    velocity = np.maximum(daily.mean(axis=1), daily[:, :short_days].mean(axis=1))
+    deviation = daily.std(axis=1)
+    return {int(pid): (float(v), float(sd)) for pid, v, sd in zip(ids, velocity, deviation)}
+
+@instrumented('db')
+def get_reorder_suggestions():
+    """اقتراحات الطلب مجمعة حسب المورد: {المورد: [منتجات مرتبة بأيام التغطية]}.
+    الكمية المقترحة تكفي مدة التوريد + REORDER_COVER_DAYS مع مخزون أمان، ولا تقل عن تجاوز حد الطلب."""
+    products = get_low_stock_products()
+    lead_times = get_supplier_lead_times()
+    velocities = get_sales_velocity(p['id'] for p in products)
+    groups = {}
+    for p in products:
+        velocity, deviation = velocities[p['id']]
+        lead_time = lead_times.get(p['supplier'], DEFAULT_LEAD_TIME_DAYS)
+        on_hand = max(p['quantity'], 0)
+        safety_stock = SAFETY_STOCK_Z * deviation * (lead_time ** 0.5)
+        order_up_to = max(math.ceil(velocity * (lead_time + REORDER_COVER_DAYS) + safety_stock), p['reorder_threshold'] + 1)
+        groups.setdefault(p['supplier'], []).append(dict(
+            p,
+            velocity=round(velocity, 2),
+            days_of_cover=round(on_hand / velocity, 1) if velocity else None,
+            lead_time_days=lead_time,
+            suggested_quantity=max(order_up_to - on_hand, 0),
+        ))
+    for items in groups.values():
+        items.sort(key=lambda item: math.inf if item['days_of_cover'] is None else item['days_of_cover'])
+    return groups
+
+@instrumented('export')
+def export_purchase_orders(groups, filepath):
+    """أمر شراء لكل مورد في ورقة مستقلة من ملف Excel."""
+    wb = Workbook()
+    wb.remove(wb.active)
+    for supplier, items in groups.items():
+        title = "".join(ch for ch in (supplier or "بدون مورد") if ch not in '[]:*?/\\')[:31] or "مورد"
+        ws = wb.create_sheet(title=title if title not in wb.sheetnames else f"{title[:27]} ({len(wb.sheetnames)})")
+        ws.sheet_view.rightToLeft = True
+        ws.append(["أمر شراء", supplier or "بدون مورد", date.today().isoformat()])
+        ws.append([])
+        ws.append(["المنتج", "الكمية الحالية", "حد الطلب", "متوسط البيع اليومي", "أيام التغطية", "مدة التوريد", "الكمية المطلوبة", "سعر الشراء", "الإجمالي"])
+        total = 0
+        for item in items:
+            line_total = item['suggested_quantity'] * item['cost_price']
+            total += line_total
+            ws.append([item['name'], item['quantity'], item['reorder_threshold'], item['velocity'], item['days_of_cover'],
+                       item['lead_time_days'], item['suggested_quantity'], item['cost_price'], line_total])
+        ws.append([])
+        ws.append(["", "", "", "", "", "", "", "الإجمالي:", total])
+    if not wb.sheetnames:
+        return False
+    wb.save(filepath)
+    return True
+
+# === 2.7 تحليلات المخزون ===
+@instrumented('db')
+def get_inventory_analytics(days=ANALYTICS_WINDOW_DAYS):
+    """تصنيف ABC وهوامش الربح ونسب التصريف والمخزون الراكد لكل المنتجات خلال آخر days يومًا.
+    التجميع على أسطر المبيعات (مع الأرشيف) يتم في SQLite، ثم تُحمّل النتيجة أعمدةً في مصفوفات NumPy
+    وتُحسب كل المؤشرات بعمليات متجهة دون حلقات على المنتجات. تتطلب NumPy."""
+    today = date.today()
+    start = (today - timedelta(days=days - 1)).isoformat()
+    with read_context() as conn:
+        cursor = conn.cursor()
+        schemas = attach_sales_archives(cursor, start)
+        lines = union_sql(schemas, "SELECT product_name, sell_price * quantity AS revenue, quantity, sale_time "
+                                   "FROM {schema}.sales WHERE sale_time >= ?")
+        cursor.execute(f'''
+            SELECT p.name, p.quantity, p.cost_price, p.sell_price,
+                   COALESCE(s.revenue, 0), COALESCE(s.units, 0),
+                   COALESCE(julianday(?) - julianday(substr(s.last_sale, 1, 10)), -1)
+            FROM products p
+            LEFT JOIN (
+                SELECT product_name, SUM(revenue) AS revenue, SUM(quantity) AS units, MAX(sale_time) AS last_sale
+                FROM ({lines}) GROUP BY product_name
+            ) s ON s.product_name = p.name
+        ''', (today.isoformat(),) + (start,) * len(schemas))
+        columns = list(zip(*cursor.fetchall()))
+    if not columns:
+        columns = [()] * 7
+    names = np.array(columns[0], dtype=object)
+    on_hand, cost, price, revenue, units, idle_days = np.array(columns[1:], dtype=float).reshape(6, -1)
+    idle_days[idle_days < 0] = np.inf  # لم يُبع خلال الفترة
+    total_revenue = revenue.sum()
+
+    # ABC: ترتيب تنازلي بالإيراد؛ المنتج في الفئة التي يقع فيها الإيراد التراكمي قبله
+    order = np.argsort(-revenue, kind='stable')
+    share_before = (np.cumsum(revenue[order]) - revenue[order]) / total_revenue if total_revenue else np.ones(len(order))
+    ranked_class = np.select([share_before < ABC_CLASS_LIMITS[0], share_before < ABC_CLASS_LIMITS[1]], ['A', 'B'], 'C')
+    ranked_class[revenue[order] <= 0] = 'C'
+    abc_class = np.empty(len(order), dtype='<U1')
+    abc_class[order] = ranked_class
+
+    stock = np.maximum(on_hand, 0)
+    gross_profit = revenue - cost * units
+    realized_margin = np.divide(gross_profit, revenue, out=np.full(len(revenue), np.nan), where=revenue > 0)
+    list_margin = np.divide(price - cost, price, out=np.full(len(price), np.nan), where=price > 0)
+    sell_through = np.divide(units, units + stock, out=np.full(len(units), np.nan), where=(units + stock) > 0)
+    dead = (stock > 0) & (idle_days > DEAD_STOCK_DAYS)
+    below_target = list_margin < TARGET_MARGIN
+
+    def idle(value):
+        return None if math.isinf(value) else int(value)
+
+    valid_margins = list_margin[~np.isnan(list_margin)]
+    histogram, _ = np.histogram(realized_margin[~np.isnan(realized_margin)], bins=MARGIN_BINS)
+    dead_order = np.flatnonzero(dead)[np.argsort(-(stock * cost)[dead], kind='stable')]
+    margin_order = np.flatnonzero(below_target)[np.argsort(list_margin[below_target], kind='stable')]
+    stocked = np.flatnonzero(stock > 0)
+    through_order = stocked[np.argsort(sell_through[stocked], kind='stable')]
+    return {
+        'window_days': days,
+        'total_revenue': float(total_revenue),
+        'abc': [(names[i], str(abc_class[i]), float(revenue[i]), float(units[i])) for i in order],
+        'abc_summary': {
+            cls: (int((abc_class == cls).sum()), float(revenue[abc_class == cls].sum()),
+                  float(revenue[abc_class == cls].sum() / total_revenue) if total_revenue else 0.0)
+            for cls in 'ABC'
+        },
+        'dead_stock': [(names[i], int(stock[i]), float(stock[i] * cost[i]), idle(idle_days[i])) for i in dead_order],
+        'dead_stock_value': float((stock * cost)[dead].sum()),
+        'low_margin': [(names[i], float(list_margin[i]), None if np.isnan(realized_margin[i]) else float(realized_margin[i]),
+                        float(gross_profit[i])) for i in margin_order],
+        'margin_percentiles': dict(zip((10, 25, 50, 75, 90), np.percentile(valid_margins, (10, 25, 50, 75, 90)).tolist()))
+                              if len(valid_margins) else {},
+        'margin_histogram': list(zip(MARGIN_BINS[:-1], MARGIN_BINS[1:], histogram.tolist())),
+        'sell_through': [(names[i], int(units[i]), int(stock[i]), float(sell_through[i])) for i in through_order],
+    }
+
+# === 2.8 فهرس الباركود في الذاكرة ===
+# يُحمّل مرة عند أول مسح ثم يُحدَّث من أحداث المنتجات والمخزون، فلا يلمس المسح قاعدة البيانات.
+# لكل رمز: (المنتج، عدد القطع التي يمثلها الرمز).
+barcode_index = {'loaded': False, 'codes': {}, 'by_product': {}}
+
+def index_products(products, product_codes=None):
+    """تفهرس المنتجات برموزها من product_barcodes؛ product_codes محمّلة مسبقًا عند التحميل الكامل."""
+    products = list(products)
+    if product_codes is None:
+        product_codes = get_product_barcodes({p['id'] for p in products})
+    codes, by_product = barcode_index['codes'], barcode_index['by_product']
+    for p in products:
+        unindex_products([p['id']])
+        entry = {'id': p['id'], 'name': p['name'], 'sell_price': p['sell_price'], 'quantity': p['quantity']}
+        by_product[p['id']] = [code for code, _ in product_codes.get(p['id'], ())]
+        for code, pack_qty in product_codes.get(p['id'], ()):
+            codes[code] = (entry, pack_qty)
+
+def unindex_products(product_ids):
+    for product_id in product_ids:
+        for code in barcode_index['by_product'].pop(product_id, ()):
+            barcode_index['codes'].pop(code, None)
+
+def lookup_barcode(code):
+    """تعيد (المنتج، عدد القطع) للرمز أو None."""
+    if not barcode_index['loaded']:
+        barcode_index['loaded'] = True
+        index_products(get_products_filtered(), get_product_barcodes())
+    found = barcode_index['codes'].get(code)
+    if found is None:
+        # منتج أضيف من جهاز آخر بعد تحميل الفهرس
+        product = get_product_by_barcode(code)
+        if product:
+            index_products(get_products_by_ids({product['id']}))
+            found = barcode_index['codes'].get(code)
+    return found
+
+def on_products_changed_for_index(event):
+    if not barcode_index['loaded']:
+        return
+    deleted = event.get('deleted', set())
+    unindex_products(deleted)
+    index_products(get_products_by_ids(event.get('ids', set()) - deleted))
+
+subscribe('product_changed', on_products_changed_for_index)
+subscribe('stock_changed', on_products_changed_for_index)
+
+# === 2.9 العروض وقواعد التسعير ===
+# القواعد النشطة تُترجم مرة إلى جدول لكل منتج (قواعد المنتج + قواعد مورده)، فتسعير السلة O(عدد الأسطر).
+# يُطبق على السطر أفضل عرض واحد متاح (بلا تراكب). الجدول يُحدَّث من أحداث العروض والمنتجات.
+PROMOTION_TYPES = {
+    'buy_x_get_y': "اشترِ X واحصل على Y مجانًا",
+    'bundle_price': "X قطع بسعر",
+    'percent_off': "خصم نسبة مئوية",
+}
+pricing_engine = {'loaded': False, 'rules': {}, 'product_ids': {}, 'by_product': {}, 'by_supplier': {}, 'promotions': {}}
+
+def get_promotions():
+    with db_context() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT pr.id, pr.name, pr.rule_type, pr.product_id, p.name, pr.supplier, pr.buy_qty, pr.get_qty, pr.amount,
+                   pr.starts_at, pr.ends_at, pr.daily_start, pr.daily_end, pr.max_applications, pr.max_discount, pr.active
+            FROM promotions pr LEFT JOIN products p ON p.id = pr.product_id
+            ORDER BY pr.active DESC, pr.id DESC
+        ''')
+        keys = ('id', 'name', 'rule_type', 'product_id', 'product_name', 'supplier', 'buy_qty', 'get_qty', 'amount',
+                'starts_at', 'ends_at', 'daily_start', 'daily_end', 'max_applications', 'max_discount', 'active')
+        return [dict(zip(keys, r)) for r in cursor.fetchall()]
+
+def add_promotion(name, rule_type, product_id=None, supplier=None, buy_qty=None, get_qty=None, amount=None,
+                  starts_at=None, ends_at=None, daily_start=None, daily_end=None, max_applications=None, max_discount=None):
+    if rule_type not in PROMOTION_TYPES:
+        raise ValueError(f"نوع عرض غير معروف: {rule_type}")
+    promotion_id = execute_write(_add_promotion, (name, rule_type, product_id, supplier, buy_qty, get_qty, amount,
+                                                  starts_at, ends_at, daily_start, daily_end, max_applications, max_discount))
+    publish('promotions_changed', ids={promotion_id})
+    return promotion_id
+
+def _add_promotion(cursor, values):
+    cursor.execute('''
+        INSERT INTO promotions (name, rule_type, product_id, supplier, buy_qty, get_qty, amount, starts_at, ends_at,
+                                daily_start, daily_end, max_applications, max_discount)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', values)
+    return cursor.lastrowid
+
+def set_promotion_active(promotion_id, active):
+    execute_write(_set_promotion_active, promotion_id, active)
+    publish('promotions_changed', ids={promotion_id})
+
+def _set_promotion_active(cursor, promotion_id, active):
+    cursor.execute("UPDATE promotions SET active = ? WHERE id = ?", (int(active), promotion_id))
+
+def delete_promotion(promotion_id):
+    execute_write(_delete_promotion, promotion_id)
+    publish('promotions_changed', ids={promotion_id})
+
+def _delete_promotion(cursor, promotion_id):
+    cursor.execute("DELETE FROM promotions WHERE id = ?", (promotion_id,))
+
+def compile_promotions():
+    """تحمّل العروض النشطة غير المنتهية وتبني جدول القواعد لكل منتج."""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    by_product, by_supplier, promotions = {}, {}, {}
+    for rule in get_promotions():
+        if not rule['active'] or (rule['ends_at'] and rule['ends_at'] < now):
+            continue
+        promotions[rule['id']] = rule
+        if rule['product_id'] is not None:
+            by_product.setdefault(rule['product_id'], []).append(rule)
+        elif rule['supplier']:
+            by_supplier.setdefault(rule['supplier'], []).append(rule)
+    pricing_engine.update(by_product=by_product, by_supplier=by_supplier, promotions=promotions, rules={}, product_ids={}, loaded=True)
+    with db_context() as conn:
+        compile_product_rules(conn.execute("SELECT id, name, supplier FROM products"))
+
+def compile_product_rules(products):
+    rules, product_ids = pricing_engine['rules'], pricing_engine['product_ids']
+    for product_id, name, supplier in products:
+        product_ids[name] = product_id
+        applicable = pricing_engine['by_product'].get(product_id, []) + pricing_engine['by_supplier'].get(supplier, [])
+        if applicable:
+            rules[product_id] = tuple(applicable)
+        else:
+            rules.pop(product_id, None)
+
+def on_products_changed_for_pricing(event):
+    if not pricing_engine['loaded']:
+        return
+    deleted = event.get('deleted', set())
+    for product_id in deleted:
+        pricing_engine['rules'].pop(product_id, None)
+    for name in [name for name, pid in pricing_engine['product_ids'].items() if pid in deleted | event.get('ids', set())]:
+        del pricing_engine['product_ids'][name]
+    with db_context() as conn:
+        compile_product_rules(conn.execute("SELECT id, name, supplier FROM products WHERE id IN (SELECT value FROM json_each(?))",
+                                           (json.dumps(sorted(event.get('ids', set()) - deleted)),)))
+
+def on_promotions_changed(event):
+    pricing_engine['loaded'] = False
+
+subscribe('product_changed', on_products_changed_for_pricing)
+subscribe('promotions_changed', on_promotions_changed)
+
+def promotion_in_window(rule, now):
+    """now بصيغة YYYY-MM-DD HH:MM:SS؛ الساعات اليومية قد تعبر منتصف الليل."""
+    if (rule['starts_at'] and now < rule['starts_at']) or (rule['ends_at'] and now > rule['ends_at']):
+        return False
+    if rule['daily_start'] and rule['daily_end']:
+        clock = now[11:16]
+        if rule['daily_start'] <= rule['daily_end']:
+            return rule['daily_start'] <= clock < rule['daily_end']
+        return clock >= rule['daily_start'] or clock < rule['daily_end']
+    return True
+
+def promotion_discount(rule, unit_price, quantity):
+    kind = rule['rule_type']
+    if kind == 'buy_x_get_y':
+        applications = quantity // (rule['buy_qty'] + rule['get_qty'])
+        per_application = rule['get_qty'] * unit_price
+    elif kind == 'bundle_price':
+        applications = quantity // rule['buy_qty']
+        per_application = rule['buy_qty'] * unit_price - rule['amount']
+    else:
+        applications = quantity
+        per_application = unit_price * rule['amount'] / 100
+    if rule['max_applications'] is not None:
+        applications = min(applications, rule['max_applications'])
+    discount = max(applications * per_application, 0)
+    if rule['max_discount'] is not None:
+        discount = min(discount, rule['max_discount'])
+    return discount
+
+def price_line(product_id, unit_price, quantity, now=None):
+    """أفضل عرض للسطر: (رقم العرض، قيمة الخصم) أو (None, 0)."""
+    if not pricing_engine['loaded']:
+        compile_promotions()
+    now = now or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    best = (None, 0)
+    for rule in pricing_engine['rules'].get(product_id, ()):
+        if promotion_in_window(rule, now):
+            discount = round(promotion_discount(rule, unit_price, quantity), 2)
+            if discount > best[1]:
+                best = (rule['id'], discount)
+    return best
+
+def price_cart(cart):
+    """[(رقم العرض، قيمة الخصم)] لكل سطر بنفس ترتيب السلة."""
+    if not pricing_engine['loaded']:
+        compile_promotions()
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    product_ids = pricing_engine['product_ids']
+    return [price_line(item.get('product_id') or product_ids.get(item['name']), item['price'], item['quantity'], now)
+            for item in cart]
+
+def promotion_name(promotion_id):
+    rule = pricing_engine['promotions'].get(promotion_id)
+    return rule['name'] if rule else ""
+
+# === 2.10 التعديلات الجماعية على المنتجات ===
+# كل عملية: (العمود، التعبير الجديد بدلالة الأعمدة الحالية ومعامل واحد ?). التنفيذ UPDATE واحد
+# على المنتجات المطابقة للفلتر داخل معاملة واحدة، والمعاينة SELECT بالتعبير نفسه.
+BULK_OPERATIONS = {
+    'sell_percent': ("sell_price", "ROUND(sell_price * (1 + ? / 100.0), 2)", "سعر البيع: نسبة %"),
+    'sell_amount': ("sell_price", "ROUND(sell_price + ?, 2)", "سعر البيع: مبلغ ثابت"),
+    'cost_percent': ("cost_price", "ROUND(cost_price * (1 + ? / 100.0), 2)", "سعر الشراء: نسبة %"),
+    'cost_amount': ("cost_price", "ROUND(cost_price + ?, 2)", "سعر الشراء: مبلغ ثابت"),
+    'margin_target': ("sell_price", "ROUND(cost_price / (1 - ? / 100.0), 2)", "سعر البيع حسب هامش مستهدف %"),
+    'supplier': ("supplier", "?", "المورد"),
+    'expiry': ("expiry_date", "?", "تاريخ الانتهاء"),
+    'category': ("category", "?", "التصنيف"),
+}
+PRICE_COLUMNS = ("cost_price", "sell_price")
+
+def bulk_filter_sql(supplier=None, name_pattern=None, product_ids=None):
+    """شرط WHERE ومعاملاته لفلتر التعديل الجماعي؛ الفلاتر تُجمع بـ AND، ونمط الاسم يقبل * كحرف بدل."""
+    conditions, params = [], []
+    if supplier is not None:
+        conditions.append("supplier IS ?")
+        params.append(supplier or None)
+    if name_pattern:
+        conditions.append("name LIKE ?")
+        params.append(name_pattern.replace("*", "%") if "*" in name_pattern else f"%{name_pattern}%")
+    if product_ids is not None:
+        conditions.append("id IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(sorted(product_ids)))
+    return " AND ".join(conditions) or "1", params
+
+def _bulk_target(operation, value, filters):
+    column, expression, _ = BULK_OPERATIONS[operation]
+    where, params = bulk_filter_sql(**filters)
+    if column in PRICE_COLUMNS:
+        # لا تُطبق العملية على المنتجات التي يصبح سعرها صفرًا أو سالبًا أو لا يتغير
+        where += f" AND ({expression}) > 0 AND ({expression}) IS NOT {column}"
+        params += [value, value]
+        if operation == 'margin_target' and not 0 <= value < 100:
+            raise ValueError("الهامش المستهدف بين 0 و 100")
+    else:
+        where += f" AND {column} IS NOT ?"
+        params.append(value)
+    return column, expression, where, params
+
+@instrumented('db')
+def preview_bulk_update(operation, value, **filters):
+    """[(id, الاسم، القيمة الحالية، القيمة الجديدة)] للمنتجات التي ستتغير."""
+    column, expression, where, params = _bulk_target(operation, value, filters)
+    with db_context() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT id, name, {column}, {expression} FROM products WHERE {where} ORDER BY name", [value] + params)
+        return cursor.fetchall()
+
+@instrumented('db')
+def apply_bulk_update(operation, value, reason=None, **filters):
+    """تنفذ العملية على كل المنتجات المطابقة دفعة واحدة وتسجل تغييرات الأسعار. تعيد عدد المنتجات المعدلة."""
+    changed = execute_write(_apply_bulk_update, operation, value, reason, filters)
+    if changed:
+        publish('product_changed', ids=set(changed))
+    return len(changed)
+
+def _apply_bulk_update(cursor, operation, value, reason, filters):
+    column, expression, where, params = _bulk_target(operation, value, filters)
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if column in PRICE_COLUMNS:
+        new_cost = expression if column == "cost_price" else "cost_price"
+        new_sell = expression if column == "sell_price" else "sell_price"
+        cursor.execute(f'''
+            INSERT INTO price_history (product_id, old_cost, new_cost, old_sell, new_sell, changed_at, reason)
+            SELECT id, cost_price, {new_cost}, sell_price, {new_sell}, ?, ? FROM products WHERE {where}
+        ''', [value, now, reason or BULK_OPERATIONS[operation][2]] + params)
+    cursor.execute(f"UPDATE products SET {column} = {expression} WHERE {where} RETURNING id", [value] + params)
+    changed = [row[0] for row in cursor.fetchall()]
+    if column == "expiry_date" and changed:
+        # التاريخ يُشتق من الدفعات، فيُطبق على كل الدفعات القائمة للمنتجات المعدلة
+        cursor.execute("UPDATE product_lots SET expiry_date = ? WHERE quantity > 0 AND product_id IN (SELECT value FROM json_each(?))",
+                       (value, json.dumps(changed)))
+    return changed
+
+@instrumented('db')
+def get_price_history(product_id=None, limit=200):
+    query = '''
+        SELECT h.changed_at, p.name, h.old_cost, h.new_cost, h.old_sell, h.new_sell, h.reason
+        FROM price_history h LEFT JOIN products p ON p.id = h.product_id
+    '''
+    params = []
+    if product_id is not None:
+        query += " WHERE h.product_id = ?"
+        params.append(product_id)
+    with read_context() as conn:
+        return conn.execute(query + " ORDER BY h.changed_at DESC, h.id DESC LIMIT ?", params + [limit]).fetchall()
+
+def get_suppliers():
+    with db_context() as conn:
+        return [row[0] for row in conn.execute("SELECT DISTINCT supplier FROM products WHERE supplier IS NOT NULL ORDER BY supplier")]
+
+# === 2.11 ورديات البائعين وتقرير الإغلاق (Z) ===
+# كل فاتورة بوردية تُضاف إلى إجماليات صف الوردية وإجماليات تصنيفاتها داخل معاملة البيع نفسها،
+# فتقرير الإغلاق وتقارير أداء الموظفين تقرأ صفوف الورديات المفهرسة ولا تمسح جدول المبيعات.
+UNCATEGORIZED = "بدون تصنيف"
+
+def add_to_shift_totals(cursor, shift_id, invoice_id, lines, gross, promotion_total, net_total):
+    """تضيف الفاتورة إلى إجماليات الوردية ضمن المعاملة الحالية. تعيد False إذا لم تكن الوردية مفتوحة."""
+    cursor.execute('''
+    UPDATE shifts SET invoice_count = invoice_count + 1, line_count = line_count + ?, item_count = item_count + ?,
+        gross = gross + ?, promotion_discounts = promotion_discounts + ?, manual_discounts = manual_discounts + ?,
+        net_total = net_total + ?
+    WHERE id = ? AND closed_at IS NULL
+    ''', (len(lines), sum(line[3] for line in lines), gross, promotion_total, gross - promotion_total - net_total,
+          net_total, shift_id))
+    if not cursor.rowcount:
+        return False
+    cursor.execute('''
+    INSERT INTO shift_category_totals (shift_id, category, quantity, total)
+    SELECT ?, COALESCE(p.category, ''), SUM(json_extract(l.value, '$[1]')), SUM(json_extract(l.value, '$[2]'))
+    FROM json_each(?) l JOIN products p ON p.id = json_extract(l.value, '$[0]')
+    WHERE 1 GROUP BY 2
+    ON CONFLICT(shift_id, category) DO UPDATE SET quantity = quantity + excluded.quantity, total = total + excluded.total
+    ''', (shift_id, json.dumps([(product_id, qty, price * qty) for product_id, _, price, qty in lines])))
+    return True
+
+@instrumented('db')
+def open_shift(employee_name, opening_cash=0):
+    """تفتح وردية للموظف، أو تعيد ورديته المفتوحة إن وجدت. تعيد رقم الوردية أو None إن لم يوجد الموظف."""
+    shift_id = execute_write(_open_shift, employee_name, opening_cash)
+    if shift_id is not None:
+        publish('shift_changed', ids={shift_id})
+    return shift_id
+
+def _open_shift(cursor, employee_name, opening_cash):
+    cursor.execute("SELECT id FROM employees WHERE name = ?", (employee_name,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    cursor.execute("SELECT id FROM shifts WHERE employee_id = ? AND closed_at IS NULL", (row[0],))
+    existing = cursor.fetchone()
+    if existing:
+        return existing[0]
+    cursor.execute("INSERT INTO shifts (employee_id, employee_name, opened_at, opening_cash) VALUES (?, ?, ?, ?)",
+                   (row[0], employee_name, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), opening_cash or 0))
+    return cursor.lastrowid
+
+@instrumented('db')
+def get_open_shift(employee_name):
+    """رقم الوردية المفتوحة للموظف أو None."""
+    with db_context() as conn:
+        row = conn.execute('''
+            SELECT s.id FROM shifts s JOIN employees e ON e.id = s.employee_id
+            WHERE e.name = ? AND s.closed_at IS NULL
+        ''', (employee_name,)).fetchone()
+        return row[0] if row else None
+
+@instrumented('db')
+def close_shift(shift_id, counted_cash=None):
+    """تغلق الوردية وتعيد تقرير الإغلاق، أو None إن كانت مغلقة مسبقًا."""
+    closed = execute_write(_close_shift, shift_id, counted_cash)
+    if not closed:
+        return None
+    publish('shift_changed', ids={shift_id})
+    return get_shift_report(shift_id)
+
+def _close_shift(cursor, shift_id, counted_cash):
+    cursor.execute("UPDATE shifts SET closed_at = ?, counted_cash = ? WHERE id = ? AND closed_at IS NULL",
+                   (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), counted_cash, shift_id))
+    return cursor.rowcount > 0
+
+SHIFT_COLUMNS = ('id', 'employee_id', 'employee_name', 'opened_at', 'closed_at', 'opening_cash', 'counted_cash',
+                 'invoice_count', 'line_count', 'item_count', 'gross', 'promotion_discounts', 'manual_discounts', 'net_total')
+
+def shift_row_dict(r):
+    shift = dict(zip(SHIFT_COLUMNS, r))
+    # النقد المتوقع في الدرج: الافتتاحي وصافي المبيعات (الدفع نقدي فقط حاليًا)
+    shift['expected_cash'] = shift['opening_cash'] + shift['net_total']
+    shift['cash_difference'] = None if shift['counted_cash'] is None else shift['counted_cash'] - shift['expected_cash']
+    return shift
+
+@instrumented('db')
+def get_shift_report(shift_id):
+    """تقرير Z: صف الوردية وإجمالياته الجارية مع إجماليات كل تصنيف. None إن لم توجد الوردية."""
+    with read_context() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {', '.join(SHIFT_COLUMNS)} FROM shifts WHERE id = ?", (shift_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        report = shift_row_dict(row)
+        cursor.execute("SELECT category, quantity, total FROM shift_category_totals WHERE shift_id = ? ORDER BY total DESC",
+                       (shift_id,))
+        report['categories'] = [(category or UNCATEGORIZED, qty, total) for category, qty, total in cursor.fetchall()]
+        return report
+
+@instrumented('db')
+def get_shifts(start_date, end_date, employee_id=None):
+    """الورديات التي فُتحت بين التاريخين (شاملين)، الأحدث أولًا."""
+    query = f"SELECT {', '.join(SHIFT_COLUMNS)} FROM shifts WHERE opened_at >= ? AND opened_at < date(?, '+1 day')"
+    params = [start_date, end_date]
+    if employee_id is not None:
+        query += " AND employee_id = ?"
+        params.append(employee_id)
+    with read_context() as conn:
+        return [shift_row_dict(r) for r in conn.execute(query + " ORDER BY opened_at DESC", params)]
+
+@instrumented('db')
+def get_employee_performance(start_date, end_date):
+    """أداء كل موظف في الورديات التي فُتحت بين التاريخين، من إجماليات الورديات فقط."""
+    with read_context() as conn:
+        rows = conn.execute('''
+        SELECT s.employee_id, COALESCE(e.name, MAX(s.employee_name)), COUNT(*), SUM(s.invoice_count), SUM(s.item_count),
+               SUM(s.gross), SUM(s.promotion_discounts + s.manual_discounts), SUM(s.net_total),
+               SUM(julianday(COALESCE(s.closed_at, datetime('now', 'localtime'))) - julianday(s.opened_at)) * 24
+        FROM shifts s LEFT JOIN employees e ON e.id = s.employee_id
+        WHERE s.opened_at >= ? AND s.opened_at < date(?, '+1 day')
+        GROUP BY s.employee_id ORDER BY 8 DESC
+        ''', (start_date, end_date)).fetchall()
+    keys = ('employee_id', 'name', 'shifts', 'invoices', 'items', 'gross', 'discounts', 'net_total', 'hours')
+    performance = [dict(zip(keys, r)) for r in rows]
+    for p in performance:
+        p['average_invoice'] = p['net_total'] / p['invoices'] if p['invoices'] else 0
+        p['sales_per_hour'] = p['net_total'] / p['hours'] if p['hours'] else 0
+    return performance
+
+def z_report_lines(report):
+    """أسطر نص تقرير الإغلاق للعرض أو الطباعة."""
+    lines = [
+        f"تقرير إغلاق الوردية #{report['id']}",
+        f"الموظف: {report['employee_name']}",
+        f"من: {report['opened_at']}",
+        f"إلى: {report['closed_at'] or 'مفتوحة'}",
+        "-" * 32,
+        f"عدد الفواتير: {report['invoice_count']}",
+        f"عدد الأسطر: {report['line_count']}   القطع: {report['item_count']}",
+        f"الإجمالي قبل الخصم: {report['gross']:.2f}",
+        f"خصومات العروض: -{report['promotion_discounts']:.2f}",
+        f"الخصم اليدوي: -{report['manual_discounts']:.2f}",
+        f"صافي المبيعات: {report['net_total']:.2f}",
+        "-" * 32,
+    ]
+    lines += [f"{category}: {qty} قطعة — {total:.2f}" for category, qty, total in report['categories']]
+    lines += [
+        "-" * 32,
+        f"النقد الافتتاحي: {report['opening_cash']:.2f}",
+        f"النقد المتوقع: {report['expected_cash']:.2f}",
+    ]
+    if report['counted_cash'] is not None:
+        lines.append(f"النقد المعدود: {report['counted_cash']:.2f}   الفرق: {report['cash_difference']:+.2f}")
+    return lines
+
+# === 2.12 طابور المستندات (الإيصالات والفواتير) ===
+# تُجهز المستندات بعد التزام البيع على خيوط عاملة: الكاشير لا ينتظر إنشاء الملفات ولا الطباعة.
+# كل مستند يُبنى من قالب ويُكتب بالاستبدال الذري في مجلد الانتظار (spool) أو يُرسل بأمر الطباعة.
+DOCUMENT_WORKERS = 4
+DOCUMENT_DEFAULTS = {
+    'store_name': "المتجر",
+    'spool_dir': "spool",
+    'print_command': "",  # مثل: lp -d thermal {path} ؛ فارغ = الحفظ في مجلد الانتظار فقط (أو طابعة ويندوز الافتراضية)
+    'receipt_formats': ['txt'],
+    'auto_receipt': True,
+    'auto_print': False,
+    'receipt_width': 42,  # عدد الأحرف في السطر: 42 لورق 80 مم، 32 لورق 58 مم
+    'font_path': "arial.ttf",
+}
+# ترميز بايثون ورقم جدول الحروف في الطابعة (ESC t n) للعربية؛ يختلف الرقم حسب طراز الطابعة
+ESCPOS_CODEPAGE = ('cp864', 37)
+RECEIPT_TEMPLATE = {
+    'header': ["{store_name}", "فاتورة بيع", "رقم الفاتورة: {invoice_id}", "التاريخ: {sale_time}", "الكاشير: {cashier}"],
+    'footer': ["شكراً لزيارتكم"],
+}
+document_settings = {'loaded': False, 'values': dict(DOCUMENT_DEFAULTS)}
+document_queue = {'executor': None, 'lock': threading.Lock(), 'recent': deque(maxlen=200), 'next_id': 1}
+
+def get_document_settings():
+    if not document_settings['loaded']:
+        document_settings['values'] = dict(DOCUMENT_DEFAULTS, **get_app_settings("documents."))
+        document_settings['loaded'] = True
+    return document_settings['values']
+
+def save_document_settings(values):
+    set_app_settings("documents.", values)
+
+def on_settings_changed_for_documents(event):
+    if any(key.startswith("documents.") for key in event.get('keys', ())):
+        document_settings['loaded'] = False
+
+subscribe('settings_changed', on_settings_changed_for_documents)
+
+@instrumented('db')
+def get_invoice_document(invoice_id):
+    """بيانات الفاتورة للقوالب، أو None إن لم توجد."""
+    lines = get_sales_by_invoice(invoice_id)
+    if not lines:
+        return None
+    with read_context() as conn:
+        row = conn.execute('''
+            SELECT sh.employee_name, SUM(s.promotion_discount) FROM sales s LEFT JOIN shifts sh ON sh.id = s.shift_id
+            WHERE s.invoice_id = ?
+        ''', (invoice_id,)).fetchone()
+    items = [(name, price, qty, price * qty) for name, price, qty, _ in lines]
+    return {
+        'invoice_id': invoice_id, 'sale_time': lines[0][3], 'cashier': row[0] or "-", 'promotions': row[1] or 0,
+        'lines': items, 'total': sum(item[3] for item in items), 'store_name': get_document_settings()['store_name'],
+    }
+
+def receipt_lines(doc, width=None):
+    """نص الإيصال بعرض ثابت: السطر الأول اسم المنتج، والثاني الكمية × السعر ومجموع السطر في طرفه."""
+    width = width or get_document_settings()['receipt_width']
+    rule = "-" * width
+    lines = [line.format(**doc)[:width].center(width) for line in RECEIPT_TEMPLATE['header']]
+    lines.append(rule)
+    for name, price, qty, total in doc['lines']:
+        lines.append(name[:width])
+        detail = f"  {qty} × {price:.2f}"
+        lines.append(detail + f"{total:.2f}".rjust(width - len(detail)))
+    lines.append(rule)
+    if doc['promotions']:
+        lines.append("وفّرت بالعروض:" + f"{doc['promotions']:.2f}".rjust(width - 14))
+    lines.append("الإجمالي:" + f"{doc['total']:.2f}".rjust(width - 9))
+    lines.append(rule)
+    lines += [line.format(**doc)[:width].center(width) for line in RECEIPT_TEMPLATE['footer']]
+    return lines
+
+def render_receipt_text(doc):
+    return ("\n".join(receipt_lines(doc)) + "\n").encode('utf-8')
+
+def render_receipt_escpos(doc):
+    codec, table = ESCPOS_CODEPAGE
+    lines = receipt_lines(doc)
+    def encode(text):
+        return text.encode(codec, errors='replace')
+    # تهيئة، جدول الحروف، السطر الأول بخط عريض، ثم تغذية الورق والقص الجزئي
+    return (b"\x1b@" + b"\x1bt" + bytes([table]) + b"\x1bE\x01" + encode(lines[0]) + b"\x1bE\x00\n"
+            + encode("\n".join(lines[1:])) + b"\n\n\n\n" + b"\x1dV\x01")
+
+def render_receipt_pdf(doc):
+    """صفحة بعرض الإيصال تُرسم بـ Pillow وتُحفظ PDF، بلا مكتبات إضافية."""
+    from PIL import ImageDraw, ImageFont
+    lines = receipt_lines(doc)
+    try:
+        font = ImageFont.truetype(get_document_settings()['font_path'], 22)
+    except (IOError, OSError):
+        font = ImageFont.load_default()
+    line_height = font.getbbox("Hg")[3] + 8
+    text_width = max(font.getbbox(line or " ")[2] for line in lines)
+    image = Image.new('L', (text_width + 40, line_height * len(lines) + 40), 255)
+    draw = ImageDraw.Draw(image)
+    for i, line in enumerate(lines):
+        draw.text((20, 20 + i * line_height), line, fill=0, font=font)
+    buffer = io.BytesIO()
+    image.save(buffer, "PDF", resolution=200)
+    return buffer.getvalue()
+
+def render_invoice_xlsx(doc):
+    wb = Workbook()
+    ws = wb.active
+    ws.title = doc['invoice_id'][:31]
+    ws.append(["فاتورة بيع"])
+    ws.append(["رقم الفاتورة:", doc['invoice_id']])
+    ws.append(["التاريخ:", doc['sale_time']])
+    ws.append(["الكاشير:", doc['cashier']])
+    ws.append([])
+    ws.append(["المنتج", "السعر", "الكمية", "المجموع"])
+    for line in doc['lines']:
+        ws.append(list(line))
+    ws.append(["", "", "الإجمالي:", doc['total']])
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+# الصيغة -> (الاسم، الامتداد، دالة البناء من بيانات الفاتورة إلى bytes)
+DOCUMENT_FORMATS = {
+    'txt': ("إيصال نصي", ".txt", render_receipt_text),
+    'escpos': ("ESC/POS للطابعة الحرارية", ".bin", render_receipt_escpos),
+    'pdf': ("PDF", ".pdf", render_receipt_pdf),
+    'xlsx': ("Excel", ".xlsx", render_invoice_xlsx),
+}
+PRINTABLE_FORMATS = ('escpos', 'txt', 'pdf')
+
+def send_to_printer(path):
+    """ترسل الملف بأمر الطباعة المضبوط، أو لطابعة ويندوز الافتراضية. تعيد False إن لم تتوفر طريقة طباعة."""
+    command = get_document_settings()['print_command']
+    if command:
+        args = [arg.format(path=path) for arg in shlex.split(command)]
+        if "{path}" not in command:
+            args.append(path)
+        subprocess.run(args, check=True, timeout=60)
+        return True
+    if sys.platform == "win32":
+        os.startfile(path, 'print')
+        return True
+    return False
+
+def write_document(path, data):
+    # الاستبدال الذري: من يراقب مجلد الانتظار لا يرى ملفًا نصف مكتوب
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+@instrumented('documents')
+def render_document_job(job):
+    doc = get_invoice_document(job['invoice_id'])
+    if doc is None:
+        raise ValueError(f"الفاتورة غير موجودة: {job['invoice_id']}")
+    out_dir = job['out_dir'] or os.path.join(get_document_settings()['spool_dir'], doc['sale_time'][:10])
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {}
+    for fmt in job['formats']:
+        _, ext, render = DOCUMENT_FORMATS[fmt]
+        paths[fmt] = os.path.join(out_dir, job['invoice_id'] + ext)
+        write_document(paths[fmt], render(doc))
+    if job['print']:
+        printable = next((fmt for fmt in PRINTABLE_FORMATS if fmt in paths), None)
+        job['printed'] = printable is not None and send_to_printer(paths[printable])
+    return paths
+
+def run_document_job(job):
+    job['status'] = 'running'
+    started = time.perf_counter()
+    try:
+        job['paths'] = render_document_job(job)
+        job['status'] = 'done'
+        return job
+    except Exception as e:
+        job['status'], job['error'] = 'failed', str(e)
+        raise
+    finally:
+        job['ms'] = (time.perf_counter() - started) * 1000
+
+def submit_document(invoice_id, formats=None, print_receipt=None, out_dir=None):
+    """تضيف مستند الفاتورة إلى الطابور وتعيد Future بالمهمة بعد اكتمالها (paths: {الصيغة: المسار}، printed)."""
+    settings = get_document_settings()
+    job = {'invoice_id': invoice_id, 'formats': list(formats or settings['receipt_formats']),
+           'print': settings['auto_print'] if print_receipt is None else print_receipt, 'out_dir': out_dir,
+           'status': 'queued', 'error': None, 'paths': None, 'printed': False, 'ms': None,
+           'queued_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+    with document_queue['lock']:
+        job['id'] = document_queue['next_id']
+        document_queue['next_id'] += 1
+        if document_queue['executor'] is None:
+            document_queue['executor'] = ThreadPoolExecutor(max_workers=DOCUMENT_WORKERS, thread_name_prefix="documents")
+        document_queue['recent'].append(job)
+    return document_queue['executor'].submit(run_document_job, job)
+
+def submit_invoice_range(start_date, end_date, formats, out_dir=None, print_receipts=False):
+    """إعادة طباعة أو تصدير كل فواتير الفترة بالتوازي على عمال الطابور. تعيد قائمة Futures."""
+    futures, after = [], None
+    while True:
+        rows, after = get_invoices_page(after=after, limit=500, start_date=start_date, end_date=end_date)
+        futures += [submit_document(row[0], formats, print_receipts, out_dir) for row in rows]
+        if after is None:
+            return futures
+
+def get_document_jobs():
+    with document_queue['lock']:
+        return [dict(job) for job in reversed(document_queue['recent'])]
+
+def on_sale_completed_for_documents(event):
+    if get_document_settings()['auto_receipt']:
+        for sale in event['sales']:
+            submit_document(sale['invoice_id'])
+
+def start_document_queue():
+    """إيصال تلقائي لكل فاتورة بعد التزامها (يُفعَّل عند تشغيل الواجهة فقط، لا في السكربتات والقياسات)."""
+    subscribe('sale_completed', on_sale_completed_for_documents)
+
+# === 2.13 تصدير التغييرات للمزامنة ===
+# كل مستهلك (نظام المحاسبة مثلًا) له مؤشر بآخر رقم تسلسل صدّره؛ التصدير يقرأ change_log بعده على دفعات
+# محدودة ويكتب الحالة الحالية لكل صف متغير، فيتناسب زمن المزامنة مع نشاط الفترة لا مع حجم القاعدة.
+# أول تصدير لمستهلك جديد (أو full) لقطة كاملة للجداول ثم يستمر تزايديًا من رقمها.
+CHANGE_TRACKED_TABLES = {
+    'products': (),
+    'sales': (),
+    'employees': ('password',),  # أعمدة لا تُصدَّر
+}
+CHANGE_EXPORT_FIELDS = ('seq', 'table', 'op', 'id', 'changed_at', 'row')
 
-def generate_invoice_id():
-    today = datetime.now().strftime("%Y%m%d")
+def get_sync_cursors():
     with db_context() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(DISTINCT invoice_id) FROM sales WHERE invoice_id LIKE ?", (f"INV-{today}%",))
-        count = cursor.fetchone()[0] + 1
-        return f"INV-{today}-{count:03d}"
+        return conn.execute("SELECT consumer, last_seq, updated_at FROM sync_cursors ORDER BY consumer").fetchall()
 
-def sell_product(product_name, sell_price, quantity):
+def get_sync_cursor(consumer):
     with db_context() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT quantity FROM products WHERE name = ?", (product_name,))
-        row = cursor.fetchone()
-        if not row:
-            return False, "المنتج غير موجود"
-        current_qty = row[0]
-        if current_qty < quantity:
-            return False, f"الكمية غير كافية! المتوفر: {current_qty}"
-        
-        new_qty = current_qty - quantity
-        cursor.execute("UPDATE products SET quantity = ? WHERE name = ?", (new_qty, product_name))
-        
-        # This logic for invoice ID generation is complex and might lead to race conditions.
-        # A simpler approach would be to use the last sale's invoice ID if it's for the same cart.
-        # For now, we assume it works for this single-user context.
-        today = datetime.now().strftime("%Y%m%d")
-        cursor.execute("SELECT COUNT(DISTINCT invoice_id) FROM sales WHERE invoice_id LIKE ?", (f"INV-{today}%",))
-        count = cursor.fetchone()[0]
-        cursor.execute("SELECT invoice_id FROM sales WHERE invoice_id LIKE ? ORDER BY id DESC LIMIT 1", (f"INV-{today}%",))
-        last_invoice = cursor.fetchone()
-        if last_invoice and last_invoice[0].endswith(f"{count:03d}"):
-            invoice_id = last_invoice[0]
-        else:
-            invoice_id = f"INV-{today}-{count + 1:03d}"
-        sale_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        cursor.execute('''
-        INSERT INTO sales (invoice_id, product_name, sell_price, quantity, sale_time)
-        VALUES (?, ?, ?, ?, ?)
-        ''', (invoice_id, product_name, sell_price, quantity, sale_time))
-        return True, invoice_id
+        row = conn.execute("SELECT last_seq FROM sync_cursors WHERE consumer = ?", (consumer,)).fetchone()
+        return row[0] if row else None
 
-def get_sales_by_invoice(invoice_id):
-    with db_context() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT product_name, sell_price, quantity, sale_time FROM sales WHERE invoice_id = ?", (invoice_id,))
-        return cursor.fetchall()
+def set_sync_cursor(consumer, last_seq):
+    execute_write(_set_sync_cursor, consumer, last_seq)
 
-def get_daily_sales(target_date):
-    with db_context() as conn:
+def _set_sync_cursor(cursor, consumer, last_seq):
+    cursor.execute('''
+    INSERT INTO sync_cursors (consumer, last_seq, updated_at) VALUES (?, ?, ?)
+    ON CONFLICT(consumer) DO UPDATE SET last_seq = excluded.last_seq, updated_at = excluded.updated_at
+    ''', (consumer, last_seq, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
+def exported_columns(cursor, table):
+    excluded = CHANGE_TRACKED_TABLES[table]
+    return [r[1] for r in cursor.execute(f"PRAGMA table_info({table})") if r[1] not in excluded]
+
+class ChangeWriter:
+    """يكتب سجلات التغيير بصيغة JSON Lines أو CSV (عمود row نص JSON)."""
+    def __init__(self, f, fmt):
+        self.f, self.fmt, self.count = f, fmt, 0
+        if fmt == 'csv':
+            import csv
+            self.csv = csv.writer(f)
+            self.csv.writerow(CHANGE_EXPORT_FIELDS)
+
+    def write(self, seq, table, op, row_id, changed_at, row):
+        record = (seq, table, op, row_id, changed_at, row)
+        if self.fmt == 'csv':
+            self.csv.writerow(record[:5] + (None if row is None else json.dumps(row, ensure_ascii=False),))
+        else:
+            self.f.write(json.dumps(dict(zip(CHANGE_EXPORT_FIELDS, record)), ensure_ascii=False) + "\n")
+        self.count += 1
+
+def fetch_rows_by_id(cursor, table, ids, columns):
+    cursor.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE id IN (SELECT value FROM json_each(?))",
+                   (json.dumps(sorted(ids)),))
+    return {row[columns.index('id')]: dict(zip(columns, row)) for row in cursor.fetchall()}
+
+def write_change_batch(cursor, writer, batch, columns):
+    """تصدير دفعة من change_log: آخر تغيير فقط لكل صف، مع حالته الحالية ضمن اللقطة نفسها."""
+    latest = {}
+    for seq, table, row_id, op, changed_at in batch:
+        latest[(table, row_id)] = (seq, op, changed_at)
+    rows = {}
+    for table in CHANGE_TRACKED_TABLES:
+        ids = {row_id for (t, row_id), (_, op, _) in latest.items() if t == table and op != 'delete'}
+        rows[table] = fetch_rows_by_id(cursor, table, ids, columns[table]) if ids else {}
+    for (table, row_id), (seq, op, changed_at) in sorted(latest.items(), key=lambda item: item[1][0]):
+        if op == 'delete':
+            writer.write(seq, table, op, row_id, changed_at, None)
+        elif row_id in rows[table]:
+            writer.write(seq, table, op, row_id, changed_at, rows[table][row_id])
+        # صف أُضيف أو عُدل ثم حُذف قبل اللقطة: تغيير الحذف اللاحق يكفي
+
+def write_snapshot(cursor, writer, seq, columns, batch_size):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for table in CHANGE_TRACKED_TABLES:
+        select = f"SELECT {', '.join(columns[table])} FROM {table} WHERE id > ? ORDER BY id LIMIT ?"
+        last_id = 0
+        while True:
+            rows = cursor.execute(select, (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                record = dict(zip(columns[table], row))
+                writer.write(seq, table, 'snapshot', record['id'], now, record)
+            last_id = rows[-1][columns[table].index('id')]
+
+@instrumented('db')
+def export_changes(consumer, out_path, fmt='jsonl', full=False, max_changes=None, batch_size=CHANGE_EXPORT_BATCH):
+    """تصدّر تغييرات المنتجات والمبيعات والموظفين منذ مؤشر المستهلك إلى ملف، ثم تقدّم المؤشر.
+    الملف يُكتب بالاستبدال الذري ولا يتقدم المؤشر إلا بعد اكتماله، فإعادة التشغيل بعد فشل آمنة.
+    max_changes يحدد عدد تغييرات السجل في التشغيل الواحد (الباقي للتشغيل التالي)."""
+    start_seq = None if full else get_sync_cursor(consumer)
+    tmp_path = out_path + ".tmp"
+    with read_context() as conn, open(tmp_path, 'w', encoding='utf-8', newline='') as f:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT
-                s.invoice_id,
-                s.product_name,
-                s.sell_price,
-                s.quantity,
-                p.cost_price
-            FROM sales s
-            JOIN products p ON s.product_name = p.name
-            WHERE date(s.sale_time) = ?
-        ''', (target_date,))
-        return cursor.fetchall()
-
-def get_all_invoices():
-    """تجلب قائمة بجميع الفواتير مع إجمالي كل فاتورة."""
+        # اتصال اللقطة: كل الدفعات ترى القاعدة نفسها حتى رقم التسلسل الأعلى
+        high = cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0]
+        columns = {table: exported_columns(cursor, table) for table in CHANGE_TRACKED_TABLES}
+        writer = ChangeWriter(f, fmt)
+        if start_seq is None:
+            write_snapshot(cursor, writer, high, columns, batch_size)
+        else:
+            seq, processed = start_seq, 0
+            while seq < high:
+                limit = batch_size if max_changes is None else min(batch_size, max_changes - processed)
+                batch = cursor.execute('''
+                    SELECT seq, table_name, row_id, op, changed_at FROM change_log
+                    WHERE seq > ? AND seq <= ? ORDER BY seq LIMIT ?
+                ''', (seq, high, limit)).fetchall()
+                if not batch:
+                    break
+                write_change_batch(cursor, writer, batch, columns)
+                seq, processed = batch[-1][0], processed + len(batch)
+                if max_changes is not None and processed >= max_changes:
+                    break
+            high = max(seq, start_seq)
+    os.replace(tmp_path, out_path)
+    set_sync_cursor(consumer, high)
+    return {'consumer': consumer, 'from_seq': start_seq, 'to_seq': high, 'records': writer.count,
+            'snapshot': start_seq is None}
+
+def changes_cli(argv):
+    """python main.py export-changes --consumer accounting --out changes.jsonl [--format csv] [--full] [--max-changes N]"""
+    global DB_NAME
+    import argparse
+    parser = argparse.ArgumentParser(prog="main.py export-changes", description="تصدير تغييرات القاعدة منذ آخر مزامنة")
+    parser.add_argument("--db", default=DB_NAME)
+    parser.add_argument("--consumer", help="اسم النظام المستهلك؛ لكل مستهلك مؤشره الخاص")
+    parser.add_argument("--out", help="ملف الناتج")
+    parser.add_argument("--format", choices=("jsonl", "csv"), default="jsonl")
+    parser.add_argument("--full", action="store_true", help="لقطة كاملة بدل التغييرات فقط")
+    parser.add_argument("--max-changes", type=int, help="أقصى عدد تغييرات في هذا التشغيل")
+    parser.add_argument("--batch-size", type=int, default=CHANGE_EXPORT_BATCH)
+    parser.add_argument("--list", action="store_true", help="عرض مؤشرات المستهلكين")
+    args = parser.parse_args(argv)
+    DB_NAME = args.db
+    init_db()
+    if args.list:
+        for consumer, last_seq, updated_at in get_sync_cursors():
+            print(f"{consumer}\t{last_seq}\t{updated_at}")
+        return 0
+    if not args.consumer or not args.out:
+        parser.error("--consumer و --out مطلوبان")
+    result = export_changes(args.consumer, args.out, args.format, args.full, args.max_changes, args.batch_size)
+    print(json.dumps(result, ensure_ascii=False))
+    return 0
+
+# === 2.14 الفروع والتقارير الموحدة ===
+# التقرير نفسه يُنفذ على قاعدة كل فرع للقراءة فقط ويعيد مجاميع جزئية تُدمج هنا. القليل من الفروع يُقرأ
+# بـ ATTACH في اتصال واحد، والكثير في مجمع عمليات بالتوازي. نتيجة كل فرع تُحفظ في الذاكرة مع بصمة
+# ملفه (الحجم ووقت التعديل للقاعدة وملف WAL)، فلا يُعاد الاستعلام إلا عن الفروع التي تغيرت.
+federation = {'executor': None, 'lock': threading.Lock(), 'cache': {}}
+
+@instrumented('db')
+def get_branches(active_only=False):
     with db_context() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT
-                invoice_id,
-                MIN(sale_time),
-                SUM(sell_price * quantity)
-            FROM sales
-            GROUP BY invoice_id
-            ORDER BY MIN(sale_time) DESC
+        query = "SELECT id, name, db_path, active FROM branches"
+        if active_only:
+            query += " WHERE active = 1"
+        return [dict(zip(('id', 'name', 'db_path', 'active'), r)) for r in conn.execute(query + " ORDER BY name")]
+
+def add_branch(name, db_path):
+    """تعيد (True, "") أو (False, رسالة)."""
+    if not os.path.exists(db_path):
+        return False, "ملف القاعدة غير موجود"
+    branch_id = execute_write(_add_branch, name, db_path)
+    return (True, "") if branch_id else (False, "اسم الفرع مستخدم")
+
+def _add_branch(cursor, name, db_path):
+    try:
+        cursor.execute("INSERT INTO branches (name, db_path, added_at) VALUES (?, ?, ?)",
+                       (name, os.path.abspath(db_path), datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        return cursor.lastrowid
+    except sqlite3.IntegrityError:
+        return None
+
+def set_branch_active(branch_id, active):
+    execute_write(_set_branch_active, branch_id, active)
+
+def _set_branch_active(cursor, branch_id, active):
+    cursor.execute("UPDATE branches SET active = ? WHERE id = ?", (int(active), branch_id))
+
+def delete_branch(branch_id):
+    execute_write(_delete_branch, branch_id)
+
+def _delete_branch(cursor, branch_id):
+    cursor.execute("DELETE FROM branches WHERE id = ?", (branch_id,))
+
+# --- تقارير الفرع الواحد: (cursor, schema, params) -> مجاميع جزئية قابلة للنقل بين العمليات ---
+def branch_daily_report(cursor, schema, params):
+    day = params['date']
+    next_day = (datetime.strptime(day, "%Y-%m-%d").date() + timedelta(days=1)).isoformat()
+    cursor.execute(f'''
+        SELECT s.product_name, SUM(s.quantity), SUM(s.sell_price * s.quantity), SUM(s.quantity * COALESCE(p.cost_price, 0))
+        FROM {schema}.sales s LEFT JOIN {schema}.products p ON p.name = s.product_name
+        WHERE s.sale_time >= ? AND s.sale_time < ?
+        GROUP BY s.product_name
+    ''', (day, next_day))
+    products = cursor.fetchall()
+    cursor.execute(f"SELECT COUNT(*), COALESCE(SUM(total), 0) FROM {schema}.invoices WHERE created_at >= ? AND created_at < ?",
+                   (day, next_day))
+    invoices, total = cursor.fetchone()
+    return {'products': products, 'invoices': invoices, 'total': total}
+
+def branch_best_sellers(cursor, schema, params):
+    if params.get('since'):
+        cursor.execute(f"SELECT product_name, SUM(quantity) FROM {schema}.sales WHERE sale_time >= ? GROUP BY product_name",
+                       (params['since'],))
+    else:
+        cursor.execute(f'''
+            SELECT product_name, SUM(quantity) FROM (
+                SELECT product_name, quantity FROM {schema}.sales
+                UNION ALL
+                SELECT product_name, quantity FROM {schema}.archived_product_sales
+            ) GROUP BY product_name
         ''')
-        return cursor.fetchall()
+    return cursor.fetchall()
+
+def branch_stock_levels(cursor, schema, params):
+    cursor.execute(f"SELECT name, quantity, reorder_threshold, quantity * cost_price FROM {schema}.products")
+    return cursor.fetchall()
+
+# --- دمج المجاميع الجزئية: [(اسم الفرع، النتيجة الجزئية)] -> التقرير الموحد ---
+def merge_daily_reports(partials):
+    products = {}
+    for _, partial in partials:
+        for name, qty, revenue, cost in partial['products']:
+            totals = products.setdefault(name, [0, 0.0, 0.0])
+            totals[0] += qty
+            totals[1] += revenue
+            totals[2] += cost
+    rows = sorted(((name, qty, revenue, revenue - cost) for name, (qty, revenue, cost) in products.items()),
+                  key=lambda row: row[2], reverse=True)
+    return {
+        'products': rows,
+        'branches': [(branch, partial['invoices'], partial['total']) for branch, partial in partials],
+        'invoices': sum(partial['invoices'] for _, partial in partials),
+        'total': sum(partial['total'] for _, partial in partials),
+    }
 
-def get_sales_summary_last_7_days():
-    """تجلب ملخص المبيعات لآخر 7 أيام."""
-    with db_context() as conn:
-        cursor = conn.cursor()
-        seven_days_ago = (datetime.now() - timedelta(days=6)).strftime('%Y-%m-%d')
-        cursor.execute('''
-            SELECT
-                date(sale_time) as sale_date,
-                SUM(sell_price * quantity) as total_sales
-            FROM sales
-            WHERE date(sale_time) >= ?
-            GROUP BY sale_date
-            ORDER BY sale_date ASC
-        ''', (seven_days_ago,))
-        return cursor.fetchall()
+def merge_best_sellers(partials, limit=50):
+    totals, by_branch = {}, {}
+    for branch, rows in partials:
+        for name, qty in rows:
+            totals[name] = totals.get(name, 0) + qty
+            if qty > by_branch.get(name, (None, 0))[1]:
+                by_branch[name] = (branch, qty)
+    top = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:limit]
+    return [(name, qty, by_branch[name][0]) for name, qty in top]
+
+def merge_stock_levels(partials):
+    """لكل منتج: الكمية في كل فرع وإجماليها، والفروع التي بلغت فيها حد إعادة الطلب."""
+    products = {}
+    for branch, rows in partials:
+        for name, qty, threshold, value in rows:
+            entry = products.setdefault(name, {'name': name, 'total': 0, 'value': 0.0, 'by_branch': {}, 'low_in': []})
+            entry['total'] += qty
+            entry['value'] += value or 0
+            entry['by_branch'][branch] = qty
+            if qty <= threshold:
+                entry['low_in'].append(branch)
+    return sorted(products.values(), key=lambda entry: entry['name'])
+
+# التقرير -> (دالة الفرع، دالة الدمج)
+FEDERATION_REPORTS = {
+    'daily': (branch_daily_report, merge_daily_reports),
+    'best_sellers': (branch_best_sellers, merge_best_sellers),
+    'stock': (branch_stock_levels, merge_stock_levels),
+}
 
-def get_best_selling_products(limit=10):
-    """Fetches the best-selling products based on quantity sold."""
-    with db_context() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT
-                product_name,
-                SUM(quantity) as total_quantity
-            FROM sales
-            GROUP BY product_name
-            ORDER BY total_quantity DESC
-            LIMIT ?
-        ''', (limit,))
-        return cursor.fetchall()
+def run_branch_report(db_path, report, params):
+    """تُنفذ في عملية عاملة: تقرير فرع واحد على اتصال للقراءة فقط."""
+    started = time.perf_counter()
+    conn = sqlite3.connect(readonly_uri(db_path), uri=True)
+    try:
+        return FEDERATION_REPORTS[report][0](conn.cursor(), 'main', params), (time.perf_counter() - started) * 1000
+    finally:
+        conn.close()
 
-def check_expiry_alerts():
-    products = get_products_filtered()
-    today = date.today()
-    alerts = []
-    for p in products:
-        if p['expiry_date']:
+def run_attached_reports(branches, report, params):
+    """الفروع القليلة: اتصال واحد يربط كل القواعد للقراءة فقط. تعيد {المسار: (النتيجة، ms) أو استثناء}."""
+    results = {}
+    conn = sqlite3.connect(":memory:", uri=True)
+    try:
+        cursor = conn.cursor()
+        for i, branch in enumerate(branches):
+            started = time.perf_counter()
             try:
-                exp_date = datetime.strptime(p['expiry_date'], "%Y-%m-%d").date()
-                if 0 <= (exp_date - today).days <= 15:
-                    alerts.append(f"{p['name']} — ينتهي في: {p['expiry_date']}")
-            except (ValueError, TypeError): continue
-    if alerts:
-        messagebox.showwarning("تنبيه انتهاء الصلاحية", "\n".join(alerts))
+                cursor.execute("ATTACH DATABASE ? AS ?", (readonly_uri(branch['db_path']), f"branch{i}"))
+                results[branch['db_path']] = (FEDERATION_REPORTS[report][0](cursor, f"branch{i}", params),
+                                              (time.perf_counter() - started) * 1000)
+            except sqlite3.Error as e:
+                results[branch['db_path']] = e
+    finally:
+        conn.close()
+    return results
+
+def run_pooled_reports(branches, report, params):
+    with federation['lock']:
+        if federation['executor'] is None:
+            # spawn وليس fork: العملية الأم فيها خيوط (الكاتب، الطوابير) لا تُنسخ بأمان
+            federation['executor'] = ProcessPoolExecutor(max_workers=FEDERATION_WORKERS,
+                                                         mp_context=multiprocessing.get_context("spawn"))
+        executor = federation['executor']
+    futures = {branch['db_path']: executor.submit(run_branch_report, branch['db_path'], report, params) for branch in branches}
+    results = {}
+    for path, future in futures.items():
+        try:
+            results[path] = future.result()
+        except Exception as e:
+            results[path] = e
+    return results
+
+def branch_fingerprint(db_path):
+    fingerprint = []
+    for path in (db_path, db_path + "-wal"):
+        try:
+            stat = os.stat(path)
+            fingerprint.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            fingerprint.append(None)
+    return tuple(fingerprint)
+
+@instrumented('db')
+def run_federated_report(report, params=None, branches=None):
+    """تنفذ التقرير على الفروع النشطة وتدمج النتائج. تعيد {'merged', 'branches': [حالة كل فرع]}.
+    الفرع الذي تعذرت قراءته يُذكر خطؤه ولا يُفشل التقرير كله."""
+    params = params or {}
+    branches = get_branches(active_only=True) if branches is None else branches
+    param_key = json.dumps(params, sort_keys=True)
+    statuses, pending = {}, []
+    for branch in branches:
+        key = (branch['db_path'], report, param_key)
+        fingerprint = branch_fingerprint(branch['db_path'])
+        cached = federation['cache'].get(key)
+        if cached and cached[0] == fingerprint:
+            statuses[branch['db_path']] = {'result': cached[1], 'ms': 0.0, 'cached': True, 'error': None}
+        else:
+            pending.append((branch, key, fingerprint))
+    if pending:
+        run = run_attached_reports if len(pending) <= FEDERATION_ATTACH_MAX else run_pooled_reports
+        results = run([branch for branch, _, _ in pending], report, params)
+        for branch, key, fingerprint in pending:
+            outcome = results[branch['db_path']]
+            if isinstance(outcome, Exception):
+                statuses[branch['db_path']] = {'result': None, 'ms': None, 'cached': False, 'error': str(outcome)}
+                continue
+            result, ms = outcome
+            statuses[branch['db_path']] = {'result': result, 'ms': ms, 'cached': False, 'error': None}
+            cache = federation['cache']
+            cache.pop(key, None)
+            cache[key] = (fingerprint, result)
+            while len(cache) > FEDERATION_CACHE_MAX:
+                cache.pop(next(iter(cache)))
+    partials = [(branch['name'], statuses[branch['db_path']]['result']) for branch in branches
+                if statuses[branch['db_path']]['error'] is None]
+    return {
+        'merged': FEDERATION_REPORTS[report][1](partials),
+        'branches': [dict(name=branch['name'], db_path=branch['db_path'], **{k: v for k, v in statuses[branch['db_path']].items() if k != 'result'})
+                     for branch in branches],
+    }
 
 # === 3. دوال واجهة المستخدم ===
 def create_sidebar(parent, buttons):
     theme = get_theme()
-    sidebar = tk.Frame(parent, bg=theme['sidebar_bg'], width=200)
+    sidebar = register_theme_role(tk.Frame(parent, bg=theme['sidebar_bg'], width=200), 'sidebar')
     sidebar.pack(side=tk.RIGHT, fill=tk.Y)
     for text, command in buttons:
         btn = tk.Button(sidebar, text=text, command=command, bg=theme['button_bg'], fg=theme['button_fg'], font=("Arial", 11, "bold"), height=1, width=15)
+        register_theme_role(btn, 'sidebar_button')
         btn.pack(pady=5, padx=10, fill=tk.X)
     return sidebar
 
@@ -449,7 +3463,8 @@ def create_search_bar(parent, on_search):
     tk.Label(frame, text="بحث باسم المنتج:", bg=theme['bg'], fg=theme['fg']).pack(side=tk.LEFT)
     entry = tk.Entry(frame, width=30, bg=theme['entry_bg'], fg=theme['entry_fg'])
     entry.pack(side=tk.LEFT, padx=5)
-    tk.Button(frame, text="بحث", command=lambda: on_search(entry.get().strip()), bg=theme['accent_bg'], fg=theme['accent_fg'], font=("Arial", 10, "bold")).pack(side=tk.LEFT)
+    search_button = tk.Button(frame, text="بحث", command=lambda: on_search(entry.get().strip()), bg=theme['accent_bg'], fg=theme['accent_fg'], font=("Arial", 10, "bold"))
+    register_theme_role(search_button, 'button').pack(side=tk.LEFT)
     entry.bind("<Return>", lambda e: on_search(entry.get().strip()))
     return entry
 
@@ -469,44 +3484,183 @@ def create_product_search_frame(parent, on_search):
     def do_search():
         on_search(name_filter=name_entry.get().strip(), expiry_filter=expiry_entry.get().strip())
 
-    tk.Button(frame, text="بحث", command=do_search, bg=theme['accent_bg'], fg=theme['accent_fg'], font=("Arial", 10, "bold")).pack(side=tk.RIGHT)
+    search_button = tk.Button(frame, text="بحث", command=do_search, bg=theme['accent_bg'], fg=theme['accent_fg'], font=("Arial", 10, "bold"))
+    register_theme_role(search_button, 'button').pack(side=tk.RIGHT)
     return name_entry, expiry_entry
 
-def apply_theme_to_widgets(widget_list):
+@instrumented('ui')
+def sync_tree_rows(tree, rows):
+    """تحدّث صفوف Treeview بالفرق فقط. rows قائمة (مفتاح، قيم[، وسوم]) بالترتيب المطلوب:
+    الصفوف غير المتغيرة لا تُلمس، والمتغيرة تُعدّل في مكانها، والزائدة تُحذف."""
+    cache = tree.__dict__.setdefault('_synced_rows', {})
+    order = []
+    for key, values, *tags in rows:
+        iid = str(key)
+        state = (tuple(values), tuple(tags[0]) if tags else ())
+        order.append(iid)
+        if iid not in cache:
+            tree.insert("", "end", iid=iid, values=state[0], tags=state[1])
+        elif cache[iid] != state:
+            tree.item(iid, values=state[0], tags=state[1])
+        cache[iid] = state
+    wanted = set(order)
+    for iid in [iid for iid in cache if iid not in wanted]:
+        tree.delete(iid)
+        del cache[iid]
+    if list(tree.get_children()) != order:
+        for index, iid in enumerate(order):
+            tree.move(iid, "", index)
+
+def apply_tree_delta(tree, rows, removed_keys=()):
+    """تعدّل صفوفًا محددة فقط في جدول تديره sync_tree_rows. المفاتيح أرقام مرتبة تصاعديًا،
+    فيُدرج الصف الجديد في موضعه دون إعادة بناء الجدول."""
+    cache = tree.__dict__.setdefault('_synced_rows', {})
+    for key in removed_keys:
+        iid = str(key)
+        if iid in cache:
+            tree.delete(iid)
+            del cache[iid]
+    for key, values, *tags in rows:
+        iid = str(key)
+        state = (tuple(values), tuple(tags[0]) if tags else ())
+        if iid not in cache:
+            keys = [int(child) for child in tree.get_children()]
+            tree.insert("", bisect.bisect_left(keys, key), iid=iid, values=state[0], tags=state[1])
+        elif cache[iid] != state:
+            tree.item(iid, values=state[0], tags=state[1])
+        cache[iid] = state
+
+def bind_product_tree(tree, to_values, current_filters):
+    """تشترك في أحداث المنتجات والمخزون فتجلب المنتجات المتأثرة فقط وتحدّث صفوفها حسب الفلاتر الحالية.
+    to_values(product) تعيد قيم الصف، و current_filters() تعيد (فلتر الاسم، فلتر الانتهاء).
+    تعيد دالة تبني صفوف الجدول (مع وسوم المخزون المنخفض) لاستخدامها في التحميل الكامل."""
+    def on_change(event):
+        deleted = event.get('deleted', set())
+        ids = event.get('ids', set()) - deleted
+        name_filter, expiry_filter = current_filters()
+        rows = product_tree_rows(p for p in get_products_by_ids(ids) if product_matches(p, name_filter, expiry_filter))
+        apply_tree_delta(tree, rows, (ids - {key for key, _ in rows}) | deleted)
+    def product_tree_rows(products):
+        return [(p['id'], to_values(p), stock_tags(p['quantity'], p['reorder_threshold'])) for p in products]
+
+    subscribe('product_changed', on_change, owner=tree)
+    subscribe('stock_changed', on_change, owner=tree)
+    return product_tree_rows
+
+def collect_widgets(parent):
+    widgets = []
+    for child in parent.winfo_children():
+        widgets.append(child)
+        widgets.extend(collect_widgets(child))
+    return widgets
+
+# أدوار السمة: لكل دور خيارات الضبط المشتقة من السمة الحالية
+THEME_ROLES = {
+    'frame': lambda t: {'bg': t['bg']},
+    'label': lambda t: {'bg': t['bg'], 'fg': t['fg']},
+    'danger_label': lambda t: {'bg': t['bg'], 'fg': t['danger_bg']},
+    'entry': lambda t: {'bg': t['entry_bg'], 'fg': t['entry_fg'], 'insertbackground': t['fg']},
+    'button': lambda t: {'bg': t['accent_bg'], 'fg': t['accent_fg'], 'font': ("Arial", 11, "bold")},
+    'sidebar': lambda t: {'bg': t['sidebar_bg']},
+    'sidebar_button': lambda t: {'bg': t['button_bg'], 'fg': t['button_fg']},
+    'warning_button': lambda t: {'bg': t['warning_bg'], 'fg': t['warning_fg']},
+    'danger_button': lambda t: {'bg': t['danger_bg'], 'fg': t['button_fg']},
+    # ألوان وسوم المخزون في الجداول (الخط والخلفية العامة يأتيان من نمط ttk المسمى)
+    'tree': lambda t: {'danger_bg': t['danger_bg'], 'warning_bg': t['warning_bg'], 'warning_fg': t['warning_fg']},
+}
+
+# سجل العناصر حسب الدور؛ مراجع ضعيفة حتى تختفي العناصر المدمرة تلقائيًا
+themed_widgets = {role: weakref.WeakSet() for role in THEME_ROLES}
+widget_roles = weakref.WeakKeyDictionary()
+applied_role_options = {}  # الخيارات المطبقة فعليًا على كل دور
+styled_theme_name = None   # السمة التي ضُبطت عليها أنماط ttk المسماة
+
+def configure_ttk_styles():
+    """تضبط أنماط ttk المسماة مرة واحدة لكل تغيير سمة بدل مرة لكل جدول."""
+    global styled_theme_name
+    if styled_theme_name == current_theme_name:
+        return
     theme = get_theme()
+    style = ttk.Style()
+    style.configure("Treeview", background=theme['tree_bg'], foreground=theme['tree_fg'], fieldbackground=theme['tree_bg'], font=("Arial", 12, "bold"), rowheight=30)
+    style.map('Treeview', background=[('selected', theme['accent_bg'])])
+    style.configure("Treeview.Heading", background=theme['tree_heading_bg'], foreground=theme['fg'], font=("Arial", 11, "bold"))
+    styled_theme_name = current_theme_name
+
+def configure_widget_role(widget, role, options):
+    if role == 'tree':
+        widget.tag_configure('out_of_stock', background=options['danger_bg'], foreground='white')
+        widget.tag_configure('low_stock', background=options['warning_bg'], foreground=options['warning_fg'])
+    else:
+        widget.configure(**options)
+
+def register_theme_role(widget, role):
+    """تسجل دور العنصر عند إنشائه وتطبق عليه خيارات السمة الحالية."""
+    options = THEME_ROLES[role](get_theme())
+    applied_role_options.setdefault(role, options)
+    if applied_role_options[role] != options:
+        # الدور لم يُحدَّث بعد للسمة الحالية (لا يحدث عادة): نحدّث الجميع
+        apply_theme_globally()
+    previous = widget_roles.get(widget)
+    if previous and previous != role:
+        themed_widgets[previous].discard(widget)
+    widget_roles[widget] = role
+    themed_widgets[role].add(widget)
+    if role == 'tree':
+        configure_ttk_styles()
+    try:
+        configure_widget_role(widget, role, options)
+    except tk.TclError:
+        pass # Some widgets might not support all options
+    return widget
+
+def infer_theme_role(widget):
+    widget_type = widget.winfo_class()
+    if widget_type in ('Frame', 'TFrame', 'Labelframe'):
+        return 'frame'
+    if widget_type in ('Label', 'TLabel'):
+        return 'label'
+    if widget_type in ('Entry', 'TEntry', 'Text'):
+        return 'entry'
+    if widget_type in ('Button', 'TButton'):
+        # الأزرار داخل الإطارات (الشريط الجانبي وغيره) تسجل دورها بنفسها عند إنشائها
+        if widget.master.winfo_class() != 'Frame':
+            return 'button'
+        return None
+    if widget_type == 'Treeview':
+        return 'tree'
+    return None
+
+@instrumented('ui')
+def apply_theme_to_widgets(widget_list):
+    """تسجل العناصر الجديدة بأدوار مستنتجة من نوعها؛ العناصر المسجلة مسبقًا لا تُلمس."""
     for widget in widget_list:
-        widget_type = widget.winfo_class()
-        try:
-            if widget_type in ('Frame', 'TFrame', 'Labelframe'):
-                widget.configure(bg=theme['bg'])
-            elif widget_type in ('Label', 'TLabel'):
-                widget.configure(bg=theme['bg'], fg=theme['fg'])
-            elif widget_type in ('Entry', 'TEntry', 'Text'):
-                widget.configure(bg=theme['entry_bg'], fg=theme['entry_fg'], insertbackground=theme['fg'])
-            elif widget_type in ('Button', 'TButton'):
-                # This is tricky as buttons are styled in create_sidebar etc.
-                # We can check for specific buttons if needed.
-                if widget.master.winfo_class() != 'Frame': # Avoid sidebar buttons
-                    widget.configure(bg=theme['accent_bg'], fg=theme['accent_fg'], font=("Arial", 11, "bold"))
-            elif widget_type == 'Treeview':
-                style = ttk.Style()
-                style.configure("Treeview", background=theme['tree_bg'], foreground=theme['tree_fg'], fieldbackground=theme['tree_bg'], font=("Arial", 12, "bold"), rowheight=30)
-                style.map('Treeview', background=[('selected', theme['accent_bg'])])
-                style.configure("Treeview.Heading", background=theme['tree_heading_bg'], foreground=theme['fg'], font=("Arial", 11, "bold"))
-        except tk.TclError:
-            pass # Some widgets might not support all options
+        if widget in widget_roles:
+            continue
+        role = infer_theme_role(widget)
+        if role:
+            register_theme_role(widget, role)
 
+@instrumented('ui')
 def apply_theme_globally():
+    """تطبق السمة الحالية على الأدوار التي تغيرت خياراتها فقط، وتعيد عدد العناصر التي أعيد ضبطها."""
     theme = get_theme()
-    root.configure(bg=theme['bg'])
-    
-    all_widgets = []
-    def collect_widgets(parent):
-        for child in parent.winfo_children():
-            all_widgets.append(child)
-            collect_widgets(child)
-    collect_widgets(root)
-    apply_theme_to_widgets(all_widgets)
+    if root is not None:
+        root.configure(bg=theme['bg'])
+    configure_ttk_styles()
+    touched = 0
+    for role, widgets in themed_widgets.items():
+        options = THEME_ROLES[role](theme)
+        if applied_role_options.get(role) == options:
+            continue
+        applied_role_options[role] = options
+        for widget in list(widgets):
+            try:
+                configure_widget_role(widget, role, options)
+                touched += 1
+            except tk.TclError:
+                widgets.discard(widget)
+    return touched
 
 def toggle_theme():
     global current_theme_name
@@ -518,13 +3672,171 @@ def toggle_theme():
         new_theme = 'light' # Fallback
     set_theme(new_theme)
     save_user_settings(current_user, current_role, new_theme)
+
+def on_settings_changed(event):
+    if 'theme' not in event or root is None:
+        return
     apply_theme_globally()
+    screen = screens.get(current_screen)
+    if screen and screen.get('on_theme'):
+        screen['on_theme']()
+
+subscribe('settings_changed', on_settings_changed)
+
+# === 3.1 رسم المبيعات ===
+SALES_CHART_RANGES = {'7d': ("7 أيام", 7), '30d': ("30 يومًا", 30), '1y': ("سنة", 365)}
+CHART_MIN_BAR_PX = 6  # أقل عرض لعمود بالبكسل؛ يحدد عدد الأعمدة الأقصى حسب عرض اللوحة
+
+def bucket_daily_totals(start, days, totals, max_buckets):
+    """تجمع الإجماليات اليومية في أعمدة متساوية لا يتجاوز عددها max_buckets (مجموع كل فترة)."""
+    per_bucket = max(1, -(-days // max_buckets))
+    labels, values = [], []
+    for offset in range(0, days, per_bucket):
+        first_day = start + timedelta(days=offset)
+        span = min(per_bucket, days - offset)
+        values.append(sum(totals.get((first_day + timedelta(days=i)).isoformat(), 0) or 0 for i in range(span)))
+        labels.append(first_day.strftime('%m-%d'))
+    return labels, values
+
+def create_sales_chart(parent):
+    """لوحة رسم المبيعات بمدى قابل للاختيار. البيانات تُقرأ من الإجماليات اليومية وتُجمَّع
+    حسب عرض اللوحة في خيط خلفي، والأشكال تُخزن لكل (مدى، سمة) وتُحدَّث أعمدتها في مكانها.
+    تعيد قاموسًا فيه refresh: دالة تعيد الرسم فقط إذا تغيرت البيانات أو السمة أو اليوم."""
+    if not matplotlib_available:
+        tk.Label(parent, text="مكتبة Matplotlib غير مثبتة. لا يمكن عرض الرسوم البيانية.").pack()
+        return {'refresh': lambda: None}
+
+    figures = {}     # (المدى، السمة) -> {'ax', 'bars', 'canvas', 'data_key'}
+    results = queue.Queue()
+    state = {'range': '7d', 'visible': None, 'in_flight': set(), 'sales_revision': 0}
+
+    controls = tk.Frame(parent)
+    controls.pack(fill=tk.X)
+    range_var = tk.StringVar(value=state['range'])
+    host = tk.Frame(parent)
+    host.pack(fill=tk.BOTH, expand=True)
+
+    def select_range():
+        state['range'] = range_var.get()
+        refresh()
+
+    for key, (label, _) in SALES_CHART_RANGES.items():
+        tk.Radiobutton(controls, text=label, value=key, variable=range_var, command=select_range).pack(side=tk.RIGHT, padx=5)
+
+    def current_data_key(range_key):
+        width = host.winfo_width()
+        max_buckets = max(7, (width if width > 1 else 800) // CHART_MIN_BAR_PX)
+        return (state['sales_revision'], date.today(), max_buckets)
+
+    def build_figure():
+        theme = get_theme()
+        fig = Figure(figsize=(8, 3), dpi=100)
+        fig.patch.set_facecolor(theme['bg'])
+        ax = fig.add_subplot(111)
+        ax.set_facecolor(theme['bg'])
+        ax.grid(axis='y', alpha=0.3, color=theme['fg'])
+        ax.set_axisbelow(True)
+        ax.set_ylabel("إجمالي المبيعات", color=theme['fg'])
+        ax.set_xlabel("التاريخ", color=theme['fg'])
+        ax.tick_params(axis='x', colors=theme['fg'])
+        ax.tick_params(axis='y', colors=theme['fg'])
+        for spine in ax.spines.values():
+            spine.set_color(theme['fg'])
+        canvas = FigureCanvasTkAgg(fig, master=host)
+        return {'fig': fig, 'ax': ax, 'bars': [], 'canvas': canvas, 'data_key': None}
+
+    def show_figure(entry):
+        widget = entry['canvas'].get_tk_widget()
+        if state['visible'] is not widget:
+            if state['visible'] is not None:
+                state['visible'].pack_forget()
+            widget.pack(fill=tk.BOTH, expand=True)
+            state['visible'] = widget
+
+    @instrumented('ui')
+    def draw(entry, labels, values):
+        ax = entry['ax']
+        tick_step = max(1, len(values) // 8)
+        if len(entry['bars']) == len(values):
+            # نفس عدد الأعمدة: تحديث الارتفاعات فقط
+            for bar, value in zip(entry['bars'], values):
+                bar.set_height(value)
+        else:
+            for bar in entry['bars']:
+                bar.remove()
+            entry['bars'] = list(ax.bar(range(len(values)), values, color=get_theme()['accent_bg'], width=0.8))
+            ax.set_xlim(-0.6, len(values) - 0.4)
+            ax.set_xticks(range(0, len(values), tick_step))
+        ax.set_xticklabels(labels[::tick_step])
+        ax.set_ylim(0, max(values + [1]) * 1.1)
+        if entry['data_key'] is None:
+            entry['fig'].tight_layout()
+        entry['canvas'].draw_idle()
+
+    def request_data(range_key, data_key):
+        """تجلب البيانات وتجمعها في خيط خلفي؛ النتيجة تُطبق على خيط الواجهة عبر poll_results."""
+        days = SALES_CHART_RANGES[range_key][1]
+        max_buckets = data_key[2]
+
+        def work():
+            try:
+                end = date.today()
+                start = end - timedelta(days=days - 1)
+                totals = dict(get_daily_sales_totals(start.isoformat(), end.isoformat()))
+                results.put((range_key, data_key, bucket_daily_totals(start, days, totals, max_buckets)))
+            except sqlite3.Error as e:
+                print(f"Warning: sales chart query failed: {e}")
+                results.put((range_key, data_key, None))
+
+        state['in_flight'].add((range_key, data_key))
+        threading.Thread(target=work, daemon=True).start()
+        host.after(20, poll_results)
+
+    def poll_results():
+        if not host.winfo_exists():
+            return
+        while True:
+            try:
+                range_key, data_key, result = results.get_nowait()
+            except queue.Empty:
+                break
+            state['in_flight'].discard((range_key, data_key))
+            if result is None:
+                continue
+            entry = figures.get((range_key, current_theme_name))
+            if entry is None:
+                entry = figures[(range_key, current_theme_name)] = build_figure()
+            draw(entry, *result)
+            entry['data_key'] = data_key
+            if range_key == state['range']:
+                show_figure(entry)
+        if state['in_flight']:
+            host.after(20, poll_results)
+
+    def refresh():
+        range_key = state['range']
+        entry = figures.get((range_key, current_theme_name))
+        data_key = current_data_key(range_key)
+        if entry is not None:
+            # نعرض الشكل المخزن فورًا حتى لو كان سيُحدَّث بعد قليل
+            show_figure(entry)
+            if entry['data_key'] == data_key:
+                return
+        if (range_key, data_key) not in state['in_flight']:
+            request_data(range_key, data_key)
+
+    def on_sale(event):
+        state['sales_revision'] += 1
+        if host.winfo_ismapped():
+            refresh()
+
+    subscribe('sale_completed', on_sale, owner=host)
+    return {'refresh': refresh}
 
 # === 4. واجهة تسجيل الدخول ===
 def login_screen():
-    global current_user, current_role, current_user_permissions
-    for widget in root.winfo_children():
-        widget.destroy()
+    global current_user, current_role, current_user_permissions, current_shift_id
+    destroy_screens()
     
     root.geometry("400x350")
     root.resizable(False, False)
@@ -543,7 +3855,7 @@ def login_screen():
     pass_entry.pack(pady=5)
 
     def handle_login():
-        global current_user, current_role, current_user_permissions
+        global current_user, current_role, current_user_permissions, current_shift_id
         name = name_entry.get().strip()
         pwd = pass_entry.get().strip()
         if not name or not pwd:
@@ -553,6 +3865,8 @@ def login_screen():
         if emp:
             current_user, current_role, can_discount = emp
             current_user_permissions = {'can_apply_discount': bool(can_discount)}
+            # الوردية تبقى مفتوحة بعد تسجيل الخروج حتى يغلقها البائع، فتُستأنف عند الدخول
+            current_shift_id = get_open_shift(current_user)
             save_user_settings(current_user, current_role, current_theme_name)
             if current_role == "مدير":
                 manager_interface()
@@ -570,36 +3884,83 @@ def login_screen():
     pass_entry.bind("<Return>", lambda e: handle_login())
     name_entry.bind("<Return>", lambda e: pass_entry.focus())
     
+    apply_theme_to_widgets(root.winfo_children())
     apply_theme_globally()
 
 # === 5. واجهات المستخدم ===
-def manager_interface():
+# الشاشات تُبنى مرة واحدة ثم تُخفى وتُظهر، ولا يعاد بناؤها إلا بعد تسجيل الخروج
+screens = {}
+current_screen = None
+
+@instrumented('ui')
+def show_screen(key, builder):
+    """تعرض الشاشة المحفوظة بالمفتاح key وتبنيها عبر builder(frame) عند أول زيارة فقط.
+    يعيد builder قاموسًا اختياريًا فيه on_show: دالة تحدّث لوحات البيانات التي تغيرت منذ آخر عرض."""
+    global current_screen
     root.geometry("1200x700")
     root.resizable(True, True)
 
+    if current_screen is None:
+        # قادمون من شاشة تسجيل الدخول: نزيل عناصرها قبل عرض أول شاشة
+        for widget in root.winfo_children():
+            widget.destroy()
+
+    screen = screens.get(key)
+    if screen is None:
+        frame = tk.Frame(root)
+        screen = builder(frame) or {}
+        screen['frame'] = frame
+        screens[key] = screen
+        apply_theme_to_widgets([frame] + collect_widgets(frame))
+    if current_screen != key:
+        if current_screen in screens:
+            screens[current_screen]['frame'].pack_forget()
+        screen['frame'].pack(fill=tk.BOTH, expand=True)
+        current_screen = key
+    if screen.get('on_show'):
+        screen['on_show']()
+
+def destroy_screens():
+    global current_screen
     for widget in root.winfo_children():
         widget.destroy()
+    screens.clear()
+    current_screen = None
+
+def manager_interface():
+    show_screen('manager', build_manager_screen)
 
+def build_manager_screen(parent):
     buttons = [
         ("الرئيسية", manager_interface),
         ("الانتقال لواجهة البائع", lambda: seller_interface(came_from_manager=True)),
         ("الانتقال لواجهة المخزن", lambda: warehouse_interface(came_from_manager=True)),
-        ("إضافة منتج", lambda: add_product_popup(load_products)),
-        ("تعديل المنتج", lambda: edit_selected_product(tree, load_products)),
+        ("إضافة منتج", add_product_popup),
+        ("تعديل المنتج", lambda: edit_selected_product(tree)),
+        ("تعديل جماعي", lambda: show_bulk_update_window(tree)),
         ("إضافة موظف", add_employee_popup),
         ("عرض الموظفين", show_employees_window),
         ("تغيير معلومات الدخول", change_credentials_popup),
         ("تبديل السمة", toggle_theme),
         ("طباعة ملصق باركود", lambda: print_barcode_for_selected_product(tree)),
+        ("باركودات المنتج", lambda: show_product_barcodes_window(tree)),
         ("استعراض الفواتير", show_invoices_list_window),
+        ("حركة المخزون", show_stock_movements_window),
+        ("إعادة الطلب", show_reorder_window),
+        ("العروض", show_promotions_window),
+        ("الورديات", show_shifts_window),
+        ("المستندات والطباعة", show_documents_window),
+        ("الفروع والتقارير الموحدة", show_branches_window),
+        ("تحليلات المخزون", show_analytics_window),
+        ("أرشفة المبيعات", show_sales_archive_window),
         ("تصدير تقرير", export_daily_report),
         ("نسخ احتياطي", backup_database),
         ("استعادة", restore_database),
         ("تسجيل خروج", login_screen),
     ]
-    create_sidebar(root, buttons)
+    create_sidebar(parent, buttons)
 
-    main_frame = tk.Frame(root)
+    main_frame = tk.Frame(parent)
     main_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
 
     content_frame = tk.Frame(main_frame)
@@ -620,15 +3981,19 @@ def manager_interface():
 
     tk.Label(products_frame, text="قائمة المنتجات", font=("Arial", 16, "bold")).pack(pady=10)
 
-    def load_products(name_filter="", expiry_filter=""):
-        for row in tree.get_children():
-            tree.delete(row)
+    # بعد أول تحميل تبقى اللوحات محدثة عبر الأحداث؛ الفلاتر الحالية تحدد أي المنتجات المتغيرة تُعرض
+    rendered = {'loaded': False, 'filters': ("", "")}
+
+    def product_values(p):
+        return (p['id'], p['name'], p['sell_price'], p['quantity'], p.get('expiry_date') or "غير محدد", p.get('supplier') or "غير محدد")
+
+    @instrumented('ui')
+    def load_products(name_filter="", expiry_filter="", alerts=True):
+        rendered['filters'] = (name_filter, expiry_filter)
         products = get_products_filtered(name_filter, expiry_filter)
-        for p in products:
-            exp_str = p.get('expiry_date') or "غير محدد"
-            supplier_str = p.get('supplier') or "غير محدد"
-            tree.insert("", "end", values=(p['id'], p['name'], p['sell_price'], p['quantity'], exp_str, supplier_str))
-        check_expiry_alerts()
+        sync_tree_rows(tree, product_tree_rows(products))
+        if alerts:
+            check_expiry_alerts()
 
     columns = ("id", "name", "price", "qty", "expiry", "supplier")
     tree = ttk.Treeview(products_frame, columns=columns, show="headings", height=8)
@@ -638,9 +4003,8 @@ def manager_interface():
     tree.pack(pady=10, fill=tk.BOTH, expand=True)
 
     # إضافة ألوان للمخزون
-    theme = get_theme()
-    tree.tag_configure('out_of_stock', background=theme['danger_bg'], foreground='white')
-    tree.tag_configure('low_stock', background=theme['warning_bg'], foreground=theme['warning_fg'])
+    register_theme_role(tree, 'tree')
+    product_tree_rows = bind_product_tree(tree, product_values, lambda: rendered['filters'])
 
     create_product_search_frame(products_frame, load_products)
 
@@ -651,109 +4015,149 @@ def manager_interface():
     bestsellers_tree.heading("qty", text="الكمية المباعة")
     bestsellers_tree.column("qty", width=100, anchor='center')
     bestsellers_tree.pack(fill=tk.BOTH, expand=True)
-    for name, qty_sold in get_best_selling_products():
-        bestsellers_tree.insert("", "end", values=(name, qty_sold))
-
-    def create_sales_chart(parent):
-        if not matplotlib_available:
-            tk.Label(parent, text="مكتبة Matplotlib غير مثبتة. لا يمكن عرض الرسوم البيانية.").pack()
-            return
-
-        data = get_sales_summary_last_7_days()
-        dates = [datetime.strptime(row[0], '%Y-%m-%d').strftime('%m-%d') for row in data]
-        sales = [row[1] for row in data]
-
-        theme = get_theme()
-        plt.style.use('seaborn-v0_8-darkgrid' if current_theme_name == 'dark' else 'seaborn-v0_8-pastel')
-
-        fig = Figure(figsize=(8, 3), dpi=100)
-        fig.patch.set_facecolor(theme['bg'])
-        ax = fig.add_subplot(111)
-        ax.set_facecolor(theme['bg'])
 
-        ax.bar(dates, sales, color=theme['accent_bg'])
-        ax.set_ylabel("إجمالي المبيعات", color=theme['fg'])
-        ax.set_xlabel("التاريخ", color=theme['fg'])
-        ax.tick_params(axis='x', colors=theme['fg'])
-        ax.tick_params(axis='y', colors=theme['fg'])
-        fig.tight_layout()
+    # الكميات المباعة لكل المنتجات: تُحمّل مرة ثم تضاف إليها أسطر كل فاتورة جديدة
+    bestseller_totals = {}
 
-        canvas = FigureCanvasTkAgg(fig, master=parent)
-        canvas.draw()
-        canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+    @instrumented('ui')
+    def refresh_bestsellers():
+        top = sorted(bestseller_totals.items(), key=lambda item: item[1], reverse=True)[:10]
+        sync_tree_rows(bestsellers_tree, [(name, (name, qty_sold)) for name, qty_sold in top])
 
-    create_sales_chart(bottom_frame)
-    load_products()
-    apply_theme_globally()
+    def on_sale(event):
+        if not rendered['loaded']:
+            return
+        for sale in event['sales']:
+            for _, name, _, qty in sale['lines']:
+                bestseller_totals[name] = bestseller_totals.get(name, 0) + qty
+        refresh_bestsellers()
+
+    subscribe('sale_completed', on_sale, owner=bestsellers_tree)
+
+    def on_show():
+        if not rendered['loaded']:
+            rendered['loaded'] = True
+            load_products(*rendered['filters'])
+            bestseller_totals.update(get_best_selling_products(limit=None))
+            refresh_bestsellers()
+        sales_chart['refresh']()
+
+    sales_chart = create_sales_chart(bottom_frame)
+    # نافذة التشخيص مخفية عن القائمة: Ctrl+Shift+D في شاشة المدير فقط
+    parent.winfo_toplevel().bind("<Control-Shift-D>", lambda e: current_screen == 'manager' and show_diagnostics_window())
+    return {'on_show': on_show, 'on_theme': sales_chart['refresh']}
 
 def warehouse_interface(came_from_manager=False):
-    root.geometry("1200x700")
-    root.resizable(True, True)
+    show_screen(('warehouse', came_from_manager), lambda parent: build_warehouse_screen(parent, came_from_manager))
 
-    for widget in root.winfo_children():
-        widget.destroy()
+def build_warehouse_screen(parent, came_from_manager):
+    tk.Label(parent, text="واجهة المخزن", font=("Arial", 18, "bold")).pack(pady=10)
 
-    tk.Label(root, text="واجهة المخزن", font=("Arial", 18, "bold")).pack(pady=10)
+    rendered = {'loaded': False, 'filters': ("", "")}
 
-    def load_products(name_filter="", expiry_filter=""):
-        for row in tree.get_children():
-            tree.delete(row)
-        products = get_products_filtered(name_filter, expiry_filter) #
-        for p in products:
-            exp_str = p.get('expiry_date') or "غير محدد"
-            supplier_str = p.get('supplier') or "غير محدد"
-            tree.insert("", "end", values=(p['name'], p['sell_price'], p['quantity'], exp_str, supplier_str))
-        check_expiry_alerts()
+    def product_values(p):
+        return (p['name'], p['sell_price'], p['quantity'], p.get('expiry_date') or "غير محدد", p.get('supplier') or "غير محدد")
+
+    @instrumented('ui')
+    def load_products(name_filter="", expiry_filter="", alerts=True):
+        rendered['filters'] = (name_filter, expiry_filter)
+        products = get_products_filtered(name_filter, expiry_filter)
+        sync_tree_rows(tree, product_tree_rows(products))
+        if alerts:
+            check_expiry_alerts()
 
     columns = ("name", "price", "qty", "expiry", "supplier")
-    tree = ttk.Treeview(root, columns=columns, show="headings", height=15)
+    tree = ttk.Treeview(parent, columns=columns, show="headings", height=15)
     for col, txt in zip(columns, ["الاسم", "سعر البيع", "الكمية", "الصلاحية", "المورد"]):
         tree.heading(col, text=txt)
     tree.pack(pady=10, fill=tk.BOTH, expand=True)
 
     # إضافة ألوان للمخزون
-    theme = get_theme()
-    tree.tag_configure('out_of_stock', background=theme['danger_bg'], foreground='white')
-    tree.tag_configure('low_stock', background=theme['warning_bg'], foreground=theme['warning_fg'])
+    register_theme_role(tree, 'tree')
+    product_tree_rows = bind_product_tree(tree, product_values, lambda: rendered['filters'])
 
     buttons = [
         ("الرئيسية", lambda: warehouse_interface(came_from_manager=came_from_manager)),
-        ("إضافة منتج", lambda: add_product_popup(load_products)),
-        ("حذف منتج", lambda: delete_selected(tree, load_products)),
+        ("إضافة منتج", add_product_popup),
+        ("استلام دفعة", lambda: receive_lot_popup(tree)),
+        ("دفعات المنتج", lambda: show_product_lots_window(tree)),
+        ("باركودات المنتج", lambda: show_product_barcodes_window(tree)),
+        ("إعادة الطلب", show_reorder_window),
+        ("حذف منتج", lambda: delete_selected(tree)),
         ("تسجيل خروج", login_screen),
     ]
     if came_from_manager:
         buttons.insert(1, ("العودة للمدير", manager_interface))
-    create_sidebar(root, buttons)
+    create_sidebar(parent, buttons)
 
-    create_product_search_frame(root, load_products)
-    load_products()
-    apply_theme_globally()
+    create_product_search_frame(parent, load_products)
 
+    def on_show():
+        if not rendered['loaded']:
+            rendered['loaded'] = True
+            load_products(*rendered['filters'])
 
-def seller_interface(came_from_manager=False):
-    root.geometry("1200x700")
-    root.resizable(True, True)
+    return {'on_show': on_show}
 
-    for widget in root.winfo_children():
-        widget.destroy()
 
+def seller_interface(came_from_manager=False):
+    show_screen(('seller', came_from_manager), lambda parent: build_seller_screen(parent, came_from_manager))
+
+def build_seller_screen(parent, came_from_manager):
     # --- Nested Functions for Seller Interface ---
+    def add_item(product_id, name, price, available, quantity=1):
+        """تضيف إلى السلة (قاموس مفتاحه اسم المنتج) وتعيد تسعير سطر المنتج وحده مع عروضه،
+        ثم تحدّث سطره والإجماليات فقط. تعيد رسالة الخطأ أو None."""
+        item = cart.get(name)
+        in_cart = item['quantity'] if item else 0
+        if in_cart + quantity > available:
+            return f"المنتج {name} غير متوفر" if available - in_cart <= 0 else f"المتوفر من {name}: {available}"
+        if item is None:
+            item = cart[name] = {'product_id': product_id, 'name': name, 'price': float(price), 'quantity': 0, 'promotion_discount': 0}
+        item['quantity'] += quantity
+        previous_discount = item['promotion_discount']
+        item['promotion_id'], item['promotion_discount'] = price_line(product_id, item['price'], item['quantity'])
+        invoice_state['subtotal'] += item['price'] * quantity
+        invoice_state['promotions'] += item['promotion_discount'] - previous_discount
+        render_invoice_line(item)
+        update_totals()
+        return None
+
     def add_to_cart():
         sel = prod_tree.selection()
         if not sel: return
-        item = prod_tree.item(sel[0])
-        name, price, qty_avail = item['values']
-        if qty_avail <= 0:
-            messagebox.showwarning("نفدت الكمية", f"المنتج {name} غير متوفر")
-            return
-        for c in cart:
-            if c['name'] == name:
-                c['quantity'] += 1
-                update_invoice()
-                return
-        cart.append({'name': name, 'price': float(price), 'quantity': 1})
-        update_invoice()
+        name, price, qty_avail = prod_tree.item(sel[0])['values']
+        error = add_item(int(sel[0]), str(name), price, qty_avail)
+        if error:
+            messagebox.showwarning("نفدت الكمية", error)
+        refocus_scanner()
+
+    def on_scan(event=None):
+        code = scan_entry.get().strip()
+        scan_entry.delete(0, tk.END)
+        if not code:
+            return "break"
+        found = lookup_barcode(code)
+        if found is None:
+            show_scan_status(f"غير مسجل: {code}", error=True)
+            return "break"
+        product, pack_qty = found
+        error = add_item(product['id'], product['name'], product['sell_price'], product['quantity'], pack_qty)
+        if error:
+            show_scan_status(error, error=True)
+        else:
+            show_scan_status(f"✔ {product['name']}" + (f" × {pack_qty}" if pack_qty > 1 else ""))
+        return "break"
+
+    def show_scan_status(text, error=False):
+        scan_status.config(text=text)
+        register_theme_role(scan_status, 'danger_label' if error else 'label')
+        if error:
+            scan_status.bell()
+
+    def refocus_scanner():
+        if scan_mode.get():
+            scan_entry.focus_set()
 
     def scan_barcode():
         if not pyzbar:
@@ -771,81 +4175,112 @@ def seller_interface(came_from_manager=False):
             if not barcodes:
                 messagebox.showwarning("لا يوجد باركود", "لم يتم العثور على باركود في الصورة")
                 return
-            barcode_data = barcodes[0].data.decode("utf-8")
-            product = get_product_by_barcode(barcode_data)
-            if product:
-                if product['quantity'] <= 0:
-                    messagebox.showwarning("نفدت الكمية", f"المنتج {product['name']} غير متوفر")
-                    return
-                for c in cart:
-                    if c['name'] == product['name']:
-                        c['quantity'] += 1
-                        update_invoice()
-                        return
-                cart.append({'name': product['name'], 'price': product['sell_price'], 'quantity': 1})
-                update_invoice()
-                messagebox.showinfo("تم", f"تمت إضافة المنتج:\n{product['name']}")
-            else:
-                messagebox.showerror("غير موجود", f"المنتج بالباركود:\n{barcode_data}\nغير مسجل في المخزن")
+            scan_entry.delete(0, tk.END)
+            scan_entry.insert(0, barcodes[0].data.decode("utf-8"))
+            on_scan()
         except Exception as e:
             messagebox.showerror("خطأ", f"فشل في قراءة الباركود:\n{e}")
-
-    def update_invoice():
-        theme = get_theme()
+        refocus_scanner()
+
+    @instrumented('ui')
+    def render_invoice_line(item):
+        """سطر كل منتج في نص الفاتورة ثابت الموضع (بترتيب إضافته)، فيُستبدل وحده عند تغير كميته."""
+        text = f"{item['name']} × {item['quantity']} = {item['price'] * item['quantity'] - item['promotion_discount']:.2f}"
+        if item['promotion_discount']:
+            text += f"  [{promotion_name(item['promotion_id'])}: -{item['promotion_discount']:.2f}]"
+        row = invoice_state['rows'].get(item['name'])
+        if row is None:
+            row = invoice_state['rows'][item['name']] = len(invoice_state['rows']) + 1
+            invoice_text.insert(f"{row}.0", text + "\n")
+        else:
+            invoice_text.delete(f"{row}.0", f"{row}.end")
+            invoice_text.insert(f"{row}.0", text)
+        invoice_text.see(f"{row}.0")
+
+    def clear_cart():
+        cart.clear()
+        invoice_state['rows'].clear()
+        invoice_state['subtotal'] = 0
+        invoice_state['promotions'] = 0
         invoice_text.delete(1.0, tk.END)
-        subtotal = 0
-        for item in cart:
-            line_total = item['price'] * item['quantity']
-            invoice_text.insert(tk.END, f"{item['name']} × {item['quantity']} = {line_total:.2f}\n")
-            subtotal += line_total
-        
-        discount_percentage = 0
+        update_totals()
+        refocus_scanner()
+
+    def current_discount():
         try:
-            discount_val = discount_entry.get()
-            if discount_val:
-                discount_percentage = float(discount_val)
+            return float(discount_entry.get() or 0)
         except (ValueError, TypeError):
-            discount_percentage = 0
+            return 0
 
-        discount_amount = (subtotal * discount_percentage) / 100
-        final_total = subtotal - discount_amount
+    def cart_totals(subtotal, promotions):
+        """الخصم اليدوي يُطبق على الصافي بعد العروض، كما في checkout."""
+        discount_percentage = current_discount()
+        discount_amount = (subtotal - promotions) * discount_percentage / 100
+        return discount_percentage, discount_amount, subtotal - promotions - discount_amount
 
+    def update_totals():
+        subtotal, promotions = invoice_state['subtotal'], invoice_state['promotions']
+        discount_percentage, discount_amount, final_total = cart_totals(subtotal, promotions)
         subtotal_label.config(text=f"المجموع الفرعي: {subtotal:.2f}")
-        discount_amount_label.config(text=f"الخصم ({discount_percentage}%): -{discount_amount:.2f}", fg=theme['danger_bg'])
+        promotions_label.config(text=f"العروض: -{promotions:.2f}")
+        discount_amount_label.config(text=f"الخصم ({discount_percentage}%): -{discount_amount:.2f}")
         total_label.config(text=f"الإجمالي النهائي: {final_total:.2f}")
 
+    def start_shift(opening_cash=0):
+        global current_shift_id
+        current_shift_id = open_shift(current_user, opening_cash)
+        update_shift_label()
+
+    def open_shift_dialog():
+        if current_shift_id is not None:
+            messagebox.showinfo("الوردية", f"الوردية #{current_shift_id} مفتوحة بالفعل")
+            return
+        opening_cash = simpledialog.askfloat("فتح وردية", "النقد الافتتاحي في الدرج:", minvalue=0, initialvalue=0)
+        if opening_cash is not None:
+            start_shift(opening_cash)
+        refocus_scanner()
+
+    def close_shift_dialog():
+        global current_shift_id
+        if current_shift_id is None:
+            messagebox.showwarning("الوردية", "لا توجد وردية مفتوحة")
+            return
+        if cart and not messagebox.askyesno("تأكيد", "الفاتورة الحالية لم تُبع بعد. إغلاق الوردية على أي حال؟"):
+            return
+        counted_cash = simpledialog.askfloat("إغلاق الوردية", "النقد المعدود في الدرج:", minvalue=0)
+        if counted_cash is None:
+            return
+        report = close_shift(current_shift_id, counted_cash)
+        current_shift_id = None
+        update_shift_label()
+        if report:
+            show_z_report(report)
+
+    def update_shift_label(event=None):
+        global current_shift_id
+        if event is not None and current_shift_id in event.get('ids', ()):
+            # أُغلقت من نافذة الورديات مثلًا: نتحقق من الحالة الفعلية
+            current_shift_id = get_open_shift(current_user)
+        report = get_shift_report(current_shift_id) if current_shift_id is not None else None
+        if report is None or report['closed_at']:
+            shift_label.config(text="لا توجد وردية مفتوحة (تُفتح تلقائيًا مع أول بيع)")
+            return
+        shift_label.config(text=f"الوردية #{report['id']} منذ {report['opened_at'][11:16]} — "
+                                f"الفواتير: {report['invoice_count']} — الصافي: {report['net_total']:.2f}")
+
     def finalize_sale():
         if not cart:
             messagebox.showwarning("فاتورة فارغة", "لا يوجد منتجات")
             return
-        all_success = True
-        invoice_id = None
-
-        discount_percentage = 0
-        try:
-            discount_val = discount_entry.get()
-            if discount_val:
-                discount_percentage = float(discount_val)
-        except (ValueError, TypeError):
-            discount_percentage = 0
-        
-        discount_factor = 1 - (discount_percentage / 100)
-
-        for item in cart:
-            discounted_price = item['price'] * discount_factor
-            success, msg = sell_product(item['name'], discounted_price, item['quantity'])
-            if not success:
-                messagebox.showerror("خطأ في البيع", msg)
-                all_success = False
-                break
-            else:
-                invoice_id = msg
-        if all_success:
-            export_invoice_to_excel(invoice_id)
-            messagebox.showinfo("تم البيع", f"تم إنشاء الفاتورة:\n{invoice_id}")
-            cart.clear()
-            update_invoice()
-            load_products()
+        if current_shift_id is None:
+            start_shift()
+        success, msg = checkout(list(cart.values()), current_discount(), current_shift_id)
+        if not success:
+            messagebox.showerror("خطأ في البيع", msg)
+            return
+        # الإيصال يُجهز في طابور المستندات بعد الالتزام، فيبدأ البيع التالي فورًا
+        clear_cart()
+        show_scan_status(f"تم البيع: {msg}")
 
     def preview_invoice_popup():
         if not cart:
@@ -867,25 +4302,19 @@ def seller_interface(came_from_manager=False):
         tree.heading("subtotal", text="المجموع الفرعي")
         tree.pack(pady=5, padx=10, fill=tk.BOTH, expand=True)
 
-        subtotal = 0
-        for item in cart:
-            line_total = item['price'] * item['quantity']
+        for item in cart.values():
+            line_total = item['price'] * item['quantity'] - item['promotion_discount']
             tree.insert("", "end", values=(item['name'], f"{item['price']:.2f}", item['quantity'], f"{line_total:.2f}"))
-            subtotal += line_total
 
-        discount_percentage = 0
-        try:
-            discount_val = discount_entry.get()
-            if discount_val: discount_percentage = float(discount_val)
-        except (ValueError, TypeError): pass
-
-        discount_amount = (subtotal * discount_percentage) / 100
-        final_total = subtotal - discount_amount
+        subtotal, promotions = invoice_state['subtotal'], invoice_state['promotions']
+        discount_percentage, discount_amount, final_total = cart_totals(subtotal, promotions)
 
         total_frame_popup = tk.Frame(win)
         total_frame_popup.pack(pady=10, fill=tk.X, padx=10)
         tk.Label(total_frame_popup, text=f"المجموع الفرعي: {subtotal:.2f}", font=("Arial", 12)).pack(anchor='e')
-        tk.Label(total_frame_popup, text=f"الخصم ({discount_percentage}%): -{discount_amount:.2f}", font=("Arial", 12), fg=get_theme()['danger_bg']).pack(anchor='e')
+        if promotions:
+            register_theme_role(tk.Label(total_frame_popup, text=f"العروض: -{promotions:.2f}", font=("Arial", 12)), 'danger_label').pack(anchor='e')
+        register_theme_role(tk.Label(total_frame_popup, text=f"الخصم ({discount_percentage}%): -{discount_amount:.2f}", font=("Arial", 12)), 'danger_label').pack(anchor='e')
         tk.Label(total_frame_popup, text=f"الإجمالي النهائي: {final_total:.2f}", font=("Arial", 14, "bold")).pack(anchor='e')
         apply_theme_to_widgets(win.winfo_children())
 
@@ -895,59 +4324,86 @@ def seller_interface(came_from_manager=False):
         ("قراءة باركود", scan_barcode),
         ("معاينة الفاتورة", preview_invoice_popup),
         ("تم البيع", finalize_sale),
-        ("إلغاء", lambda: [cart.clear(), update_invoice()]),
+        ("إلغاء", clear_cart),
+        ("فتح وردية", open_shift_dialog),
+        ("إغلاق الوردية (Z)", close_shift_dialog),
         ("تسجيل خروج", login_screen),
     ]
     if came_from_manager:
         buttons.insert(0, ("العودة للمدير", manager_interface))
-    create_sidebar(root, buttons)
-
-    tk.Label(root, text="واجهة البائع", font=("Arial", 18, "bold")).pack(pady=10)
-
+    create_sidebar(parent, buttons)
+
+    tk.Label(parent, text="واجهة البائع", font=("Arial", 18, "bold")).pack(pady=10)
+    shift_label = tk.Label(parent, text="", font=("Arial", 11))
+    shift_label.pack(anchor='e', padx=10)
+    subscribe('sale_completed', lambda event: update_shift_label(), owner=shift_label)
+    subscribe('shift_changed', update_shift_label, owner=shift_label)
+
+    # خانة المسح: قارئات الباركود USB تكتب الرمز ثم Enter
+    scan_frame = tk.Frame(parent)
+    scan_frame.pack(pady=5, fill=tk.X)
+    scan_mode = tk.BooleanVar(value=True)
+    tk.Checkbutton(scan_frame, text="وضع المسح السريع", variable=scan_mode, command=lambda: refocus_scanner()).pack(side=tk.RIGHT, padx=5)
+    tk.Label(scan_frame, text="الباركود:").pack(side=tk.RIGHT)
+    scan_entry = tk.Entry(scan_frame, width=30, font=("Arial", 12))
+    scan_entry.pack(side=tk.RIGHT, padx=5)
+    scan_entry.bind("<Return>", on_scan)
+    scan_entry.bind("<KP_Enter>", on_scan)
+    scan_status = tk.Label(scan_frame, text="", font=("Arial", 11, "bold"))
+    scan_status.pack(side=tk.RIGHT, padx=10)
+    # إنهاء البيع وإلغاؤه من لوحة المفاتيح دون مغادرة خانة المسح
+    scan_entry.bind("<F12>", lambda e: finalize_sale())
+    scan_entry.bind("<Escape>", lambda e: clear_cart())
+
+    rendered = {'loaded': False, 'filter': ""}
+
+    def product_values(p):
+        return (p['name'], p['sell_price'], p['quantity'])
+
+    @instrumented('ui')
     def load_products(name_filter=""):
-        for row in prod_tree.get_children():
-            prod_tree.delete(row)
+        rendered['filter'] = name_filter
         products = get_products_filtered(name_filter)
-        for p in products:
-            prod_tree.insert("", "end", values=(p['name'], p['sell_price'], p['quantity']))
+        sync_tree_rows(prod_tree, product_tree_rows(products))
 
     columns = ("name", "price", "qty")
-    prod_tree = ttk.Treeview(root, columns=columns, show="headings", height=10)
+    prod_tree = ttk.Treeview(parent, columns=columns, show="headings", height=10)
     prod_tree.heading("name", text="المنتج")
     prod_tree.heading("price", text="سعر البيع")
     prod_tree.heading("qty", text="الكمية")
     prod_tree.pack(pady=10, fill=tk.BOTH, expand=True)
     
     # إضافة ألوان للمخزون
-    theme = get_theme()
-    prod_tree.tag_configure('out_of_stock', background=theme['danger_bg'], foreground='white')
-    prod_tree.tag_configure('low_stock', background=theme['warning_bg'], foreground=theme['warning_fg'])
+    register_theme_role(prod_tree, 'tree')
+    product_tree_rows = bind_product_tree(prod_tree, product_values, lambda: (rendered['filter'], ""))
 
     # إضافة شريط البحث
-    create_search_bar(root, load_products)
+    create_search_bar(parent, load_products)
 
-    global cart
-    cart = []
-    invoice_frame = tk.Frame(root)
+    cart = {}  # اسم المنتج -> سطر السلة، بترتيب الإضافة
+    invoice_state = {'rows': {}, 'subtotal': 0, 'promotions': 0}  # رقم سطر كل منتج في نص الفاتورة، والمجاميع الجارية
+    invoice_frame = tk.Frame(parent)
     invoice_frame.pack(pady=10, fill=tk.X)
     
     tk.Label(invoice_frame, text="الفاتورة", font=("Arial", 14, "bold")).pack()
     invoice_text = tk.Text(invoice_frame, height=8)
     invoice_text.pack(pady=5, fill=tk.X)
 
-    discount_frame = tk.Frame(root)
+    discount_frame = tk.Frame(parent)
     discount_frame.pack(pady=5, fill=tk.X)
     tk.Label(discount_frame, text="نسبة الخصم (%):").pack(side=tk.RIGHT, padx=5)
     discount_entry = tk.Entry(discount_frame, width=10)
     discount_entry.pack(side=tk.RIGHT) 
-    discount_button = tk.Button(discount_frame, text="تطبيق الخصم", command=update_invoice, font=("Arial", 10, "bold"))
+    discount_button = tk.Button(discount_frame, text="تطبيق الخصم", command=update_totals, font=("Arial", 10, "bold"))
     discount_button.pack(side=tk.RIGHT, padx=5)
 
-    total_frame = tk.Frame(root)
+    total_frame = tk.Frame(parent)
     total_frame.pack(pady=5, fill=tk.X)
     subtotal_label = tk.Label(total_frame, text="المجموع الفرعي: 0.00", font=("Arial", 12))
     subtotal_label.pack(anchor='e')
-    discount_amount_label = tk.Label(total_frame, text="الخصم: -0.00", font=("Arial", 12))
+    promotions_label = register_theme_role(tk.Label(total_frame, text="العروض: -0.00", font=("Arial", 12)), 'danger_label')
+    promotions_label.pack(anchor='e')
+    discount_amount_label = register_theme_role(tk.Label(total_frame, text="الخصم: -0.00", font=("Arial", 12)), 'danger_label')
     discount_amount_label.pack(anchor='e')
     total_label = tk.Label(total_frame, text="الإجمالي النهائي: 0.00", font=("Arial", 14, "bold"))
     total_label.pack(anchor='e')
@@ -956,50 +4412,31 @@ def seller_interface(came_from_manager=False):
         discount_entry.config(state=tk.DISABLED)
         discount_button.config(state=tk.DISABLED)
 
-    apply_theme_globally()
-
-    def export_invoice_to_excel(invoice_id):
-        sales = get_sales_by_invoice(invoice_id)
-        if not sales:
-            return
-        filepath = filedialog.asksaveasfilename(
-            defaultextension=".xlsx",
-            filetypes=[("Excel", "*.xlsx")],
-            initialfile=f"{invoice_id}.xlsx"
-        )
-        if not filepath:
-            return
-        wb = Workbook()
-        ws = wb.active
-        ws.title = invoice_id
-        ws.append(["فاتورة بيع"])
-        ws.append(["رقم الفاتورة:", invoice_id])
-        ws.append(["التاريخ:", sales[0][3][:10]])
-        ws.append([])
-        ws.append(["المنتج", "السعر", "الكمية", "المجموع"])
-        total = 0
-        for name, price, qty, _ in sales:
-            line_total = price * qty
-            ws.append([name, price, qty, line_total])
-            total += line_total
-        ws.append(["", "", "الإجمالي:", total])
-        wb.save(filepath)
+    def on_show():
+        if not rendered['loaded']:
+            rendered['loaded'] = True
+            load_products(rendered['filter'])
+        update_shift_label()
+        refocus_scanner()
 
-    load_products()
-    apply_theme_globally()
+    return {'on_show': on_show}
 
 # === 6. دوال الدعم ===
-def add_product_popup(refresh_callback):
+def add_product_popup():
     win = tk.Toplevel()
     win.title("إضافة منتج")
-    win.geometry("320x380")
+    win.geometry("320x430")
     win.resizable(False, False)
     win.configure(bg=get_theme()['bg'])
 
-    tk.Label(win, text="الاسم (يمكن أن يكون الباركود):").pack(pady=(10, 0))
+    tk.Label(win, text="الاسم:").pack(pady=(10, 0))
     name_e = tk.Entry(win, width=35)
     name_e.pack()
 
+    tk.Label(win, text="الباركود [اختياري]:").pack()
+    barcode_e = tk.Entry(win, width=35)
+    barcode_e.pack()
+
     tk.Label(win, text="سعر الشراء (رقم عشري):").pack()
     cost_e = tk.Entry(win, width=35)
     cost_e.pack()
@@ -1072,19 +4509,18 @@ def add_product_popup(refresh_callback):
 
         supplier = supplier_e.get().strip() or None
 
-        if add_product_to_db(name, cost, sell, qty, exp_str, supplier):
+        if add_product_to_db(name, cost, sell, qty, exp_str, supplier, barcode_e.get().strip() or None):
             messagebox.showinfo("تم", f"✅ تم إضافة المنتج:\n{name}")
-            refresh_callback()
             win.destroy()
         else:
-            error_label.config(text="❌ اسم المنتج مستخدم مسبقًا")
+            error_label.config(text="❌ اسم المنتج أو الباركود مستخدم مسبقًا")
 
     tk.Button(win, text="حفظ المنتج", command=save_prod, width=20, font=("Arial", 11, "bold")).pack(pady=15)
     
     # تطبيق السمة على النافذة المنبثقة
     apply_theme_to_widgets(win.winfo_children())
 
-def edit_selected_product(tree, refresh_callback):
+def edit_selected_product(tree):
     selected = tree.selection()
     if not selected:
         messagebox.showwarning("تحذير", "الرجاء اختيار منتج لتعديله")
@@ -1102,9 +4538,9 @@ def edit_selected_product(tree, refresh_callback):
         messagebox.showerror("خطأ", "لم يتم العثور على المنتج")
         return
 
-    edit_product_popup(product_data, refresh_callback)
+    edit_product_popup(product_data)
 
-def edit_product_popup(product_data, refresh_callback):
+def edit_product_popup(product_data):
     p_id, p_name, p_cost, p_sell, p_qty, p_expiry, p_supplier = product_data
 
     win = tk.Toplevel()
@@ -1160,20 +4596,182 @@ def edit_product_popup(product_data, refresh_callback):
 
         supplier = supplier_e.get().strip() or None
 
-        success, msg = update_product_in_db(p_id, name, cost, sell, qty, exp_str, supplier)
-        if success:
-            messagebox.showinfo("تم", f"✅ تم تحديث المنتج:\n{name}", parent=win)
-            refresh_callback()
-            win.destroy()
-        else:
-            error_label.config(text=f"❌ {msg}")
+        success, msg = update_product_in_db(p_id, name, cost, sell, qty, exp_str, supplier)
+        if success:
+            messagebox.showinfo("تم", f"✅ تم تحديث المنتج:\n{name}", parent=win)
+            win.destroy()
+        else:
+            error_label.config(text=f"❌ {msg}")
+
+    save_button = tk.Button(win, text="حفظ التغييرات", command=save_changes, width=20, font=("Arial", 11, "bold"))
+    # استخدام لون مميز للحفظ
+    register_theme_role(save_button, 'button').pack(pady=15)
+    
+    apply_theme_to_widgets(win.winfo_children())
+
+def receive_lot_popup(tree):
+    selected = tree.selection()
+    if not selected:
+        messagebox.showwarning("تحذير", "الرجاء اختيار منتج لاستلام دفعة منه")
+        return
+    # معرّف الصف هو رقم المنتج؛ Tk يعيد الأسماء الرقمية مثل "0012345" أعدادًا فلا يُبحث بالاسم المعروض
+    product_id = int(selected[0])
+    products = get_products_by_ids({product_id})
+    if not products:
+        messagebox.showerror("خطأ", "لم يتم العثور على المنتج")
+        return
+    product_name = products[0]['name']
+
+    win = tk.Toplevel()
+    win.title(f"استلام دفعة: {product_name}")
+    win.geometry("320x300")
+    win.resizable(False, False)
+    win.configure(bg=get_theme()['bg'])
+
+    tk.Label(win, text="الكمية (عدد صحيح):").pack(pady=(10, 0)); qty_e = tk.Entry(win, width=35); qty_e.pack()
+    tk.Label(win, text="تاريخ الانتهاء (YYYY-MM-DD) [اختياري]:").pack(); exp_e = tk.Entry(win, width=35); exp_e.pack()
+    tk.Label(win, text="المورد [اختياري]:").pack(); supplier_e = tk.Entry(win, width=35); supplier_e.pack()
+    tk.Label(win, text="سعر الشراء [اختياري]:").pack(); cost_e = tk.Entry(win, width=35); cost_e.pack()
+
+    error_label = tk.Label(win, text="", fg="red")
+    error_label.pack(pady=5)
+
+    def save_lot():
+        try:
+            qty = int(qty_e.get().strip())
+            if qty <= 0:
+                error_label.config(text="❌ الكمية يجب أن تكون > 0"); return
+        except ValueError:
+            error_label.config(text="❌ الكمية يجب أن تكون عددًا صحيحًا"); return
+
+        exp_str = exp_e.get().strip() or None
+        if exp_str:
+            try:
+                datetime.strptime(exp_str, "%Y-%m-%d")
+            except ValueError:
+                error_label.config(text="❌ صيغة التاريخ: YYYY-MM-DD"); return
+
+        cost = None
+        if cost_e.get().strip():
+            try:
+                cost = float(cost_e.get().strip())
+            except ValueError:
+                error_label.config(text="❌ سعر الشراء غير صحيح"); return
+
+        success, msg = receive_stock(product_id, qty, "استلام دفعة", exp_str, supplier_e.get().strip() or None, cost)
+        if success:
+            messagebox.showinfo("تم", f"✅ تم استلام {qty} من {product_name}", parent=win)
+            win.destroy()
+        else:
+            error_label.config(text=f"❌ {msg}")
+
+    tk.Button(win, text="حفظ الدفعة", command=save_lot, width=20, font=("Arial", 11, "bold")).pack(pady=15)
+    apply_theme_to_widgets(win.winfo_children())
+
+def show_product_lots_window(tree):
+    selected = tree.selection()
+    if not selected:
+        messagebox.showwarning("تحذير", "الرجاء اختيار منتج لعرض دفعاته")
+        return
+    # معرّف الصف هو رقم المنتج؛ Tk يعيد الأسماء الرقمية مثل "0012345" أعدادًا فلا يُبحث بالاسم المعروض
+    product_id = int(selected[0])
+    products = get_products_by_ids({product_id})
+    if not products:
+        messagebox.showerror("خطأ", "لم يتم العثور على المنتج")
+        return
+    product_name = products[0]['name']
+
+    win = tk.Toplevel()
+    win.title(f"دفعات المنتج: {product_name}")
+    win.geometry("650x350")
+
+    columns = ("qty", "expiry", "supplier", "cost", "received")
+    lots_tree = ttk.Treeview(win, columns=columns, show="headings")
+    for col, txt in zip(columns, ["الكمية", "الصلاحية", "المورد", "سعر الشراء", "تاريخ الاستلام"]):
+        lots_tree.heading(col, text=txt)
+        lots_tree.column(col, width=110, anchor='center')
+    lots_tree.pack(pady=10, padx=10, fill=tk.BOTH, expand=True)
+
+    for lot in get_product_lots(product_id):
+        lots_tree.insert("", "end", values=(
+            lot['quantity'], lot['expiry_date'] or "غير محدد", lot['supplier'] or "غير محدد",
+            f"{lot['cost_price']:.2f}" if lot['cost_price'] is not None else "-", lot['received_at']
+        ))
+    apply_theme_to_widgets(win.winfo_children())
+
+def show_product_barcodes_window(tree):
+    selected = tree.selection()
+    if not selected:
+        messagebox.showwarning("تحذير", "الرجاء اختيار منتج لعرض رموزه")
+        return
+    # معرّف الصف في جداول المنتجات هو رقم المنتج
+    product_id = int(selected[0])
+    products = get_products_by_ids({product_id})
+    if not products:
+        messagebox.showerror("خطأ", "لم يتم العثور على المنتج")
+        return
+
+    win = tk.Toplevel()
+    win.title(f"باركودات المنتج: {products[0]['name']}")
+    win.geometry("450x380")
+
+    columns = ("code", "pack_qty")
+    codes_tree = ttk.Treeview(win, columns=columns, show="headings")
+    codes_tree.heading("code", text="الباركود")
+    codes_tree.heading("pack_qty", text="عدد القطع")
+    codes_tree.column("code", width=250, anchor='center')
+    codes_tree.column("pack_qty", width=100, anchor='center')
+    codes_tree.pack(pady=10, padx=10, fill=tk.BOTH, expand=True)
+    codes = list(get_product_barcodes({product_id}).get(product_id, []))
+
+    def refresh():
+        codes_tree.delete(*codes_tree.get_children())
+        for code, pack_qty in codes:
+            codes_tree.insert("", "end", iid=code, values=(code, pack_qty))
+
+    def save(new_codes):
+        success, msg = set_product_barcodes(product_id, new_codes)
+        if not success:
+            messagebox.showerror("خطأ", msg, parent=win)
+            return
+        codes[:] = new_codes
+        refresh()
 
-    theme = get_theme()
-    save_button = tk.Button(win, text="حفظ التغييرات", command=save_changes, width=20, font=("Arial", 11, "bold"))
-    # استخدام لون مميز للحفظ
-    save_button.config(bg=theme.get('accent_bg', '#28A745'), fg=theme.get('accent_fg', 'white'))
-    save_button.pack(pady=15)
-    
+    def add_code():
+        code = code_e.get().strip()
+        try:
+            pack_qty = int(pack_e.get().strip() or 1)
+            if pack_qty <= 0:
+                raise ValueError
+        except ValueError:
+            messagebox.showerror("خطأ", "عدد القطع يجب أن يكون عددًا صحيحًا موجبًا", parent=win)
+            return
+        if not code:
+            return
+        save([(c, q) for c, q in codes if c != code] + [(code, pack_qty)])
+        code_e.delete(0, tk.END)
+
+    def delete_code():
+        sel = codes_tree.selection()
+        if sel:
+            save([(c, q) for c, q in codes if c != sel[0]])
+
+    form = tk.Frame(win)
+    form.pack(pady=5)
+    tk.Label(form, text="الباركود:").pack(side=tk.RIGHT)
+    code_e = tk.Entry(form, width=20)
+    code_e.pack(side=tk.RIGHT, padx=5)
+    tk.Label(form, text="عدد القطع:").pack(side=tk.RIGHT)
+    pack_e = tk.Entry(form, width=5)
+    pack_e.insert(0, "1")
+    pack_e.pack(side=tk.RIGHT, padx=5)
+    code_e.bind("<Return>", lambda e: add_code())
+    button_frame = tk.Frame(win)
+    button_frame.pack(pady=5)
+    tk.Button(button_frame, text="إضافة", command=add_code, font=("Arial", 10, "bold")).pack(side=tk.RIGHT, padx=5)
+    tk.Button(button_frame, text="حذف المحدد", command=delete_code, font=("Arial", 10, "bold")).pack(side=tk.RIGHT, padx=5)
+
+    refresh()
     apply_theme_to_widgets(win.winfo_children())
 
 def show_employees_window():
@@ -1188,11 +4786,24 @@ def show_employees_window():
     tree.heading("role", text="الدور")
     tree.column("id", width=50)
 
+    current_filter = {'name': ""}
+
+    @instrumented('ui')
     def refresh_employees(filter_name=""): # refresh_employees is already defined inside show_employees_window
-        for row in tree.get_children():
-            tree.delete(row)
-        for emp_id, name, role in get_all_employees(filter_name):
-            tree.insert("", "end", values=(emp_id, name, role))
+        current_filter['name'] = filter_name
+        sync_tree_rows(tree, [(emp_id, (emp_id, name, role)) for emp_id, name, role in get_all_employees(filter_name)])
+
+    def on_employee_changed(event):
+        rows, removed = [], set()
+        for emp_id in event['ids']:
+            details = get_employee_details(emp_id)
+            if details and current_filter['name'].lower() in details[1].lower():
+                rows.append((emp_id, details[:3]))
+            else:
+                removed.add(emp_id)
+        apply_tree_delta(tree, rows, removed)
+
+    subscribe('employee_changed', on_employee_changed, owner=tree)
 
     search_frame = tk.Frame(win) # search_frame is already defined inside show_employees_window
     search_frame.pack(pady=5, padx=10, fill=tk.X)
@@ -1223,7 +4834,7 @@ def show_employees_window():
             messagebox.showerror("خطأ", "لا يمكن تعديل بيانات حساب المدير.", parent=win)
             return
 
-        edit_employee_popup(employee_details, refresh_employees)
+        edit_employee_popup(employee_details)
 
     def delete_selected_employee():
         selected = tree.selection()
@@ -1241,18 +4852,18 @@ def show_employees_window():
         if messagebox.askyesno("تأكيد الحذف", f"هل أنت متأكد من حذف الموظف: {name}؟", parent=win):
             delete_employee_from_db(emp_id)
             messagebox.showinfo("تم", f"تم حذف الموظف: {name}", parent=win)
-            refresh_employees()
 
     buttons_frame = tk.Frame(win)
     buttons_frame.pack(pady=10)
-    theme = get_theme()
-    tk.Button(buttons_frame, text="تعديل الموظف المحدد", command=edit_selected_employee, bg=theme['warning_bg'], fg=theme['warning_fg'], font=("Arial", 10, "bold")).pack(side=tk.LEFT, padx=5)
-    tk.Button(buttons_frame, text="حذف الموظف المحدد", command=delete_selected_employee, bg=theme['danger_bg'], fg=theme['button_fg'], font=("Arial", 10, "bold")).pack(side=tk.LEFT, padx=5)
+    edit_button = tk.Button(buttons_frame, text="تعديل الموظف المحدد", command=edit_selected_employee, font=("Arial", 10, "bold"))
+    register_theme_role(edit_button, 'warning_button').pack(side=tk.LEFT, padx=5)
+    delete_button = tk.Button(buttons_frame, text="حذف الموظف المحدد", command=delete_selected_employee, font=("Arial", 10, "bold"))
+    register_theme_role(delete_button, 'danger_button').pack(side=tk.LEFT, padx=5)
 
     refresh_employees()
     apply_theme_to_widgets(win.winfo_children())
 
-def edit_employee_popup(employee_data, refresh_callback):
+def edit_employee_popup(employee_data):
     win = tk.Toplevel()
     emp_id, emp_name, emp_role, can_discount = employee_data
     win.title(f"تعديل الموظف: {emp_name}")
@@ -1294,7 +4905,6 @@ def edit_employee_popup(employee_data, refresh_callback):
             update_employee_in_db(emp_id, new_role, new_can_discount)
 
         messagebox.showinfo("تم التحديث", f"تم تحديث بيانات الموظف: {emp_name}", parent=win)
-        refresh_callback()
         win.destroy()
 
     tk.Button(win, text="حفظ التغييرات", command=save_changes, font=("Arial", 11, "bold")).pack(pady=15)
@@ -1303,27 +4913,1123 @@ def edit_employee_popup(employee_data, refresh_callback):
 def show_invoices_list_window():
     win = tk.Toplevel()
     win.title("استعراض الفواتير")
-    win.geometry("600x400")
+    win.geometry("750x500")
+
+    filter_frame = tk.Frame(win)
+    filter_frame.pack(pady=5, padx=10, fill=tk.X)
+    filter_entries = {}
+    for key, label, width in [("id_prefix", "رقم الفاتورة يبدأ بـ:", 16), ("start_date", "من تاريخ:", 11),
+                              ("end_date", "إلى تاريخ:", 11), ("min_total", "المبلغ من:", 8), ("max_total", "إلى:", 8)]:
+        tk.Label(filter_frame, text=label).pack(side=tk.RIGHT)
+        entry = tk.Entry(filter_frame, width=width)
+        entry.pack(side=tk.RIGHT, padx=(0, 5))
+        filter_entries[key] = entry
 
     columns = ("id", "date", "total")
-    tree = ttk.Treeview(win, columns=columns, show="headings")
+    tree = ttk.Treeview(win, columns=columns, show="tree headings")
     tree.heading("id", text="رقم الفاتورة")
     tree.heading("date", text="التاريخ")
     tree.heading("total", text="الإجمالي")
-    tree.pack(pady=10, padx=10, fill=tk.BOTH, expand=True)
+    tree.column("#0", width=30, stretch=False)
+    scrollbar = ttk.Scrollbar(win, orient=tk.VERTICAL, command=tree.yview)
+
+    state = {'filters': {}, 'next': None, 'loading': False, 'scheduled': False}
+
+    def read_filters():
+        filters = {}
+        for key, entry in filter_entries.items():
+            value = entry.get().strip()
+            if not value:
+                continue
+            if key in ("start_date", "end_date"):
+                datetime.strptime(value, "%Y-%m-%d")
+            elif key in ("min_total", "max_total"):
+                value = float(value)
+            filters[key] = value
+        return filters
+
+    def load_page():
+        state['scheduled'] = False
+        # بعد آخر صفحة لا يعني next = None البداية؛ apply_filters وحدها تحمّل من الأول
+        if state['next'] is None and tree.get_children():
+            return
+        state['loading'] = True
+        rows, state['next'] = get_invoices_page(after=state['next'], **state['filters'])
+        for inv_id, created_at, total, line_count in rows:
+            item = tree.insert("", "end", iid=inv_id, values=(inv_id, created_at.split(" ")[0], f"{total:.2f}"))
+            # عنصر مؤقت حتى يظهر سهم التوسيع؛ تُجلب الأسطر عند الفتح فقط
+            tree.insert(item, "end", iid=f"{inv_id}::pending", values=("…", "", ""))
+        more_button.config(state=tk.NORMAL if state['next'] else tk.DISABLED)
+        state['loading'] = False
+
+    def apply_filters():
+        try:
+            state['filters'] = read_filters()
+        except ValueError:
+            messagebox.showerror("خطأ", "تحقق من صيغة التاريخ (YYYY-MM-DD) والمبالغ", parent=win)
+            return
+        state['next'] = None
+        tree.delete(*tree.get_children())
+        load_page()
+
+    def on_open(event):
+        inv_id = tree.focus()
+        pending = f"{inv_id}::pending"
+        if not tree.exists(pending):
+            return
+        tree.delete(pending)
+        for name, price, qty, _ in get_sales_by_invoice(inv_id):
+            tree.insert(inv_id, "end", values=(name, f"{price:.2f} × {qty}", f"{price * qty:.2f}"))
+
+    def on_scroll(first, last):
+        scrollbar.set(first, last)
+        # تحميل الصفحة التالية تلقائيًا عند الاقتراب من نهاية القائمة
+        # yscrollcommand يُستدعى مرات عديدة لكل تمرير، فلا تُجدول إلا صفحة واحدة في كل مرة
+        if float(last) > 0.95 and state['next'] and not state['loading'] and not state['scheduled']:
+            state['scheduled'] = True
+            win.after_idle(load_page)
+
+    tree.configure(yscrollcommand=on_scroll)
+    tree.bind("<<TreeviewOpen>>", on_open)
+
+    tk.Button(filter_frame, text="بحث", command=apply_filters, font=("Arial", 10, "bold")).pack(side=tk.LEFT)
+    for entry in filter_entries.values():
+        entry.bind("<Return>", lambda e: apply_filters())
 
-    for inv_id, sale_time, total in get_all_invoices():
-        tree.insert("", "end", values=(inv_id, sale_time.split(" ")[0], f"{total:.2f}"))
+    scrollbar.pack(side=tk.RIGHT, fill=tk.Y, pady=10)
+    tree.pack(pady=10, padx=(10, 0), fill=tk.BOTH, expand=True)
 
     def view_details():
         selected = tree.selection()
-        if not selected:
+        if not selected or tree.parent(selected[0]):
             messagebox.showwarning("تحذير", "الرجاء اختيار فاتورة لعرض تفاصيلها", parent=win)
             return
-        invoice_id = tree.item(selected[0])['values'][0]
-        show_invoice_details_popup(invoice_id)
+        show_invoice_details_popup(selected[0])
+
+    def reprint_selected():
+        invoice_ids = [iid for iid in tree.selection() if not tree.parent(iid)]
+        if not invoice_ids:
+            messagebox.showwarning("تحذير", "الرجاء اختيار فاتورة أو أكثر", parent=win)
+            return
+        watch_document_futures(win, [submit_document(inv_id, print_receipt=True) for inv_id in invoice_ids], progress_label)
+
+    def export_range():
+        try:
+            filters = read_filters()
+        except ValueError:
+            filters = {}
+        if not filters.get('start_date') or not filters.get('end_date'):
+            messagebox.showwarning("تحذير", "أدخل تاريخ البداية والنهاية للفترة", parent=win)
+            return
+        formats = ask_document_formats(win)
+        if not formats:
+            return
+        out_dir = filedialog.askdirectory(title="مجلد التصدير", parent=win)
+        if not out_dir:
+            return
+        futures = submit_invoice_range(filters['start_date'], filters['end_date'], formats, out_dir)
+        if not futures:
+            messagebox.showinfo("تصدير", "لا توجد فواتير في الفترة", parent=win)
+            return
+        watch_document_futures(win, futures, progress_label)
+
+    buttons_frame = tk.Frame(win)
+    buttons_frame.pack(pady=10)
+    tk.Button(buttons_frame, text="عرض تفاصيل الفاتورة", command=view_details, font=("Arial", 11, "bold")).pack(side=tk.LEFT, padx=5)
+    tk.Button(buttons_frame, text="إعادة طباعة المحدد", command=reprint_selected, font=("Arial", 11, "bold")).pack(side=tk.LEFT, padx=5)
+    tk.Button(buttons_frame, text="تصدير فواتير الفترة", command=export_range, font=("Arial", 11, "bold")).pack(side=tk.LEFT, padx=5)
+    progress_label = tk.Label(buttons_frame, text="")
+    progress_label.pack(side=tk.LEFT, padx=5)
+    more_button = tk.Button(buttons_frame, text="تحميل المزيد", command=load_page, font=("Arial", 11, "bold"))
+    more_button.pack(side=tk.LEFT, padx=5)
+
+    load_page()
+    apply_theme_to_widgets(win.winfo_children())
+
+def watch_document_futures(widget, futures, progress_label=None, on_done=None):
+    """تتابع مهام الطابور من خيط الواجهة دون انتظارها: تحدّث التقدم ثم تستدعي on_done(المهام) عند اكتمالها."""
+    def poll():
+        if not widget.winfo_exists():
+            return
+        finished = [f for f in futures if f.done()]
+        failed = sum(1 for f in finished if f.exception() is not None)
+        if progress_label is not None:
+            progress_label.config(text=f"المستندات: {len(finished)}/{len(futures)}" + (f" — فشل {failed}" if failed else ""))
+        if len(finished) < len(futures):
+            widget.after(200, poll)
+        elif on_done:
+            on_done([f.result() if f.exception() is None else {'status': 'failed', 'error': str(f.exception())} for f in futures])
+    poll()
+
+def ask_document_formats(parent):
+    """نافذة اختيار صيغ المستندات؛ تعيد قائمة الصيغ أو [] عند الإلغاء."""
+    win = tk.Toplevel(parent)
+    win.title("صيغ المستندات")
+    choices = {fmt: tk.BooleanVar(value=fmt in get_document_settings()['receipt_formats']) for fmt in DOCUMENT_FORMATS}
+    for fmt, (label, ext, _) in DOCUMENT_FORMATS.items():
+        tk.Checkbutton(win, text=f"{label} ({ext})", variable=choices[fmt]).pack(anchor='e', padx=20, pady=2)
+    result = []
+    def confirm():
+        result.extend(fmt for fmt, var in choices.items() if var.get())
+        win.destroy()
+    tk.Button(win, text="متابعة", command=confirm, font=("Arial", 10, "bold")).pack(pady=10)
+    apply_theme_to_widgets(win.winfo_children())
+    win.grab_set()
+    win.wait_window()
+    return result
+
+def show_documents_window():
+    win = tk.Toplevel()
+    win.title("المستندات والطباعة")
+    win.geometry("850x550")
+    settings = get_document_settings()
+
+    form = tk.Frame(win)
+    form.pack(pady=5, padx=10, fill=tk.X)
+    entries = {}
+    for row, (key, label) in enumerate([('store_name', "اسم المتجر:"), ('spool_dir', "مجلد الانتظار:"),
+                                        ('print_command', "أمر الطباعة ({path}):"), ('receipt_width', "عرض الإيصال (أحرف):"),
+                                        ('font_path', "خط PDF:")]):
+        tk.Label(form, text=label).grid(row=row, column=1, sticky='e')
+        entry = tk.Entry(form, width=50)
+        entry.insert(0, str(settings[key]))
+        entry.grid(row=row, column=0, padx=5, pady=2)
+        entries[key] = entry
+    options = tk.Frame(win)
+    options.pack(padx=10, fill=tk.X)
+    auto_receipt = tk.BooleanVar(value=settings['auto_receipt'])
+    auto_print = tk.BooleanVar(value=settings['auto_print'])
+    tk.Checkbutton(options, text="إيصال تلقائي بعد كل بيع", variable=auto_receipt).pack(side=tk.RIGHT)
+    tk.Checkbutton(options, text="طباعة تلقائية", variable=auto_print).pack(side=tk.RIGHT, padx=10)
+    formats = {fmt: tk.BooleanVar(value=fmt in settings['receipt_formats']) for fmt in DOCUMENT_FORMATS}
+    for fmt, (label, _, _) in DOCUMENT_FORMATS.items():
+        tk.Checkbutton(options, text=label, variable=formats[fmt]).pack(side=tk.LEFT)
+
+    def save():
+        try:
+            width = int(entries['receipt_width'].get())
+        except ValueError:
+            messagebox.showerror("خطأ", "عرض الإيصال رقم صحيح", parent=win)
+            return
+        values = {key: entries[key].get().strip() for key in ('store_name', 'spool_dir', 'print_command', 'font_path')}
+        values.update(receipt_width=width, auto_receipt=auto_receipt.get(), auto_print=auto_print.get(),
+                      receipt_formats=[fmt for fmt, var in formats.items() if var.get()] or ['txt'])
+        save_document_settings(values)
+        messagebox.showinfo("تم", "تم حفظ إعدادات المستندات", parent=win)
+
+    tk.Button(win, text="حفظ الإعدادات", command=save, font=("Arial", 10, "bold")).pack(pady=5)
+
+    tk.Label(win, text="آخر مهام الطابور", font=("Arial", 12, "bold")).pack()
+    columns = ("id", "invoice", "formats", "status", "ms", "detail")
+    tree = ttk.Treeview(win, columns=columns, show="headings")
+    for col, txt, width in zip(columns, ["#", "الفاتورة", "الصيغ", "الحالة", "المدة (ms)", "التفاصيل"], [40, 150, 110, 80, 80, 350]):
+        tree.heading(col, text=txt)
+        tree.column(col, width=width, anchor='center')
+    tree.pack(pady=5, padx=10, fill=tk.BOTH, expand=True)
+    statuses = {'queued': "في الانتظار", 'running': "قيد التنفيذ", 'done': "تم", 'failed': "فشل"}
+
+    def refresh():
+        if not win.winfo_exists():
+            return
+        sync_tree_rows(tree, [(str(job['id']), (
+            job['id'], job['invoice_id'], "، ".join(job['formats']), statuses[job['status']],
+            "" if job['ms'] is None else f"{job['ms']:.0f}",
+            job['error'] or ("أُرسلت للطابعة" if job['printed'] else ", ".join((job['paths'] or {}).values())),
+        )) for job in get_document_jobs()])
+        win.after(1000, refresh)
+
+    refresh()
+    apply_theme_to_widgets(win.winfo_children())
+
+def show_branches_window():
+    win = tk.Toplevel()
+    win.title("الفروع والتقارير الموحدة")
+    win.geometry("1000x650")
+
+    branches_tree = ttk.Treeview(win, columns=("name", "path", "active", "status"), show="headings", height=6)
+    for col, txt, width in [("name", "الفرع", 140), ("path", "ملف القاعدة", 420), ("active", "نشط", 60), ("status", "آخر تشغيل", 250)]:
+        branches_tree.heading(col, text=txt)
+        branches_tree.column(col, width=width, anchor='center')
+    branches_tree.pack(pady=5, padx=10, fill=tk.X)
+    last_status = {}
+
+    def load_branches():
+        # معرّف الصف هو رقم الفرع
+        sync_tree_rows(branches_tree, [(str(b['id']), (b['name'], b['db_path'], "نعم" if b['active'] else "لا",
+                                                       last_status.get(b['db_path'], ""))) for b in get_branches()])
+
+    def add():
+        name = simpledialog.askstring("إضافة فرع", "اسم الفرع:", parent=win)
+        if not name:
+            return
+        path = filedialog.askopenfilename(title="قاعدة بيانات الفرع", filetypes=[("SQLite", "*.db"), ("All files", "*.*")], parent=win)
+        if not path:
+            return
+        success, msg = add_branch(name.strip(), path)
+        if not success:
+            messagebox.showerror("خطأ", msg, parent=win)
+        load_branches()
+
+    def selected_branch():
+        sel = branches_tree.selection()
+        if not sel:
+            messagebox.showwarning("تحذير", "اختر فرعًا", parent=win)
+            return None
+        return int(sel[0])
+
+    def toggle():
+        branch_id = selected_branch()
+        if branch_id is not None:
+            set_branch_active(branch_id, branches_tree.item(str(branch_id))['values'][2] != "نعم")
+            load_branches()
+
+    def remove():
+        branch_id = selected_branch()
+        if branch_id is not None and messagebox.askyesno("تأكيد", "إزالة الفرع من القائمة؟ (لا يُحذف ملفه)", parent=win):
+            delete_branch(branch_id)
+            load_branches()
+
+    branch_buttons = tk.Frame(win)
+    branch_buttons.pack(pady=5)
+    for text, command in [("إضافة فرع", add), ("تفعيل/إيقاف", toggle), ("إزالة", remove)]:
+        tk.Button(branch_buttons, text=text, command=command).pack(side=tk.RIGHT, padx=5)
+
+    controls = tk.Frame(win)
+    controls.pack(pady=5, padx=10, fill=tk.X)
+    tk.Label(controls, text="تاريخ التقرير اليومي:").pack(side=tk.RIGHT)
+    date_e = tk.Entry(controls, width=12)
+    date_e.insert(0, date.today().isoformat())
+    date_e.pack(side=tk.RIGHT, padx=5)
+    tk.Label(controls, text="الأكثر مبيعًا خلال (أيام):").pack(side=tk.RIGHT)
+    days_combo = ttk.Combobox(controls, state="readonly", width=8, values=("الكل", 7, 30, 90, 365))
+    days_combo.set("الكل")
+    days_combo.pack(side=tk.RIGHT, padx=5)
+    summary_label = tk.Label(controls, justify=tk.RIGHT)
+    summary_label.pack(side=tk.LEFT)
+
+    notebook = ttk.Notebook(win)
+    notebook.pack(pady=5, padx=10, fill=tk.BOTH, expand=True)
+    tabs = {
+        'daily': ("التقرير اليومي الموحد", ["المنتج", "الكمية", "الإيراد", "الربح"]),
+        'best_sellers': ("الأكثر مبيعًا", ["المنتج", "الكمية", "أكثر فرع مبيعًا"]),
+        'stock': ("المخزون في الفروع", ["المنتج", "الإجمالي", "قيمة المخزون", "التوزيع", "منخفض في"]),
+    }
+    trees = {}
+    for key, (title, headings) in tabs.items():
+        frame = tk.Frame(notebook)
+        notebook.add(frame, text=title)
+        columns = tuple(f"c{i}" for i in range(len(headings)))
+        tree = ttk.Treeview(frame, columns=columns, show="headings")
+        for col, txt in zip(columns, headings):
+            tree.heading(col, text=txt)
+            tree.column(col, width=150, anchor='center')
+        tree.column("c0", width=220, anchor='e')
+        tree.pack(fill=tk.BOTH, expand=True)
+        trees[key] = tree
+    trees['stock'].column("c3", width=300)
+
+    def show_results(results):
+        for report, result in results.items():
+            merged, tree = result['merged'], trees[report]
+            tree.delete(*tree.get_children())
+            if report == 'daily':
+                rows = [(name, qty, f"{revenue:.2f}", f"{profit:.2f}") for name, qty, revenue, profit in merged['products']]
+                summary_label.config(text=f"الفواتير: {merged['invoices']}   الإجمالي: {merged['total']:.2f}   " + "   ".join(
+                    f"{branch}: {total:.2f}" for branch, _, total in merged['branches']))
+            elif report == 'best_sellers':
+                rows = merged
+            else:
+                rows = [(e['name'], e['total'], f"{e['value']:.2f}", "، ".join(f"{b}: {q}" for b, q in e['by_branch'].items()),
+                         "، ".join(e['low_in'])) for e in merged]
+            for row in rows:
+                tree.insert("", "end", values=row)
+            for b in result['branches']:
+                last_status[b['db_path']] = (f"خطأ: {b['error']}" if b['error'] else
+                                             "من الذاكرة" if b['cached'] else f"{b['ms']:.0f} ms")
+        load_branches()
+
+    def run_reports():
+        try:
+            datetime.strptime(date_e.get().strip(), "%Y-%m-%d")
+        except ValueError:
+            messagebox.showerror("خطأ", "صيغة التاريخ: YYYY-MM-DD", parent=win)
+            return
+        days = days_combo.get()
+        params = {
+            'daily': {'date': date_e.get().strip()},
+            'best_sellers': {} if days == "الكل" else {'since': (date.today() - timedelta(days=int(days))).isoformat()},
+            'stock': {},
+        }
+        run_button.config(state=tk.DISABLED)
+        summary_label.config(text="جارٍ جمع تقارير الفروع...")
+        state = {}
+
+        def work():
+            try:
+                state['results'] = {report: run_federated_report(report, p) for report, p in params.items()}
+            except Exception as e:
+                state['error'] = str(e)
+
+        # يُجمع في خيط خلفي؛ الواجهة تتحقق من انتهائه دون انتظار
+        worker = threading.Thread(target=work, daemon=True)
+        worker.start()
+
+        def poll():
+            if not win.winfo_exists():
+                return
+            if worker.is_alive():
+                win.after(100, poll)
+                return
+            run_button.config(state=tk.NORMAL)
+            if 'error' in state:
+                summary_label.config(text="")
+                messagebox.showerror("خطأ", state['error'], parent=win)
+            else:
+                show_results(state['results'])
+        poll()
+
+    run_button = tk.Button(controls, text="تشغيل التقارير", command=run_reports, font=("Arial", 10, "bold"))
+    run_button.pack(side=tk.RIGHT, padx=5)
+    load_branches()
+    apply_theme_to_widgets(win.winfo_children())
+
+def show_stock_movements_window():
+    win = tk.Toplevel()
+    win.title("حركة المخزون")
+    win.geometry("800x450")
+
+    filter_frame = tk.Frame(win)
+    filter_frame.pack(pady=5, padx=10, fill=tk.X)
+    tk.Label(filter_frame, text="من (YYYY-MM-DD):").pack(side=tk.RIGHT)
+    start_e = tk.Entry(filter_frame, width=12)
+    start_e.insert(0, (date.today() - timedelta(days=6)).isoformat())
+    start_e.pack(side=tk.RIGHT, padx=5)
+    tk.Label(filter_frame, text="إلى:").pack(side=tk.RIGHT)
+    end_e = tk.Entry(filter_frame, width=12)
+    end_e.insert(0, date.today().isoformat())
+    end_e.pack(side=tk.RIGHT, padx=5)
+
+    columns = ("name", "opening") + tuple(STOCK_MOVEMENT_TYPES) + ("closing",)
+    tree = ttk.Treeview(win, columns=columns, show="headings")
+    headings = ["المنتج", "رصيد افتتاحي"] + list(STOCK_MOVEMENT_TYPES.values()) + ["رصيد ختامي"]
+    for col, txt in zip(columns, headings):
+        tree.heading(col, text=txt)
+        tree.column(col, width=90, anchor='center')
+    tree.column("name", width=160, anchor='e')
+
+    def load_report():
+        start, end = start_e.get().strip(), end_e.get().strip()
+        try:
+            datetime.strptime(start, "%Y-%m-%d")
+            datetime.strptime(end, "%Y-%m-%d")
+        except ValueError:
+            messagebox.showerror("خطأ", "صيغة التاريخ: YYYY-MM-DD", parent=win)
+            return
+        for row in tree.get_children():
+            tree.delete(row)
+        for r in get_stock_movements_report(start, end):
+            tree.insert("", "end", values=tuple(r[col] for col in columns))
+
+    tk.Button(filter_frame, text="عرض", command=load_report, font=("Arial", 10, "bold")).pack(side=tk.RIGHT, padx=5)
+    tree.pack(pady=10, padx=10, fill=tk.BOTH, expand=True)
+
+    load_report()
+    apply_theme_to_widgets(win.winfo_children())
+
+def show_reorder_window():
+    win = tk.Toplevel()
+    win.title("المخزون المنخفض وإعادة الطلب")
+    win.geometry("900x500")
+
+    columns = ("qty", "threshold", "velocity", "cover", "lead", "suggested")
+    tree = ttk.Treeview(win, columns=columns, show="tree headings")
+    tree.heading("#0", text="المورد / المنتج")
+    tree.column("#0", width=220, anchor='e')
+    for col, txt in zip(columns, ["الكمية", "حد الطلب", "البيع اليومي", "أيام التغطية", "مدة التوريد", "الكمية المقترحة"]):
+        tree.heading(col, text=txt)
+        tree.column(col, width=100, anchor='center')
+    register_theme_role(tree, 'tree')
+    suggestions = {}
+
+    def load():
+        suggestions.clear()
+        suggestions.update(get_reorder_suggestions())
+        tree.delete(*tree.get_children())
+        for index, (supplier, items) in enumerate(suggestions.items()):
+            parent = tree.insert("", "end", iid=f"s{index}", text=supplier or "بدون مورد", open=True,
+                                 values=("", "", "", "", items[0]['lead_time_days'], sum(i['suggested_quantity'] for i in items)))
+            for item in items:
+                tree.insert(parent, "end", iid=str(item['id']), text=item['name'],
+                            tags=stock_tags(item['quantity'], item['reorder_threshold']),
+                            values=(item['quantity'], item['reorder_threshold'], item['velocity'],
+                                    "∞" if item['days_of_cover'] is None else item['days_of_cover'],
+                                    item['lead_time_days'], item['suggested_quantity']))
+
+    def selected_item():
+        selected = tree.selection()
+        return selected[0] if selected else None
+
+    def edit_threshold():
+        iid = selected_item()
+        if not iid or iid.startswith("s"):
+            messagebox.showwarning("تحذير", "اختر منتجًا", parent=win)
+            return
+        value = simpledialog.askinteger("حد إعادة الطلب", f"حد الطلب لـ {tree.item(iid)['text']}:",
+                                        initialvalue=tree.item(iid)['values'][1], minvalue=0, parent=win)
+        if value is not None:
+            set_reorder_threshold(int(iid), value)
+
+    def edit_lead_time():
+        iid = selected_item()
+        if not iid:
+            messagebox.showwarning("تحذير", "اختر موردًا", parent=win)
+            return
+        parent = tree.parent(iid) or iid
+        supplier = list(suggestions)[int(parent[1:])]
+        if supplier is None:
+            messagebox.showwarning("تحذير", "المنتجات بدون مورد تستخدم مدة التوريد الافتراضية", parent=win)
+            return
+        value = simpledialog.askinteger("مدة التوريد", f"مدة التوريد بالأيام لـ {supplier}:",
+                                        initialvalue=tree.item(parent)['values'][4], minvalue=0, parent=win)
+        if value is not None:
+            set_supplier_lead_time(supplier, value)
+            load()
+
+    def export_orders():
+        if not suggestions:
+            messagebox.showinfo("لا توجد طلبات", "لا توجد منتجات بلغت حد إعادة الطلب", parent=win)
+            return
+        filepath = filedialog.asksaveasfilename(defaultextension=".xlsx", filetypes=[("Excel", "*.xlsx")],
+                                                initialfile=f"أوامر_الشراء_{date.today().isoformat()}.xlsx", parent=win)
+        if filepath and export_purchase_orders(suggestions, filepath):
+            messagebox.showinfo("تم", f"تم حفظ أوامر الشراء في:\n{filepath}", parent=win)
+
+    button_frame = tk.Frame(win)
+    button_frame.pack(pady=5)
+    for text, command in [("تحديث", load), ("تعديل حد الطلب", edit_threshold),
+                          ("تعديل مدة التوريد", edit_lead_time), ("تصدير أوامر الشراء", export_orders)]:
+        tk.Button(button_frame, text=text, command=command, font=("Arial", 10, "bold")).pack(side=tk.RIGHT, padx=5)
+    tree.pack(pady=10, padx=10, fill=tk.BOTH, expand=True)
+
+    # الجدول صغير (المنتجات المنخفضة فقط عبر الفهرس الجزئي) فيُعاد بناؤه مع كل تغيير في المخزون
+    subscribe('product_changed', lambda event: load(), owner=tree)
+    subscribe('stock_changed', lambda event: load(), owner=tree)
+    load()
+    apply_theme_to_widgets(win.winfo_children())
+
+def show_bulk_update_window(products_tree):
+    win = tk.Toplevel()
+    win.title("تعديل جماعي للمنتجات")
+    win.geometry("820x560")
+
+    all_suppliers, no_supplier = "(الكل)", "(بدون مورد)"
+    filter_frame = tk.Frame(win)
+    filter_frame.pack(pady=5, padx=10, fill=tk.X)
+    tk.Label(filter_frame, text="المورد:").pack(side=tk.RIGHT)
+    supplier_combo = ttk.Combobox(filter_frame, state="readonly", width=18, values=[all_suppliers, no_supplier] + get_suppliers())
+    supplier_combo.current(0)
+    supplier_combo.pack(side=tk.RIGHT, padx=5)
+    tk.Label(filter_frame, text="الاسم (* حرف بدل):").pack(side=tk.RIGHT)
+    name_e = tk.Entry(filter_frame, width=18)
+    name_e.pack(side=tk.RIGHT, padx=5)
+    selection_only = tk.BooleanVar(value=False)
+    tk.Checkbutton(filter_frame, text="المنتجات المحددة فقط", variable=selection_only).pack(side=tk.RIGHT, padx=5)
+
+    op_frame = tk.Frame(win)
+    op_frame.pack(pady=5, padx=10, fill=tk.X)
+    tk.Label(op_frame, text="العملية:").pack(side=tk.RIGHT)
+    op_combo = ttk.Combobox(op_frame, state="readonly", width=28, values=[label for _, _, label in BULK_OPERATIONS.values()])
+    op_combo.current(0)
+    op_combo.pack(side=tk.RIGHT, padx=5)
+    tk.Label(op_frame, text="القيمة:").pack(side=tk.RIGHT)
+    value_e = tk.Entry(op_frame, width=18)
+    value_e.pack(side=tk.RIGHT, padx=5)
+    tk.Label(op_frame, text="السبب:").pack(side=tk.RIGHT)
+    reason_e = tk.Entry(op_frame, width=20)
+    reason_e.pack(side=tk.RIGHT, padx=5)
+
+    columns = ("name", "old", "new")
+    preview_tree = ttk.Treeview(win, columns=columns, show="headings")
+    for col, txt in zip(columns, ["المنتج", "القيمة الحالية", "القيمة الجديدة"]):
+        preview_tree.heading(col, text=txt)
+        preview_tree.column(col, width=200, anchor='center')
+    preview_tree.pack(pady=5, padx=10, fill=tk.BOTH, expand=True)
+    count_label = tk.Label(win, text="")
+    count_label.pack()
+
+    def request():
+        """(العملية، القيمة، الفلاتر) من النموذج أو None مع رسالة خطأ."""
+        operation = list(BULK_OPERATIONS)[op_combo.current()]
+        text = value_e.get().strip()
+        try:
+            if BULK_OPERATIONS[operation][0] in PRICE_COLUMNS:
+                value = float(text)
+            elif operation == 'expiry':
+                value = datetime.strptime(text, "%Y-%m-%d").strftime("%Y-%m-%d") if text else None
+            else:
+                value = text or None
+        except ValueError:
+            messagebox.showerror("خطأ", "قيمة غير صحيحة (رقم أو تاريخ YYYY-MM-DD)", parent=win)
+            return None
+        filters = {'name_pattern': name_e.get().strip() or None}
+        if supplier_combo.get() != all_suppliers:
+            filters['supplier'] = "" if supplier_combo.get() == no_supplier else supplier_combo.get()
+        if selection_only.get():
+            # معرّف الصف في جدول المنتجات هو رقم المنتج
+            filters['product_ids'] = [int(iid) for iid in products_tree.selection()]
+            if not filters['product_ids']:
+                messagebox.showwarning("تحذير", "لا توجد منتجات محددة", parent=win)
+                return None
+        return operation, value, filters
+
+    def preview():
+        req = request()
+        if not req:
+            return None
+        try:
+            rows = preview_bulk_update(req[0], req[1], **req[2])
+        except ValueError as e:
+            messagebox.showerror("خطأ", str(e), parent=win)
+            return None
+        preview_tree.delete(*preview_tree.get_children())
+        for _, name, old, new in rows:
+            preview_tree.insert("", "end", values=(name, "" if old is None else old, "" if new is None else new))
+        count_label.config(text=f"سيتم تعديل {len(rows)} منتج")
+        return req, rows
+
+    def apply():
+        previewed = preview()
+        if not previewed:
+            return
+        (operation, value, filters), rows = previewed
+        if not rows:
+            messagebox.showinfo("لا تغيير", "لا توجد منتجات ستتغير", parent=win)
+            return
+        if not messagebox.askyesno("تأكيد", f"تطبيق \"{op_combo.get()}\" على {len(rows)} منتج؟", parent=win):
+            return
+        changed = apply_bulk_update(operation, value, reason_e.get().strip() or None, **filters)
+        messagebox.showinfo("تم", f"تم تعديل {changed} منتج", parent=win)
+        preview()
+
+    def show_history():
+        hist = tk.Toplevel(win)
+        hist.title("سجل الأسعار")
+        hist.geometry("800x400")
+        hist_columns = ("at", "name", "old_cost", "new_cost", "old_sell", "new_sell", "reason")
+        hist_tree = ttk.Treeview(hist, columns=hist_columns, show="headings")
+        for col, txt in zip(hist_columns, ["الوقت", "المنتج", "شراء قبل", "شراء بعد", "بيع قبل", "بيع بعد", "السبب"]):
+            hist_tree.heading(col, text=txt)
+            hist_tree.column(col, width=105, anchor='center')
+        hist_tree.pack(pady=10, padx=10, fill=tk.BOTH, expand=True)
+        selected = products_tree.selection()
+        for row in get_price_history(int(selected[0]) if len(selected) == 1 else None):
+            hist_tree.insert("", "end", values=tuple("" if v is None else v for v in row))
+        apply_theme_to_widgets(hist.winfo_children())
+
+    button_frame = tk.Frame(win)
+    button_frame.pack(pady=5)
+    for text, command in [("معاينة", preview), ("تطبيق", apply), ("سجل الأسعار", show_history)]:
+        tk.Button(button_frame, text=text, command=command, font=("Arial", 10, "bold")).pack(side=tk.RIGHT, padx=5)
+    apply_theme_to_widgets(win.winfo_children())
+
+def show_z_report(report):
+    win = tk.Toplevel()
+    win.title(f"تقرير الإغلاق - الوردية #{report['id']}")
+    win.geometry("420x520")
+    text = tk.Text(win, font=("Courier", 11))
+    text.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+    text.insert(tk.END, "\n".join(z_report_lines(report)))
+    text.config(state=tk.DISABLED)
+    apply_theme_to_widgets(win.winfo_children())
+
+def show_shifts_window():
+    win = tk.Toplevel()
+    win.title("الورديات وأداء الموظفين")
+    win.geometry("950x500")
+
+    filter_frame = tk.Frame(win)
+    filter_frame.pack(pady=5, padx=10, fill=tk.X)
+    tk.Label(filter_frame, text="من (YYYY-MM-DD):").pack(side=tk.RIGHT)
+    start_e = tk.Entry(filter_frame, width=12)
+    start_e.insert(0, (date.today() - timedelta(days=6)).isoformat())
+    start_e.pack(side=tk.RIGHT, padx=5)
+    tk.Label(filter_frame, text="إلى:").pack(side=tk.RIGHT)
+    end_e = tk.Entry(filter_frame, width=12)
+    end_e.insert(0, date.today().isoformat())
+    end_e.pack(side=tk.RIGHT, padx=5)
+
+    notebook = ttk.Notebook(win)
+    notebook.pack(pady=5, padx=10, fill=tk.BOTH, expand=True)
+    tabs = {
+        'shifts': ("الورديات", ["#", "الموظف", "الفتح", "الإغلاق", "الفواتير", "الإجمالي", "الخصومات", "الصافي", "فرق النقد"]),
+        'performance': ("أداء الموظفين", ["الموظف", "الورديات", "الفواتير", "القطع", "الصافي", "متوسط الفاتورة", "الساعات", "المبيعات/ساعة"]),
+    }
+    trees = {}
+    for key, (title, headings) in tabs.items():
+        frame = tk.Frame(notebook)
+        notebook.add(frame, text=title)
+        columns = tuple(f"c{i}" for i in range(len(headings)))
+        tree = ttk.Treeview(frame, columns=columns, show="headings")
+        for col, txt in zip(columns, headings):
+            tree.heading(col, text=txt)
+            tree.column(col, width=100, anchor='center')
+        tree.pack(fill=tk.BOTH, expand=True)
+        trees[key] = tree
+    trees['shifts'].column("c0", width=50)
+
+    def load(event=None):
+        start, end = start_e.get().strip(), end_e.get().strip()
+        try:
+            datetime.strptime(start, "%Y-%m-%d")
+            datetime.strptime(end, "%Y-%m-%d")
+        except ValueError:
+            if event is None:
+                messagebox.showerror("خطأ", "صيغة التاريخ: YYYY-MM-DD", parent=win)
+            return
+        # معرّف الصف في جدول الورديات هو رقم الوردية
+        sync_tree_rows(trees['shifts'], [(str(s['id']), (
+            s['id'], s['employee_name'], s['opened_at'][:16], (s['closed_at'] or "مفتوحة")[:16], s['invoice_count'],
+            f"{s['gross']:.2f}", f"{s['promotion_discounts'] + s['manual_discounts']:.2f}", f"{s['net_total']:.2f}",
+            "—" if s['cash_difference'] is None else f"{s['cash_difference']:+.2f}",
+        )) for s in get_shifts(start, end)])
+        sync_tree_rows(trees['performance'], [(str(p['employee_id']), (
+            p['name'], p['shifts'], p['invoices'], p['items'], f"{p['net_total']:.2f}", f"{p['average_invoice']:.2f}",
+            f"{p['hours']:.1f}", f"{p['sales_per_hour']:.2f}",
+        )) for p in get_employee_performance(start, end)])
+
+    def selected_shift():
+        sel = trees['shifts'].selection()
+        if not sel:
+            messagebox.showwarning("تحذير", "اختر وردية", parent=win)
+            return None
+        return int(sel[0])
+
+    def show_report():
+        shift_id = selected_shift()
+        if shift_id is not None:
+            show_z_report(get_shift_report(shift_id))
+
+    def close_selected():
+        shift_id = selected_shift()
+        if shift_id is None:
+            return
+        counted_cash = simpledialog.askfloat("إغلاق الوردية", "النقد المعدود في الدرج:", minvalue=0, parent=win)
+        if counted_cash is None:
+            return
+        report = close_shift(shift_id, counted_cash)
+        if report is None:
+            messagebox.showinfo("الوردية", "الوردية مغلقة مسبقًا", parent=win)
+        else:
+            show_z_report(report)
+
+    tk.Button(filter_frame, text="عرض", command=load, font=("Arial", 10, "bold")).pack(side=tk.RIGHT, padx=5)
+    button_frame = tk.Frame(win)
+    button_frame.pack(pady=5)
+    tk.Button(button_frame, text="تقرير الإغلاق (Z)", command=show_report).pack(side=tk.RIGHT, padx=5)
+    tk.Button(button_frame, text="إغلاق الوردية", command=close_selected).pack(side=tk.RIGHT, padx=5)
+    subscribe('shift_changed', load, owner=win)
+    subscribe('sale_completed', load, owner=win)
+    load()
+    apply_theme_to_widgets(win.winfo_children())
+
+def show_promotions_window():
+    win = tk.Toplevel()
+    win.title("العروض")
+    win.geometry("1000x560")
+
+    columns = ("id", "name", "type", "scope", "params", "period", "hours", "caps", "active")
+    tree = ttk.Treeview(win, columns=columns, show="headings", height=10)
+    for col, txt, width in zip(columns, ["#", "الاسم", "النوع", "المنتج / المورد", "المعاملات", "الفترة", "الساعات", "الحدود", "نشط"],
+                               [40, 140, 150, 150, 90, 170, 90, 110, 50]):
+        tree.heading(col, text=txt)
+        tree.column(col, width=width, anchor='center')
+    tree.pack(pady=10, padx=10, fill=tk.BOTH, expand=True)
+
+    def load():
+        tree.delete(*tree.get_children())
+        for promo in get_promotions():
+            params = {'buy_x_get_y': f"{promo['buy_qty']} + {promo['get_qty']}",
+                      'bundle_price': f"{promo['buy_qty']} بـ {promo['amount']}",
+                      'percent_off': f"{promo['amount']}%"}[promo['rule_type']]
+            caps = " / ".join(filter(None, [promo['max_applications'] and f"{promo['max_applications']} مرة",
+                                            promo['max_discount'] and f"≤ {promo['max_discount']}"]))
+            tree.insert("", "end", iid=str(promo['id']), values=(
+                promo['id'], promo['name'], PROMOTION_TYPES[promo['rule_type']],
+                promo['product_name'] or (f"المورد: {promo['supplier']}" if promo['supplier'] else "-"), params,
+                f"{(promo['starts_at'] or '')[:10]} → {(promo['ends_at'] or '')[:10]}",
+                f"{promo['daily_start']}-{promo['daily_end']}" if promo['daily_start'] else "", caps,
+                "نعم" if promo['active'] else "لا"))
+
+    form = tk.Frame(win)
+    form.pack(pady=5, padx=10, fill=tk.X)
+    fields = {}
+    labels = [('name', "الاسم"), ('product', "المنتج (الاسم)"), ('supplier', "أو المورد"), ('buy_qty', "X (الكمية)"),
+              ('get_qty', "Y (مجانًا)"), ('amount', "السعر / النسبة"), ('starts_at', "من (YYYY-MM-DD)"), ('ends_at', "إلى"),
+              ('daily_start', "من الساعة (HH:MM)"), ('daily_end', "إلى الساعة"), ('max_applications', "أقصى مرات للسطر"),
+              ('max_discount', "أقصى خصم للسطر")]
+    for index, (key, text) in enumerate(labels):
+        row, col = divmod(index, 4)
+        tk.Label(form, text=text + ":").grid(row=row, column=7 - col * 2, sticky='e', padx=2, pady=2)
+        fields[key] = tk.Entry(form, width=14)
+        fields[key].grid(row=row, column=6 - col * 2, padx=2, pady=2)
+    type_combo = ttk.Combobox(form, state="readonly", width=25, values=list(PROMOTION_TYPES.values()))
+    type_combo.current(0)
+    type_combo.grid(row=3, column=6, columnspan=2, pady=5)
+
+    def value(key, cast=str):
+        text = fields[key].get().strip()
+        return cast(text) if text else None
+
+    def save():
+        rule_type = list(PROMOTION_TYPES)[type_combo.current()]
+        try:
+            name = value('name')
+            buy_qty, get_qty, amount = value('buy_qty', int), value('get_qty', int), value('amount', float)
+            max_applications, max_discount = value('max_applications', int), value('max_discount', float)
+            starts_at, ends_at = value('starts_at'), value('ends_at')
+            for day in (starts_at, ends_at):
+                if day:
+                    datetime.strptime(day, "%Y-%m-%d")
+            daily_start, daily_end = value('daily_start'), value('daily_end')
+            for clock in (daily_start, daily_end):
+                if clock:
+                    datetime.strptime(clock, "%H:%M")
+        except ValueError:
+            messagebox.showerror("خطأ", "تحقق من الأرقام والتواريخ (YYYY-MM-DD) والساعات (HH:MM)", parent=win)
+            return
+        required = {'buy_x_get_y': buy_qty and get_qty, 'bundle_price': buy_qty and amount, 'percent_off': amount and 0 < amount <= 100}
+        if not name or not required[rule_type] or bool(daily_start) != bool(daily_end):
+            messagebox.showerror("خطأ", "أكمل الاسم ومعاملات نوع العرض (وساعتي البداية والنهاية معًا)", parent=win)
+            return
+        product_id = None
+        if value('product'):
+            product_id = get_product_id_by_name(value('product'))
+            if product_id is None:
+                messagebox.showerror("خطأ", "المنتج غير موجود", parent=win)
+                return
+        elif not value('supplier'):
+            messagebox.showerror("خطأ", "حدد منتجًا أو موردًا", parent=win)
+            return
+        add_promotion(name, rule_type, product_id, None if product_id else value('supplier'), buy_qty, get_qty, amount,
+                      f"{starts_at} 00:00:00" if starts_at else None, f"{ends_at} 23:59:59" if ends_at else None,
+                      daily_start, daily_end, max_applications, max_discount)
+        for entry in fields.values():
+            entry.delete(0, tk.END)
+        load()
+
+    def selected_id():
+        selected = tree.selection()
+        if not selected:
+            messagebox.showwarning("تحذير", "اختر عرضًا", parent=win)
+            return None
+        return int(selected[0])
+
+    def toggle():
+        promotion_id = selected_id()
+        if promotion_id is not None:
+            set_promotion_active(promotion_id, tree.item(str(promotion_id))['values'][-1] != "نعم")
+            load()
+
+    def remove():
+        promotion_id = selected_id()
+        if promotion_id is not None and messagebox.askyesno("تأكيد", "حذف العرض؟", parent=win):
+            delete_promotion(promotion_id)
+            load()
+
+    button_frame = tk.Frame(win)
+    button_frame.pack(pady=5)
+    for text, command in [("إضافة العرض", save), ("تفعيل / إيقاف", toggle), ("حذف", remove)]:
+        tk.Button(button_frame, text=text, command=command, font=("Arial", 10, "bold")).pack(side=tk.RIGHT, padx=5)
+    load()
+    apply_theme_to_widgets(win.winfo_children())
+
+def show_analytics_window():
+    if not numpy_available:
+        messagebox.showwarning("غير متاح", "مكتبة NumPy غير مثبتة. لا يمكن عرض تحليلات المخزون.")
+        return
+    win = tk.Toplevel()
+    win.title("تحليلات المخزون")
+    win.geometry("950x550")
+
+    filter_frame = tk.Frame(win)
+    filter_frame.pack(pady=5, padx=10, fill=tk.X)
+    tk.Label(filter_frame, text="الفترة (أيام):").pack(side=tk.RIGHT)
+    days_combo = ttk.Combobox(filter_frame, state="readonly", width=8, values=(30, 90, 180, 365, 730))
+    days_combo.set(ANALYTICS_WINDOW_DAYS)
+    days_combo.pack(side=tk.RIGHT, padx=5)
+    summary_label = tk.Label(filter_frame, justify=tk.RIGHT)
+    summary_label.pack(side=tk.LEFT)
+
+    notebook = ttk.Notebook(win)
+    notebook.pack(pady=5, padx=10, fill=tk.BOTH, expand=True)
+    tabs = {
+        'abc': ("تصنيف ABC", ["المنتج", "الفئة", "الإيراد", "الكمية المباعة"]),
+        'dead_stock': ("المخزون الراكد", ["المنتج", "الكمية", "قيمة المخزون", "أيام بلا بيع"]),
+        'low_margin': ("هوامش أقل من المستهدف", ["المنتج", "الهامش الحالي", "الهامش المحقق", "إجمالي الربح"]),
+        'sell_through': ("نسبة التصريف", ["المنتج", "المباع", "المتوفر", "نسبة التصريف"]),
+    }
+    trees = {}
+    for key, (title, headings) in tabs.items():
+        frame = tk.Frame(notebook)
+        notebook.add(frame, text=title)
+        columns = tuple(f"c{i}" for i in range(len(headings)))
+        tree = ttk.Treeview(frame, columns=columns, show="headings")
+        for col, txt in zip(columns, headings):
+            tree.heading(col, text=txt)
+            tree.column(col, width=150, anchor='center')
+        tree.column("c0", width=220, anchor='e')
+        tree.pack(fill=tk.BOTH, expand=True)
+        trees[key] = tree
+    margins_label = tk.Label(win, justify=tk.RIGHT)
+    margins_label.pack(pady=5, padx=10, anchor='e')
+
+    def percent(value):
+        return "—" if value is None else f"{value:.1%}"
+
+    def load():
+        data = get_inventory_analytics(int(days_combo.get()))
+        formatters = {
+            'abc': lambda r: (r[0], r[1], f"{r[2]:.2f}", int(r[3])),
+            'dead_stock': lambda r: (r[0], r[1], f"{r[2]:.2f}", "لم يُبع" if r[3] is None else r[3]),
+            'low_margin': lambda r: (r[0], percent(r[1]), percent(r[2]), f"{r[3]:.2f}"),
+            'sell_through': lambda r: (r[0], r[1], r[2], percent(r[3])),
+        }
+        for key, tree in trees.items():
+            tree.delete(*tree.get_children())
+            for row in data[key]:
+                tree.insert("", "end", values=formatters[key](row))
+        summary_label.config(text="   ".join(
+            f"{cls}: {count} منتج — {share:.0%} من الإيراد" for cls, (count, _, share) in data['abc_summary'].items()
+        ) + f"   |   المخزون الراكد: {data['dead_stock_value']:.2f}")
+        percentiles = "، ".join(f"P{p}: {v:.0%}" for p, v in data['margin_percentiles'].items())
+        bins = "، ".join(f"{'' if math.isinf(lo) else f'{lo:.0%}'}–{'' if math.isinf(hi) else f'{hi:.0%}'}: {count}"
+                         for lo, hi, count in data['margin_histogram'])
+        margins_label.config(text=f"توزيع هامش السعر الحالي: {percentiles}\nتوزيع الهامش المحقق (عدد المنتجات): {bins}")
+
+    tk.Button(filter_frame, text="عرض", command=load, font=("Arial", 10, "bold")).pack(side=tk.RIGHT, padx=5)
+    load()
+    apply_theme_to_widgets(win.winfo_children())
+
+def show_sales_archive_window():
+    win = tk.Toplevel()
+    win.title("أرشفة المبيعات")
+    win.geometry("600x380")
+
+    tk.Label(win, text="تُنقل مبيعات السنوات المغلقة إلى ملفات مستقلة بجانب قاعدة البيانات.\n"
+                       "النسخ الاحتياطي يشمل القاعدة الحالية فقط؛ احفظ ملفات الأرشيف مرة واحدة بعد إنشائها.",
+             justify=tk.RIGHT).pack(pady=10, padx=10)
+
+    action_frame = tk.Frame(win)
+    action_frame.pack(pady=5)
+    tk.Label(action_frame, text="السنة:").pack(side=tk.RIGHT)
+    year_combo = ttk.Combobox(action_frame, state="readonly", width=10)
+    year_combo.pack(side=tk.RIGHT, padx=5)
+
+    columns = ("year", "file", "lines", "invoices", "archived_at")
+    tree = ttk.Treeview(win, columns=columns, show="headings")
+    for col, txt in zip(columns, ["السنة", "الملف", "الأسطر", "الفواتير", "تاريخ الأرشفة"]):
+        tree.heading(col, text=txt)
+        tree.column(col, width=100, anchor='center')
+    tree.column("file", width=180)
+
+    def refresh():
+        year_combo['values'] = get_archivable_years()
+        year_combo.set(year_combo['values'][0] if year_combo['values'] else "")
+        tree.delete(*tree.get_children())
+        for row in get_sales_archives():
+            tree.insert("", "end", values=row)
+
+    def archive_selected():
+        if not year_combo.get():
+            messagebox.showwarning("تحذير", "لا توجد سنوات سابقة لأرشفتها", parent=win)
+            return
+        year = int(year_combo.get())
+        if not messagebox.askyesno("تأكيد", f"نقل مبيعات سنة {year} إلى ملف الأرشيف؟", parent=win):
+            return
+        archive_button.config(state=tk.DISABLED)
+        status_label.config(text=f"جارٍ أرشفة سنة {year}...")
+        state = {}
+
+        def work():
+            try:
+                state['result'] = archive_sales_year(year)
+            except sqlite3.Error as e:
+                state['error'] = str(e)
+
+        # النقل في خيط خلفي حتى لا تتجمد الواجهة
+        worker = threading.Thread(target=work, daemon=True)
+        worker.start()
+
+        def poll():
+            if not win.winfo_exists():
+                return
+            if worker.is_alive():
+                win.after(200, poll)
+                return
+            archive_button.config(state=tk.NORMAL)
+            status_label.config(text="")
+            if 'error' in state:
+                messagebox.showerror("خطأ", f"فشلت الأرشفة: {state['error']}", parent=win)
+                return
+            success, result = state['result']
+            if success:
+                messagebox.showinfo("نجاح", f"تم نقل {result} سطر مبيعات إلى:\n{sales_archive_path(year)}", parent=win)
+            else:
+                messagebox.showwarning("تحذير", result, parent=win)
+            refresh()
+        poll()
+
+    archive_button = tk.Button(action_frame, text="أرشفة", command=archive_selected, font=("Arial", 10, "bold"))
+    archive_button.pack(side=tk.RIGHT, padx=5)
+    status_label = tk.Label(action_frame, text="")
+    status_label.pack(side=tk.RIGHT, padx=5)
+    tree.pack(pady=10, padx=10, fill=tk.BOTH, expand=True)
+
+    refresh()
+    apply_theme_to_widgets(win.winfo_children())
+
+def show_diagnostics_window():
+    win = tk.Toplevel()
+    win.title("التشخيص")
+    win.geometry("900x550")
+
+    top_frame = tk.Frame(win)
+    top_frame.pack(pady=5, padx=10, fill=tk.X)
+    enabled_var = tk.BooleanVar(value=diagnostics['enabled'])
+    def toggle_enabled():
+        diagnostics['enabled'] = enabled_var.get()
+    tk.Checkbutton(top_frame, text="تفعيل القياس", variable=enabled_var, command=toggle_enabled).pack(side=tk.RIGHT)
+    writer_label = tk.Label(top_frame, text="")
+    writer_label.pack(side=tk.RIGHT, padx=15)
+
+    columns = ("name", "count", "avg", "p50", "p95", "max")
+    timings_tree = ttk.Treeview(win, columns=columns, show="headings", height=10)
+    for col, txt in zip(columns, ["الدالة", "العدد", "المتوسط (ms)", "p50", "p95", "الأقصى"]):
+        timings_tree.heading(col, text=txt)
+        timings_tree.column(col, width=90, anchor='center')
+    timings_tree.column("name", width=260, anchor='w')
+    timings_tree.pack(pady=5, padx=10, fill=tk.BOTH, expand=True)
+
+    tk.Label(win, text="الاستعلامات البطيئة (الأحدث أولًا)").pack()
+    slow_text = tk.Text(win, height=10, wrap=tk.WORD, font=("Courier New", 9))
+    slow_text.pack(pady=5, padx=10, fill=tk.BOTH, expand=True)
+
+    def refresh():
+        if not win.winfo_exists():
+            return
+        snapshot = get_diagnostics_snapshot()
+        writer = snapshot['writer']
+        writer_label.config(text=f"طابور الكتابة: {writer['queue_depth']} — دفعات: {writer['batches']} — "
+                                 f"متوسط الدفعة: {writer.get('avg_batch', 0):.1f}")
+        timings = sorted(snapshot['timings'].items(), key=lambda item: item[1]['sum_ms'], reverse=True)
+        sync_tree_rows(timings_tree, [
+            (name, (name, h['count'], f"{h['avg_ms']:.2f}", f"{h['p50_ms']:g}", f"{h['p95_ms']:g}", f"{h['max_ms']:.1f}"))
+            for name, h in timings
+        ])
+        slow_text.delete("1.0", tk.END)
+        for q in reversed(snapshot['slow_queries']):
+            slow_text.insert(tk.END, f"[{q['at']}] {q['source']} — {q['ms']} ms\n{q['sql']}\n")
+            for step in q['plan']:
+                slow_text.insert(tk.END, f"    {step}\n")
+            slow_text.insert(tk.END, "\n")
+        win.after(1000, refresh)
+
+    def export_metrics():
+        path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON", "*.json")],
+                                            initialfile="store_metrics.json", title="حفظ القياسات", parent=win)
+        if path:
+            write_metrics_files(os.path.splitext(path)[0])
+            messagebox.showinfo("نجاح", "تم حفظ ملفي القياسات (json و prom)", parent=win)
+
+    def reset():
+        with diagnostics_lock:
+            latency_histograms.clear()
+        slow_queries.clear()
+
+    buttons_frame = tk.Frame(win)
+    buttons_frame.pack(pady=5)
+    tk.Button(buttons_frame, text="حفظ القياسات", command=export_metrics, font=("Arial", 10, "bold")).pack(side=tk.LEFT, padx=5)
+    tk.Button(buttons_frame, text="تصفير", command=reset, font=("Arial", 10, "bold")).pack(side=tk.LEFT, padx=5)
+    tk.Button(buttons_frame, text="سجل الصيانة", command=show_maintenance_log_window, font=("Arial", 10, "bold")).pack(side=tk.LEFT, padx=5)
+
+    refresh()
+    apply_theme_to_widgets(win.winfo_children())
+
+def show_maintenance_log_window():
+    win = tk.Toplevel()
+    win.title("سجل الصيانة")
+    win.geometry("850x400")
+
+    columns = ("at", "task", "status", "ms", "reclaimed", "free_before", "free_after", "detail")
+    tree = ttk.Treeview(win, columns=columns, show="headings")
+    for col, txt in zip(columns, ["الوقت", "المهمة", "الحالة", "المدة (ms)", "المستعاد (بايت)", "حرة قبل", "حرة بعد", "تفاصيل"]):
+        tree.heading(col, text=txt)
+        tree.column(col, width=90, anchor='center')
+    tree.column("at", width=140)
+    tree.column("detail", width=200, anchor='w')
+    tree.pack(pady=10, padx=10, fill=tk.BOTH, expand=True)
+
+    def refresh():
+        tree.delete(*tree.get_children())
+        for row in get_maintenance_log():
+            tree.insert("", "end", values=tuple("" if v is None else v for v in row))
+
+    def run_now():
+        # في خيط خلفي حتى لا تتجمد الواجهة؛ يُحدَّث الجدول بعد انتهاء المهام
+        worker = threading.Thread(target=run_due_maintenance, kwargs={'force': True}, daemon=True)
+        worker.start()
+
+        def poll():
+            if not win.winfo_exists():
+                return
+            if worker.is_alive():
+                win.after(200, poll)
+                return
+            refresh()
+        win.after(200, poll)
+
+    def convert_vacuum():
+        if not messagebox.askyesno(
+                "تأكيد", "تفعيل التفريغ التدريجي يعيد بناء ملف القاعدة كاملًا (VACUUM):\n"
+                "• تتوقف المبيعات على كل الأجهزة حتى ينتهي، وقد يستغرق دقائق في القواعد الكبيرة\n"
+                "• يحتاج مساحة حرة بقدر ضعف حجم القاعدة\n"
+                "يُنصح بتشغيله خارج ساعات البيع بعد نسخة احتياطية. متابعة؟", parent=win):
+            return
+        convert_button.config(state=tk.DISABLED)
+        state = {}
+
+        def work():
+            try:
+                state['result'] = convert_to_incremental_vacuum()
+            except sqlite3.Error as e:
+                state['result'] = (False, str(e))
+
+        worker = threading.Thread(target=work, daemon=True)
+        worker.start()
+
+        def poll():
+            if not win.winfo_exists():
+                return
+            if worker.is_alive():
+                win.after(200, poll)
+                return
+            success, msg = state['result']
+            (messagebox.showinfo if success else messagebox.showerror)("التفريغ التدريجي", msg, parent=win)
+            update_vacuum_button()
+        poll()
+
+    def update_vacuum_button():
+        convert_button.config(state=tk.DISABLED if get_auto_vacuum_mode() == 2 else tk.NORMAL)
 
-    tk.Button(win, text="عرض تفاصيل الفاتورة", command=view_details, font=("Arial", 11, "bold")).pack(pady=10)
+    buttons_frame = tk.Frame(win)
+    buttons_frame.pack(pady=5)
+    tk.Button(buttons_frame, text="تشغيل الصيانة الآن", command=run_now, font=("Arial", 10, "bold")).pack(side=tk.LEFT, padx=5)
+    tk.Button(buttons_frame, text="تحديث", command=refresh, font=("Arial", 10, "bold")).pack(side=tk.LEFT, padx=5)
+    convert_button = tk.Button(buttons_frame, text="تفعيل التفريغ التدريجي", command=convert_vacuum, font=("Arial", 10, "bold"))
+    convert_button.pack(side=tk.LEFT, padx=5)
+    update_vacuum_button()
+
+    refresh()
     apply_theme_to_widgets(win.winfo_children())
 
 def show_invoice_details_popup(invoice_id):
@@ -1354,53 +6060,21 @@ def show_invoice_details_popup(invoice_id):
     tk.Label(total_frame, text=f"{grand_total:.2f}", font=("Arial", 12, "bold")).pack(side=tk.RIGHT)
     apply_theme_to_widgets(win.winfo_children())
 
-    def generate_printable_invoice_text(inv_id):
-        sales_items = get_sales_by_invoice(inv_id)
-        if not sales_items:
-            return None
-
-        header = f"""
-*************************************
-           فاتورة بيع
-*************************************
-رقم الفاتورة: {inv_id}
-التاريخ: {sales_items[0][3]}
--------------------------------------
-المنتج      الكمية    السعر    المجموع
--------------------------------------
-"""
-        body = ""
-        total = 0
-        for name, price, qty, _ in sales_items:
-            subtotal = price * qty
-            total += subtotal
-            # تنسيق النص ليكون متراصفاً
-            body += f"{name:<12} {qty:<8} {price:<8.2f} {subtotal:<8.2f}\n"
-
-        footer = f"""
--------------------------------------
-الإجمالي الكلي: {total:.2f}
-*************************************
-        شكراً لزيارتكم
-*************************************
-"""
-        return header + body + footer
-
     def print_invoice():
-        invoice_text_content = generate_printable_invoice_text(invoice_id)
-        if not invoice_text_content:
-            messagebox.showerror("خطأ", "لا يمكن إنشاء نص الفاتورة.", parent=win)
-            return
-        
-        filepath = filedialog.asksaveasfilename(initialfile=f"{invoice_id}.txt", defaultextension=".txt", filetypes=[("Text files", "*.txt")])
-        if filepath:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                f.write(invoice_text_content)
-            messagebox.showinfo("تم الحفظ", f"تم حفظ الفاتورة في:\n{filepath}", parent=win)
-            import os
-            os.startfile(filepath, 'print')
-
-    tk.Button(win, text="طباعة الفاتورة", command=print_invoice, font=("Arial", 11, "bold")).pack(pady=10)
+        print_button.config(state=tk.DISABLED)
+        def on_done(jobs):
+            print_button.config(state=tk.NORMAL)
+            job = jobs[0]
+            if job['status'] == 'failed':
+                messagebox.showerror("خطأ", f"تعذر إنشاء الفاتورة:\n{job['error']}", parent=win)
+            elif job['printed']:
+                messagebox.showinfo("تم", "أُرسلت الفاتورة إلى الطابعة", parent=win)
+            else:
+                messagebox.showinfo("تم الحفظ", "لا يوجد أمر طباعة مضبوط؛ حُفظت الفاتورة في:\n" + "\n".join(job['paths'].values()), parent=win)
+        watch_document_futures(win, [submit_document(invoice_id, print_receipt=True)], on_done=on_done)
+
+    print_button = tk.Button(win, text="طباعة الفاتورة", command=print_invoice, font=("Arial", 11, "bold"))
+    print_button.pack(pady=10)
     apply_theme_to_widgets(win.winfo_children())
 
 def print_barcode_for_selected_product(tree):
@@ -1413,14 +6087,19 @@ def print_barcode_for_selected_product(tree):
         messagebox.showwarning("تحذير", "الرجاء اختيار منتج لطباعة ملصق له.")
         return
 
-    product_name = tree.item(selected[0])['values'][1]
-    generate_and_print_barcode_label(product_name)
+    product_id = int(selected[0])
+    codes = get_product_barcodes({product_id}).get(product_id)
+    if not codes:
+        messagebox.showwarning("تحذير", "لا يوجد باركود مسجل لهذا المنتج. أضفه من \"باركودات المنتج\".")
+        return
+    # رمز القطعة الواحدة أولًا
+    generate_and_print_barcode_label(codes[0][0], get_products_by_ids({product_id})[0]['name'])
 
-def generate_and_print_barcode_label(product_name):
+def generate_and_print_barcode_label(code, product_name):
     try:
         # 1. إنشاء الباركود كصورة SVG في الذاكرة
         code128 = barcode.get_barcode_class('code128')
-        barcode_instance = code128(product_name, writer=ImageWriter())
+        barcode_instance = code128(code, writer=ImageWriter())
         
         # حفظ SVG في الذاكرة
         svg_buffer = io.BytesIO()
@@ -1456,11 +6135,12 @@ def generate_and_print_barcode_label(product_name):
         draw.text(((label_width - text_width) / 2, 150), product_name, fill="black", font=font)
 
         # 4. حفظ الملصق وإرساله للطباعة
-        filepath = f"barcode_{product_name}.png"
+        filepath = f"barcode_{code}.png"
         label_image.save(filepath)
-        import os
-        os.startfile(filepath, 'print')
-        messagebox.showinfo("تم", f"تم إرسال ملصق الباركود للمنتج '{product_name}' إلى الطابعة.")
+        if send_to_printer(filepath):
+            messagebox.showinfo("تم", f"تم إرسال ملصق الباركود للمنتج '{product_name}' إلى الطابعة.")
+        else:
+            messagebox.showinfo("تم الحفظ", f"لا يوجد أمر طباعة مضبوط؛ حُفظ الملصق في:\n{os.path.abspath(filepath)}")
 
     except Exception as e:
         messagebox.showerror("خطأ في إنشاء الباركود", f"حدث خطأ: {e}")
@@ -1482,50 +6162,39 @@ def add_employee_popup():
         if role not in ["بائع", "مخزن"]:
             messagebox.showerror("خطأ", "الدور يجب أن يكون 'بائع' أو 'مخزن'")
             return
-        with db_context() as conn:
-            try:
-                conn.execute("INSERT INTO employees (name, role, password) VALUES (?, ?, ?)",
-                               (name_e.get(), role, pass_e.get()))
-                messagebox.showinfo("تم", "تمت إضافة الموظف")
-                win.destroy()
-            except sqlite3.IntegrityError:
-                messagebox.showerror("خطأ", "اسم المستخدم مستخدم مسبقًا")
+        if add_employee_to_db(name_e.get(), role, pass_e.get()):
+            messagebox.showinfo("تم", "تمت إضافة الموظف")
+            win.destroy()
+        else:
+            messagebox.showerror("خطأ", "اسم المستخدم مستخدم مسبقًا")
     tk.Button(win, text="حفظ", command=save_emp, font=("Arial", 11, "bold")).pack(pady=10)
     apply_theme_to_widgets(win.winfo_children())
 
-def delete_selected(tree, refresh_callback):
+def delete_selected(tree):
     selected = tree.selection()
     if not selected:
         messagebox.showwarning("تحذير", "اختر منتجًا للحذف")
         return
     name = tree.item(selected[0])['values'][0]
     delete_product_from_db(name)
-    refresh_callback()
     messagebox.showinfo("تم", f"تم حذف المنتج: {name}")
 
-def export_daily_report():
-    today = date.today().isoformat()
-    sales = get_daily_sales(today)
+@instrumented('export')
+def write_daily_report(target_date, filepath):
+    """تكتب تقرير مبيعات يوم معين إلى ملف Excel. تعيد False إذا لم تكن هناك مبيعات."""
+    sales = get_daily_sales(target_date)
     if not sales:
-        messagebox.showinfo("لا توجد مبيعات", "لا توجد مبيعات اليوم")
-        return
+        return False
     invoices = {}
-    for inv_id, name, price, qty in sales:
+    for inv_id, name, price, qty, cost in sales:
         if inv_id not in invoices:
             invoices[inv_id] = []
-        invoices[inv_id].append((name, price, qty))
-    filepath = filedialog.asksaveasfilename(
-        defaultextension=".xlsx",
-        filetypes=[("Excel", "*.xlsx")],
-        initialfile=f"تقرير_اليوم_{today}.xlsx"
-    )
-    if not filepath:
-        return
+        invoices[inv_id].append((name, price, qty, cost))
     wb = Workbook()
     ws = wb.active
     ws.sheet_view.rightToLeft = True
     ws.title = "التقرير اليومي"
-    ws.append(["التقرير اليومي", today])
+    ws.append(["التقرير اليومي", target_date])
     ws.append([])
     ws.append(["رقم الفاتورة", "المنتج", "سعر الشراء", "سعر البيع", "الكمية", "إجمالي البيع", "إجمالي الربح"])
     grand_total = 0
@@ -1541,8 +6210,43 @@ def export_daily_report():
     ws.append(["", "", "", "", "الإجمالي الكلي للمبيعات:", grand_total])
     ws.append(["", "", "", "", "إجمالي الأرباح:", grand_profit])
     wb.save(filepath)
+    return True
+
+def export_daily_report():
+    today = date.today().isoformat()
+    if not get_daily_sales(today):
+        messagebox.showinfo("لا توجد مبيعات", "لا توجد مبيعات اليوم")
+        return
+    filepath = filedialog.asksaveasfilename(
+        defaultextension=".xlsx",
+        filetypes=[("Excel", "*.xlsx")],
+        initialfile=f"تقرير_اليوم_{today}.xlsx"
+    )
+    if not filepath:
+        return
+    write_daily_report(today, filepath)
     messagebox.showinfo("تم", "تم حفظ التقرير اليومي")
 
+@instrumented('db')
+def backup_database_to(backup_path):
+    """تنسخ قاعدة البيانات إلى المسار المحدد عبر واجهة النسخ في SQLite (تشمل ما لم يُنقل بعد من ملف WAL)."""
+    with db_context() as src:
+        dst = sqlite3.connect(backup_path)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+
+@instrumented('db')
+def restore_database_from(restore_path):
+    """تستبدل محتوى القاعدة الحالية بالنسخة المحددة دون استبدال الملف الذي تفتحه الاتصالات الأخرى."""
+    src = sqlite3.connect(restore_path)
+    try:
+        with db_context() as dst:
+            src.backup(dst)
+    finally:
+        src.close()
+
 def backup_database():
     """يقوم بإنشاء نسخة احتياطية من قاعدة البيانات."""
     try:
@@ -1553,7 +6257,7 @@ def backup_database():
             title="حفظ النسخة الاحتياطية"
         )
         if backup_path:
-            shutil.copy(DB_NAME, backup_path)
+            backup_database_to(backup_path)
             messagebox.showinfo("نجاح", f"تم حفظ النسخة الاحتياطية بنجاح في:\n{backup_path}")
     except Exception as e:
         messagebox.showerror("خطأ", f"فشل النسخ الاحتياطي: {e}")
@@ -1566,7 +6270,12 @@ def restore_database():
     restore_path = filedialog.askopenfilename(filetypes=[("Database files", "*.db")], title="اختيار نسخة احتياطية للاستعادة")
     if restore_path:
         try:
-            shutil.copy(restore_path, DB_NAME)
+            restore_database_from(restore_path)
+            # قد تكون النسخة أقدم من نتائج مخزنة؛ تُعاد كلها من البيانات المستعادة
+            try:
+                clear_report_cache()
+            except sqlite3.OperationalError:
+                pass  # نسخة أقدم من جدول الذاكرة؛ ينشئه init_db عند التشغيل التالي
             messagebox.showinfo("نجاح", "تم استعادة قاعدة البيانات بنجاح.\nالرجاء إعادة تشغيل البرنامج الآن.")
             root.quit()
         except Exception as e:
@@ -1631,16 +6340,23 @@ def change_credentials_popup():
     apply_theme_to_widgets(win.winfo_children())
 
 # === 7. بدء التشغيل ===
-init_db()
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["export-changes"]:
+        sys.exit(changes_cli(sys.argv[2:]))
+    init_db()
+    start_maintenance_scheduler()
+    start_document_queue()
+    if diagnostics['enabled']:
+        start_metrics_export(os.path.splitext(os.path.abspath(DB_NAME))[0] + "_metrics")
 
-user_settings = load_user_settings()
-if user_settings:
-    set_theme(user_settings[2])
+    user_settings = load_user_settings()
+    if user_settings:
+        set_theme(user_settings[2])
 
-root = tk.Tk()
-root.title("متجر احترافي - إصدار محسّن")
-root.geometry("1200x700")
+    root = tk.Tk()
+    root.title("متجر احترافي - إصدار محسّن")
+    root.geometry("1200x700")
 
-login_screen()
+    login_screen()
 
-root.mainloop()
+    root.mainloop()